@@ -1,23 +1,99 @@
+import os
 
-from flask import Flask, jsonify
-from flask_sqlalchemy import SQLAlchemy
-from flask_migrate import Migrate
-from flask_jwt_extended import JWTManager
+from flask import Flask
+from werkzeug.middleware.proxy_fix import ProxyFix
+from extensions import db, jwt, init_migrate
+from utils.serialize import FastJSONProvider
+from utils.background import periodic
+from utils.image_jobs import image_jobs
+from utils.passwords import password_hasher, login_throttle
+from utils.revocation import revocation_store
+from utils import sweeper
+from utils import dataset
+from utils import query_plans
+from utils import sqlite_profile
+from utils import db_profiles
+from utils.read_routing import read_router
+from utils.sql_stats import sql_stats
+from utils.metrics import metrics
+from utils.profiler import request_profiler
 
-app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///app.db'
-app.config['JWT_SECRET_KEY'] = 'your-secret-key'  # Change this to a secure value
-db = SQLAlchemy(app)
-migrate = Migrate(app, db)
-jwt = JWTManager(app)
 
-# model
-import model
+def create_app(config=None):
+    """Build the app; `config` overrides the settings below."""
+    app = Flask(__name__)
+    app.json = FastJSONProvider(app)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///app.db'  # default when DATABASE_URL is not set
+    app.config['SQLITE_PRAGMAS'] = {}  # overrides for utils.sqlite_profile.DEFAULT_PRAGMAS, e.g. {'mmap_size': 0}
+    app.config['SQLITE_OPTIMIZE_INTERVAL'] = 60 * 60  # seconds between PRAGMA optimize runs
+    app.config['SQLITE_CHECKPOINT_INTERVAL'] = 5 * 60  # seconds between WAL truncating checkpoints
+    app.config['READ_SNAPSHOT_INTERVAL'] = 0  # seconds between SQLite read snapshot refreshes, each copies the whole database; 0 disables
+    app.config['READ_MAX_STALENESS'] = 30  # older read data falls back to the primary
+    app.config['SQL_STATS'] = False  # Server-Timing header and N+1 warnings per request; exposes DB timings to clients
+    app.config['SQL_REPEAT_THRESHOLD'] = 5  # warn when one statement runs more often in a request
+    app.config['METRICS'] = False  # Prometheus metrics at /metrics, see utils/metrics.py
+    app.config['METRICS_FLUSH_INTERVAL'] = 10  # seconds between each worker's /metrics snapshot
+    app.config['METRICS_TOKEN'] = None  # bearer token required by /metrics; without one only loopback clients
+    app.config['PROFILER_SECRET'] = os.environ.get('PROFILER_SECRET')  # enables on-demand profiling, see utils/profiler.py
+    app.config['PROFILER_MAX_PROFILES'] = 50  # newest profiles kept under instance/profiles
+    app.config['JWT_SECRET_KEY'] = 'your-secret-key'  # Change this to a secure value
+    app.config['JWT_REVOCATION_SYNC_SECONDS'] = 2  # how soon a logout in another worker is seen
+    app.config['JWT_REVOCATION_PURGE_SECONDS'] = 15 * 60  # interval for dropping expired revocations
+    app.config['PASSWORD_HASH_METHOD'] = 'scrypt'  # stored hashes are upgraded to this on login
+    app.config['PASSWORD_WORKERS'] = 2  # threads hashing passwords per worker
+    app.config['PASSWORD_QUEUE_SIZE'] = 32  # logins hashing or waiting, across all workers, before answering 503
+    app.config['LEGACY_BASIC_AUTH'] = True  # also accept HTTP Basic on the user update/delete routes
+    app.config['LOGIN_MAX_FAILURES_PER_USER'] = 5  # per LOGIN_FAILURE_WINDOW seconds
+    app.config['LOGIN_MAX_FAILURES_PER_IP'] = 20
+    app.config['LOGIN_FAILURE_WINDOW'] = 15 * 60
+    app.config['TRUSTED_PROXIES'] = 0  # reverse proxies in front adding X-Forwarded-For, the client IP is read past them
+    app.config['MAX_CONTENT_LENGTH'] = 3 * 1024 * 1024  # request body limit, enforced while reading
+    app.config['IMAGE_WORKERS'] = 2  # image processing processes, 0 processes uploads inline
+    app.config['IMAGE_QUEUE_SIZE'] = 16  # queued uploads per worker before answering 503
+    app.config['IMAGE_JOB_TIMEOUT'] = 15 * 60  # pending images older than this are marked failed
+    app.config['UPLOAD_SWEEP_INTERVAL'] = 6 * 60 * 60  # seconds between orphan sweeps, 0 disables
+    app.config['UPLOAD_SWEEP_GRACE'] = 60 * 60  # files younger than this are never swept
+    app.config['USE_X_SENDFILE'] = False  # let Apache/lighttpd send files via X-Sendfile
+    app.config['UPLOADS_ACCEL_REDIRECT_PREFIX'] = None  # nginx internal location for blob uploads
+    app.config['ASGI_THREADS'] = 8  # threads running the Flask app under create_asgi_app()
+    app.config['ASGI_QUEUE_SIZE'] = 64  # requests waiting for those threads before answering 503
+    app.config.update(config or {})
+    if app.config['TRUSTED_PROXIES']:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['TRUSTED_PROXIES'])
+    periodic.init_app(app)
+    db_profiles.init_app(app)
+    db.init_app(app)
+    sqlite_profile.init_app(app)
+    read_router.init_app(app)
+    sql_stats.init_app(app)
+    metrics.init_app(app)
+    request_profiler.init_app(app)
+    init_migrate(app)
+    jwt.init_app(app)
+    image_jobs.init_app(app)
+    password_hasher.init_app(app)
+    login_throttle.init_app(app)
+    revocation_store.init_app(app)
+    sweeper.init_app(app)
+    dataset.init_app(app)
+    query_plans.init_app(app)
+
+    import model  # noqa: F401, registers the tables
+    from routes import register_blueprints
+    register_blueprints(app)
+    return app
+
+
+def create_asgi_app(config=None):
+    """The app for an ASGI server, see utils/asgi.py:
+
+        uvicorn --factory app:create_asgi_app
+    """
+    from routes.async_reads import async_routes
+    from utils.asgi import AsyncApp
+
+    return AsyncApp(create_app(config), async_routes)
 
-# routes
-import routes
-from routes.reports import reports_bp   
-app.register_blueprint(reports_bp)
 
 if __name__ == '__main__':
-    app.run()
+    create_app().run()
@@ -0,0 +1,310 @@
+"""Connections handled per MB of server memory: gunicorn sync workers
+against the ASGI mode (utils/asgi.py).
+
+Generates a throwaway SQLite database with `flask dataset generate`, then for
+each mode starts the server on it.  For every --connections level it holds
+that many client connections, which send the read mix below with a
+--think-ms pause between requests, as tills do.  This goes on for --duration
+seconds:
+
+    invoice_get      GET /invoice/<id>
+    report_daily     GET /reports/sales/daily
+    report_monthly   GET /reports/sales/monthly
+    product_list     GET /product/list
+    category_stats   GET /category/list?stats=1
+    user_list        GET /user/list
+
+A level is handled when no request failed and the p99 latency stayed under
+--slo-ms.  Server memory is the PSS of all its processes, so pages shared
+after a fork count once, sampled during the run.  The result per mode is its
+highest handled level divided by the memory it needed for it:
+
+    python bench/asgi_bench.py --connections 8,32,128,512 \\
+        --sync-workers 4 --asgi-workers 1 --slo-ms 250 [--min-gain 2]
+
+--min-gain fails the run when the ASGI mode handles fewer than that many
+times the sync connections per MB.  The clients share the machine with the
+server, so compare runs made on the same box.
+"""
+import argparse
+import asyncio
+import os
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+
+from loadtest import free_port, percentile  # noqa: E402
+
+# operation -> (weight, path)
+MIX = {
+    'invoice_get': (40, '/invoice/{sale_id}'),
+    'report_daily': (10, '/reports/sales/daily'),
+    'report_monthly': (10, '/reports/sales/monthly'),
+    'product_list': (15, '/product/list'),
+    'category_stats': (15, '/category/list?stats=1'),
+    'user_list': (10, '/user/list'),
+}
+
+ASGI_MODULE = """\
+from app import create_asgi_app
+
+app = create_asgi_app({config!r})
+"""
+
+
+def generate(url, sales):
+    env = dict(os.environ, DATABASE_URL=url)
+    for command in (['db', 'upgrade'], ['dataset', 'generate', '--yes', '--sales', str(sales),
+                                        '--customers', '5000', '--products', '2000']):
+        subprocess.run([sys.executable, '-m', 'flask', '--app', 'app', *command],
+                       cwd=ROOT, env=env, check=True, capture_output=True)
+
+
+def start_server(mode, workers, url, tmp_dir, port):
+    config = {'METRICS_DIR': os.path.join(tmp_dir, 'metrics'),
+              'IMAGE_RAW_DIR': os.path.join(tmp_dir, 'uploads_pending')}
+    env = dict(os.environ, DATABASE_URL=url, PYTHONPATH=ROOT)
+    log = open(os.path.join(tmp_dir, f"{mode}.log"), 'w')
+    if mode == 'sync':
+        command = [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', f"app:create_app({config!r})"]
+        env.update(BIND=f"127.0.0.1:{port}", WEB_CONCURRENCY=str(workers))
+    else:
+        with open(os.path.join(tmp_dir, 'asgi_bench_app.py'), 'w') as f:
+            f.write(ASGI_MODULE.format(config=config))
+        command = [sys.executable, '-m', 'uvicorn', 'asgi_bench_app:app', '--app-dir', tmp_dir,
+                   '--port', str(port), '--workers', str(workers), '--log-level', 'warning',
+                   '--backlog', '4096', '--no-access-log']
+    return subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=log)
+
+
+def process_tree(pid):
+    """`pid` and all its descendants."""
+    parents = {}
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    # the command name may contain spaces, the fields after it do not
+                    parents[int(entry)] = int(f.read().rsplit(')', 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                pass
+    tree = [pid]
+    for current in tree:
+        tree.extend(child for child, parent in parents.items() if parent == current)
+    return tree
+
+
+def memory_mb(pid):
+    """PSS of the process tree in MB, RSS where smaps_rollup is missing."""
+    total_kb = 0
+    for member in process_tree(pid):
+        for path, field in ((f"/proc/{member}/smaps_rollup", 'Pss:'), (f"/proc/{member}/status", 'VmRSS:')):
+            try:
+                with open(path) as f:
+                    values = [int(line.split()[1]) for line in f if line.startswith(field)]
+            except OSError:
+                continue
+            if values:
+                total_kb += values[0]
+                break
+    return total_kb / 1024
+
+
+class Connection:
+    """HTTP/1.1 client connection; reconnects whenever the server closes it."""
+
+    def __init__(self, port):
+        self.port = port
+        self.reader = self.writer = None
+
+    async def get(self, path):
+        for attempt in (1, 2):
+            if self.writer is None:
+                self.reader, self.writer = await asyncio.open_connection('127.0.0.1', self.port)
+            try:
+                self.writer.write(f"GET {path} HTTP/1.1\r\nHost: bench\r\n\r\n".encode())
+                await self.writer.drain()
+                return await self._response()
+            except (ConnectionError, asyncio.IncompleteReadError):
+                # a kept-alive connection the server had already closed
+                self.close()
+                if attempt == 2:
+                    raise
+
+    async def _response(self):
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionResetError()
+        headers = {}
+        while (line := await self.reader.readline()) not in (b'\r\n', b''):
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip().lower()
+        if 'content-length' in headers:
+            await self.reader.readexactly(int(headers['content-length']))
+        elif headers.get('transfer-encoding') == 'chunked':
+            while True:
+                size = int((await self.reader.readline()).split(b';')[0], 16)
+                await self.reader.readexactly(size + 2)
+                if size == 0:
+                    break
+        else:
+            await self.reader.read()
+            headers['connection'] = 'close'
+        if headers.get('connection') == 'close':
+            self.close()
+        return int(status_line.split()[1])
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+
+async def drive(port, connections, duration, warmup, think, sale_ids, seed_value):
+    """([latency seconds...], errors) of the measured window."""
+    operations = list(MIX)
+    weights = [MIX[name][0] for name in operations]
+    latencies, errors = [], []
+    start = time.perf_counter() + warmup
+    stop = start + duration
+
+    async def client(n):
+        rng = random.Random(seed_value * 1000 + n)
+        conn = Connection(port)
+        # spread the first requests over one think time
+        await asyncio.sleep(rng.uniform(0, think))
+        while time.perf_counter() < stop:
+            path = MIX[rng.choices(operations, weights)[0]][1].format(sale_id=rng.choice(sale_ids))
+            began = time.perf_counter()
+            try:
+                status = await conn.get(path)
+            except OSError as e:
+                status = type(e).__name__
+                conn.close()
+            if began >= start:
+                latencies.append(time.perf_counter() - began)
+                if not isinstance(status, int) or status >= 400:
+                    errors.append(status)
+            await asyncio.sleep(rng.uniform(0.5, 1.5) * think)
+        conn.close()
+
+    await asyncio.gather(*(client(n) for n in range(connections)))
+    return latencies, errors
+
+
+async def sample_memory(pid, peak, stop):
+    while not stop.is_set():
+        peak[0] = max(peak[0], await asyncio.to_thread(memory_mb, pid))
+        try:
+            await asyncio.wait_for(stop.wait(), 0.5)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def run_level(server, port, connections, args, sale_ids):
+    peak = [0.0]
+    stop = asyncio.Event()
+    sampler = asyncio.create_task(sample_memory(server.pid, peak, stop))
+    latencies, errors = await drive(port, connections, args.duration, args.warmup, args.think_ms / 1000,
+                                    sale_ids, args.seed)
+    stop.set()
+    await sampler
+    latencies.sort()
+    return {
+        'connections': connections,
+        'requests': len(latencies),
+        'rps': len(latencies) / args.duration,
+        'p50': percentile(latencies, 50) * 1000,
+        'p99': percentile(latencies, 99) * 1000,
+        'errors': len(errors),
+        'mb': peak[0],
+    }
+
+
+def wait_until_up(server, port, timeout=60):
+    import http.client
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise SystemExit(f"server exited with {server.returncode}")
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=2)
+            conn.request('GET', '/category/list')
+            if conn.getresponse().status == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise SystemExit("server did not come up")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--connections', default='8,32,128,512', help='Comma separated levels.')
+    parser.add_argument('--duration', type=float, default=10, help='Measured seconds per level.')
+    parser.add_argument('--warmup', type=float, default=2, help='Unmeasured seconds per level.')
+    parser.add_argument('--think-ms', type=float, default=200, help='Mean pause between requests.')
+    parser.add_argument('--slo-ms', type=float, default=250, help='p99 a handled level stays under.')
+    parser.add_argument('--sync-workers', type=int, default=4, help='gunicorn sync workers.')
+    parser.add_argument('--asgi-workers', type=int, default=1, help='uvicorn workers.')
+    parser.add_argument('--sales', type=int, default=50000, help='Sales generated.')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--min-gain', type=float, default=None,
+                        help='Fail unless ASGI handles this many times the sync connections per MB.')
+    args = parser.parse_args()
+    levels = [int(level) for level in args.connections.split(',')]
+
+    tmp_dir = tempfile.mkdtemp(prefix='asgi-bench-')
+    url = f"sqlite:///{os.path.join(tmp_dir, 'bench.db')}"
+    results = {}
+    try:
+        generate(url, args.sales)
+        with sqlite3.connect(os.path.join(tmp_dir, 'bench.db')) as conn:
+            sale_ids = [row[0] for row in conn.execute("SELECT id FROM sale")]
+        for mode, workers in (('sync', args.sync_workers), ('asgi', args.asgi_workers)):
+            port = free_port()
+            server = start_server(mode, workers, url, tmp_dir, port)
+            try:
+                wait_until_up(server, port)
+                results[mode] = [asyncio.run(run_level(server, port, level, args, sale_ids))
+                                 for level in levels]
+            finally:
+                server.terminate()
+                server.wait(timeout=30)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    print(f"think {args.think_ms:g} ms, p99 SLO {args.slo_ms:g} ms, {args.duration:g}s per level, "
+          f"{args.sync_workers} sync / {args.asgi_workers} ASGI workers")
+    print(f"{'mode':6}{'conns':>7}{'req/s':>9}{'p50 ms':>9}{'p99 ms':>9}{'errors':>8}{'MB':>8}  handled")
+    per_mb = {}
+    for mode, levels_run in results.items():
+        per_mb[mode] = (0, 0.0, 0.0)
+        for r in levels_run:
+            handled = not r['errors'] and r['requests'] and r['p99'] <= args.slo_ms
+            if handled:
+                per_mb[mode] = (r['connections'], r['mb'], r['connections'] / r['mb'])
+            print(f"{mode:6}{r['connections']:>7}{r['rps']:>9.1f}{r['p50']:>9.1f}{r['p99']:>9.1f}"
+                  f"{r['errors']:>8}{r['mb']:>8.1f}  {'yes' if handled else 'no'}")
+    print()
+    for mode, (connections, mb, ratio) in per_mb.items():
+        print(f"{mode:6} {ratio:6.2f} connections/MB ({connections} connections in {mb:.1f} MB)")
+
+    sync_ratio, asgi_ratio = per_mb['sync'][2], per_mb['asgi'][2]
+    if sync_ratio:
+        print(f"gain   {asgi_ratio / sync_ratio:6.2f}x")
+    if args.min_gain is not None and asgi_ratio < args.min_gain * sync_ratio:
+        print(f"ASGI connections/MB below {args.min_gain}x sync", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,341 @@
+"""HTTP load test of the API against a throwaway SQLite database.
+
+Migrates and seeds a temporary database, starts gunicorn on it (with
+gunicorn.conf.py, so the production settings) and drives it with
+--concurrency client threads for --duration seconds.  The mix is
+weighted like a till:
+
+    login                POST /login
+    product_list         GET  /product/list
+    product_get          GET  /product/list-by-id/<id>   (the lookup a search hits)
+    category_stats       GET  /category/list?stats=1
+    invoice_create       POST /invoice/create            (1-20 items, mostly small)
+    invoice_get          GET  /invoice/<id>
+    report_daily         GET  /reports/sales/daily
+    report_monthly       GET  /reports/sales/monthly
+
+and reports throughput plus p50/p95/p99 per operation.  The exit status is
+1 when a limit is broken:
+
+    python bench/loadtest.py --duration 30 --concurrency 16 \\
+        --limit invoice_create.p95=50 --limit all.p99=250 \\
+        --max-error-rate 0.01 --min-rps 300
+
+    # or against an earlier run, failing when any p95 grew by more than 20%
+    python bench/loadtest.py --save base.json
+    python bench/loadtest.py --baseline base.json --tolerance 0.2
+
+The clients run in this process, so on a small box they compete with the
+server for CPU; compare runs made with the same settings.
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+
+PASSWORD = 'loadtest-password'
+
+# operation -> weight
+MIX = {
+    'login': 2,
+    'product_list': 25,
+    'product_get': 15,
+    'category_stats': 10,
+    'invoice_create': 25,
+    'invoice_get': 13,
+    'report_daily': 6,
+    'report_monthly': 4,
+}
+
+
+def seed(url, users, customers, categories, products, seed_value):
+    """Schema through the migrations, then a small catalogue."""
+    from werkzeug.security import generate_password_hash
+
+    env = dict(os.environ, DATABASE_URL=url)
+    subprocess.run([sys.executable, '-m', 'flask', '--app', 'app', 'db', 'upgrade'],
+                   cwd=ROOT, env=env, check=True, capture_output=True)
+
+    os.environ['DATABASE_URL'] = url
+    from app import create_app
+    from extensions import db
+    from model import Category, Customer, Product, User
+
+    rng = random.Random(seed_value)
+    app = create_app({'METRICS': False, 'READ_SNAPSHOT_INTERVAL': 0})
+    with app.app_context():
+        hashed = generate_password_hash(PASSWORD, app.config['PASSWORD_HASH_METHOD'])
+        db.session.add_all(User(user_name=f"cashier{i}", password=hashed) for i in range(users))
+        db.session.add_all(Customer(name=f"customer {i}") for i in range(customers))
+        db.session.add_all(Category(name=f"category {i}") for i in range(categories))
+        db.session.flush()
+        category_ids = [c.id for c in Category.query.all()]
+        for i in range(products):
+            cost = round(rng.uniform(0.5, 80), 2)
+            db.session.add(Product(name=f"product {i}", category_id=rng.choice(category_ids),
+                                   cost=cost, price=round(cost * rng.uniform(1.1, 1.6), 2)))
+        db.session.commit()
+        return ([u.id for u in User.query.all()], [c.id for c in Customer.query.all()],
+                [p.id for p in Product.query.all()])
+
+
+class Client:
+
+    def __init__(self, port, user_ids, customer_ids, product_ids, invoice_ids, rng):
+        self.conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        self.user_ids = user_ids
+        self.customer_ids = customer_ids
+        self.product_ids = product_ids
+        self.invoice_ids = invoice_ids
+        self.rng = rng
+
+    def request(self, method, path, body=None):
+        headers = {'Content-Type': 'application/json'} if body is not None else {}
+        payload = json.dumps(body) if body is not None else None
+        try:
+            self.conn.request(method, path, payload, headers)
+            response = self.conn.getresponse()
+        except (ConnectionError, http.client.HTTPException):
+            # the sync worker closed the connection; one retry on a new one
+            self.conn.close()
+            self.conn.request(method, path, payload, headers)
+            response = self.conn.getresponse()
+        data = response.read()
+        if response.getheader('Connection', '').lower() == 'close':
+            self.conn.close()
+        return response.status, data
+
+    def basket_size(self):
+        # most baskets are small, a few are big
+        return min(20, max(1, int(self.rng.expovariate(1 / 3)) + 1))
+
+    def run(self, operation):
+        rng = self.rng
+        if operation == 'login':
+            return self.request('POST', '/login', {
+                'user_name': f"cashier{rng.randrange(len(self.user_ids))}", 'password': PASSWORD})
+        if operation == 'product_list':
+            return self.request('GET', '/product/list')
+        if operation == 'product_get':
+            return self.request('GET', f"/product/list-by-id/{rng.choice(self.product_ids)}")
+        if operation == 'category_stats':
+            return self.request('GET', '/category/list?stats=1')
+        if operation == 'invoice_create':
+            items = [{'product_id': product_id, 'qty': rng.randint(1, 5)}
+                     for product_id in rng.sample(self.product_ids, self.basket_size())]
+            status, data = self.request('POST', '/invoice/create', {
+                'user_id': rng.choice(self.user_ids),
+                'customer_id': rng.choice(self.customer_ids) if rng.random() < 0.4 else None,
+                'paid': 0, 'items': items})
+            if status == 201:
+                self.invoice_ids.append(json.loads(data)['invoice_id'])
+            return status, data
+        if operation == 'invoice_get':
+            if not self.invoice_ids:
+                return self.run('invoice_create')
+            return self.request('GET', f"/invoice/{rng.choice(self.invoice_ids)}")
+        if operation == 'report_daily':
+            return self.request('GET', '/reports/sales/daily')
+        if operation == 'report_monthly':
+            return self.request('GET', '/reports/sales/monthly')
+        raise ValueError(operation)
+
+
+def drive(port, ids, concurrency, duration, warmup, seed_value):
+    """{operation: ([latency seconds...], errors)} for the measured window."""
+    user_ids, customer_ids, product_ids = ids
+    invoice_ids = []
+    operations = list(MIX)
+    weights = [MIX[name] for name in operations]
+    results = defaultdict(lambda: ([], []))
+    lock = threading.Lock()
+    start = time.perf_counter() + warmup
+    stop = start + duration
+
+    def worker(n):
+        rng = random.Random(seed_value * 1000 + n)
+        client = Client(port, user_ids, customer_ids, product_ids, invoice_ids, rng)
+        local = defaultdict(lambda: ([], []))
+        while True:
+            now = time.perf_counter()
+            if now >= stop:
+                break
+            operation = rng.choices(operations, weights)[0]
+            try:
+                status, _ = client.run(operation)
+            except OSError:
+                status = 'connection error'
+            took = time.perf_counter() - now
+            if now >= start:
+                latencies, errors = local[operation]
+                latencies.append(took)
+                if not isinstance(status, int) or status >= 400:
+                    errors.append(status)
+        with lock:
+            for operation, (latencies, errors) in local.items():
+                results[operation][0].extend(latencies)
+                results[operation][1].extend(errors)
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))]
+
+
+def summarize(results, duration):
+    summary = {}
+    everything = []
+    total_errors = 0
+    for operation in MIX:
+        latencies, errors = results.get(operation, ([], []))
+        everything.extend(latencies)
+        total_errors += len(errors)
+        summary[operation] = _stats(sorted(latencies), len(errors), duration)
+        if errors:
+            summary[operation]['statuses'] = {str(s): errors.count(s) for s in set(errors)}
+    summary['all'] = _stats(sorted(everything), total_errors, duration)
+    return summary
+
+
+def _stats(latencies, errors, duration):
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': round(len(latencies) / duration, 1),
+        'p50': round(percentile(latencies, 50) * 1000, 2),
+        'p95': round(percentile(latencies, 95) * 1000, 2),
+        'p99': round(percentile(latencies, 99) * 1000, 2),
+        'max': round((latencies[-1] if latencies else 0) * 1000, 2),
+    }
+
+
+def check(summary, limits, max_error_rate, min_rps, baseline, tolerance):
+    failures = []
+    for limit in limits:
+        name, value = limit.split('=')
+        operation, stat = name.rsplit('.', 1)
+        actual = summary.get(operation, {}).get(stat)
+        if actual is not None and actual > float(value):
+            failures.append(f"{operation} {stat} {actual} ms > {value} ms")
+    requests = summary['all']['requests']
+    if max_error_rate is not None and requests and summary['all']['errors'] / requests > max_error_rate:
+        failures.append(f"error rate {summary['all']['errors'] / requests:.3%} > {max_error_rate:.3%}")
+    if min_rps is not None and summary['all']['rps'] < min_rps:
+        failures.append(f"throughput {summary['all']['rps']} req/s < {min_rps}")
+    for operation, before in (baseline or {}).items():
+        after = summary.get(operation)
+        if after and after['requests'] and before['p95'] and after['p95'] > before['p95'] * (1 + tolerance):
+            failures.append(f"{operation} p95 {after['p95']} ms, was {before['p95']} ms "
+                            f"(+{after['p95'] / before['p95'] - 1:.0%})")
+    return failures
+
+
+def wait_until_up(port, server, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise SystemExit(f"gunicorn exited with {server.returncode}")
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=2)
+            conn.request('GET', '/category/list')
+            if conn.getresponse().status == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise SystemExit("gunicorn did not come up")
+
+
+def free_port():
+    import socket
+
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--duration', type=float, default=20, help='Measured seconds.')
+    parser.add_argument('--warmup', type=float, default=3, help='Unmeasured seconds first.')
+    parser.add_argument('--concurrency', type=int, default=8, help='Client threads.')
+    parser.add_argument('--workers', type=int, default=4, help='gunicorn workers.')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--customers', type=int, default=500)
+    parser.add_argument('--categories', type=int, default=20)
+    parser.add_argument('--products', type=int, default=500)
+    parser.add_argument('--limit', action='append', default=[], metavar='OPERATION.STAT=MS',
+                        help="e.g. invoice_create.p95=50 or all.p99=250; repeatable.")
+    parser.add_argument('--max-error-rate', type=float, default=None)
+    parser.add_argument('--min-rps', type=float, default=None)
+    parser.add_argument('--baseline', help='JSON from an earlier --save to compare p95 against.')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed p95 growth over --baseline.')
+    parser.add_argument('--save', help='Write the summary as JSON here.')
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp(prefix='loadtest-')
+    url = f"sqlite:///{os.path.join(tmp_dir, 'loadtest.db')}"
+    server = None
+    try:
+        ids = seed(url, args.users, args.customers, args.categories, args.products, args.seed)
+        port = free_port()
+        config = {'METRICS_DIR': os.path.join(tmp_dir, 'metrics'),
+                  'IMAGE_RAW_DIR': os.path.join(tmp_dir, 'uploads_pending')}
+        server = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', f"app:create_app({config!r})"],
+            cwd=ROOT, stdout=subprocess.DEVNULL, stderr=open(os.path.join(tmp_dir, 'gunicorn.log'), 'w'),
+            env=dict(os.environ, DATABASE_URL=url, BIND=f"127.0.0.1:{port}",
+                     WEB_CONCURRENCY=str(args.workers)))
+        wait_until_up(port, server)
+        results = drive(port, ids, args.concurrency, args.duration, args.warmup, args.seed)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(timeout=30)
+
+    summary = summarize(results, args.duration)
+    print(f"{args.concurrency} clients, {args.workers} workers, {args.duration:g}s measured")
+    print(f"{'operation':16}{'requests':>9}{'errors':>8}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}"
+          f"{'p99 ms':>9}{'max ms':>9}")
+    for operation, s in summary.items():
+        print(f"{operation:16}{s['requests']:>9}{s['errors']:>8}{s['rps']:>9}{s['p50']:>9}{s['p95']:>9}"
+              f"{s['p99']:>9}{s['max']:>9}")
+        if 'statuses' in s:
+            print(f"{'':16}errors: {s['statuses']}")
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(summary, f, indent=2)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    failures = check(summary, args.limit, args.max_error_rate, args.min_rps, baseline, args.tolerance)
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    if failures:
+        print('\nFAILED:\n  ' + '\n  '.join(failures), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
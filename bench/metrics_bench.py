@@ -0,0 +1,79 @@
+"""Per-request cost of the /metrics instrumentation (utils/metrics.py).
+
+Times the hooks alone (WSGI wrapper and after_request for one request) and
+a full test-client request with and without them (best of five alternating
+runs), plus one /metrics scrape.
+
+    python bench/metrics_bench.py [--requests 20000]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+
+def per_call_us(fn, n):
+    started = time.perf_counter()
+    for _ in range(n):
+        fn()
+    return (time.perf_counter() - started) / n * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=20000)
+    args = parser.parse_args()
+
+    from flask import Response, request
+
+    from app import create_app
+    from utils.metrics import metrics
+
+    app = create_app({'METRICS': True})
+    app.config['METRICS_DIR'] = metrics.directory = tempfile.mkdtemp(prefix='metrics-bench-')
+    # a view with no database work, so the hooks are what is being measured
+    app.add_url_rule('/_bench', '_bench', lambda: Response('ok'))
+    client = app.test_client()
+
+    with app.test_request_context('/_bench'):
+        response = Response('ok')
+        environ = request.environ
+        noop = metrics._wrap(lambda environ, start_response: [])
+
+        def one_request():
+            noop(environ, None).close()
+            metrics._finish(response)
+
+        hooks_us = per_call_us(one_request, args.requests)
+
+    wrapped = app.wsgi_app
+    runs = {'with': [], 'without': []}
+    # alternate so warm-up and drift hit both sides alike
+    for _ in range(5):
+        app.wsgi_app = wrapped
+        app.after_request_funcs[None].append(metrics._finish)
+        runs['with'].append(per_call_us(lambda: client.get('/_bench'), args.requests // 5))
+        app.wsgi_app = wrapped.__wrapped__
+        app.after_request_funcs[None].remove(metrics._finish)
+        runs['without'].append(per_call_us(lambda: client.get('/_bench'), args.requests // 5))
+    app.wsgi_app = wrapped
+    app.after_request_funcs[None].append(metrics._finish)
+    with_hooks = min(runs['with'])
+    without_hooks = min(runs['without'])
+
+    started = time.perf_counter()
+    body = metrics.render()
+    scrape_ms = (time.perf_counter() - started) * 1000
+
+    print(f"hooks alone          {hooks_us:8.2f} us/request")
+    print(f"request with hooks   {with_hooks:8.2f} us/request")
+    print(f"request without      {without_hooks:8.2f} us/request")
+    print(f"overhead             {with_hooks - without_hooks:8.2f} us/request")
+    print(f"/metrics render      {scrape_ms:8.2f} ms ({len(body.splitlines())} lines)")
+
+
+if __name__ == '__main__':
+    main()
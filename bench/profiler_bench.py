@@ -0,0 +1,58 @@
+"""Cost of the on-demand profiler (utils/profiler.py).
+
+Times the WSGI wrapper alone for a request that is not profiled, with
+sampling off, and the whole of a profiled test-client request against an
+unprofiled one.
+
+    PROFILER_SECRET=x python bench/profiler_bench.py [--requests 20000]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+
+def per_call_us(fn, n):
+    started = time.perf_counter()
+    for _ in range(n):
+        fn()
+    return (time.perf_counter() - started) / n * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=20000)
+    args = parser.parse_args()
+    os.environ.setdefault('PROFILER_SECRET', 'bench')
+
+    from flask import Response
+
+    from app import create_app
+    from utils.profiler import request_profiler, sign
+
+    app = create_app()
+
+    request_profiler.directory = tempfile.mkdtemp(prefix='profiler-bench-')
+    app.add_url_rule('/_bench', '_bench', lambda: Response('ok'))
+    client = app.test_client()
+
+    environ = {'PATH_INFO': '/_bench'}
+    noop = request_profiler._wrap(lambda environ, start_response: None)
+    wrapper_us = per_call_us(lambda: noop(environ, None), args.requests)
+
+    header = {'X-Profile': sign(request_profiler.secret, '/_bench', int(time.time()) + 3600)}
+    request_profiler.max_profiles = 10
+    n = max(1, args.requests // 100)
+    plain_us = min(per_call_us(lambda: client.get('/_bench'), n) for _ in range(3))
+    profiled_us = min(per_call_us(lambda: client.get('/_bench', headers=header), n) for _ in range(3))
+
+    print(f"wrapper, not profiled  {wrapper_us:8.2f} us/request")
+    print(f"request                {plain_us:8.2f} us/request")
+    print(f"request, profiled      {profiled_us:8.2f} us/request (profile stored)")
+
+
+if __name__ == '__main__':
+    main()
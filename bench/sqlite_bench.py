@@ -0,0 +1,111 @@
+"""Throughput of the SQLite profile (utils/sqlite_profile.py) against
+SQLite's defaults.
+
+Several processes, like gunicorn workers, run a mix of short write
+transactions (an invoice with its items) and indexed reads against one
+database file for a fixed time.  Reports operations per second and how many
+operations failed with "database is locked".
+
+    python bench/sqlite_bench.py [--workers 4] [--seconds 5] [--write-ratio 0.2]
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+SCHEMA = (
+    "CREATE TABLE sale (id INTEGER PRIMARY KEY, user_id INTEGER, total NUMERIC, date_time TEXT)",
+    "CREATE TABLE sale_item (id INTEGER PRIMARY KEY, sale_id INTEGER, product_id INTEGER, qty INTEGER)",
+    "CREATE INDEX ix_sale_item_sale_id ON sale_item (sale_id)",
+)
+
+
+def make_engine(path, profile):
+    from sqlalchemy import create_engine
+    from utils.sqlite_profile import DEFAULT_PRAGMAS, install
+
+    # 'default' is what app.py had before: the URI alone, pysqlite's 5s timeout
+    engine = create_engine(f"sqlite:///{path}")
+    if profile == 'tuned':
+        install(engine, DEFAULT_PRAGMAS)
+    return engine
+
+
+def run_worker(path, profile, seconds, write_ratio, seed, queue):
+    from sqlalchemy import text
+    from sqlalchemy.exc import OperationalError
+
+    rng = random.Random(seed)
+    engine = make_engine(path, profile)
+    ops = locked = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        try:
+            if rng.random() < write_ratio:
+                with engine.begin() as conn:
+                    sale_id = conn.execute(
+                        text("INSERT INTO sale (user_id, total, date_time) "
+                             "VALUES (:u, :t, datetime('now'))"),
+                        {'u': rng.randint(1, 20), 't': rng.randint(1, 500)}).lastrowid
+                    conn.execute(text("INSERT INTO sale_item (sale_id, product_id, qty) VALUES (:s, :p, :q)"),
+                                 [{'s': sale_id, 'p': rng.randint(1, 200), 'q': rng.randint(1, 5)}
+                                  for _ in range(3)])
+            else:
+                with engine.connect() as conn:
+                    conn.execute(text("SELECT s.id, s.total, count(i.id) FROM sale s "
+                                      "LEFT JOIN sale_item i ON i.sale_id = s.id "
+                                      "WHERE s.id > (SELECT max(id) - 50 FROM sale) GROUP BY s.id")).all()
+            ops += 1
+        except OperationalError as e:
+            if 'locked' not in str(e):
+                raise
+            locked += 1
+    engine.dispose()
+    queue.put((ops, locked))
+
+
+def run_case(profile, workers, seconds, write_ratio):
+    from sqlalchemy import text
+
+    path = os.path.join(tempfile.mkdtemp(prefix='sqlite-bench-'), 'bench.db')
+    engine = make_engine(path, profile)
+    with engine.begin() as conn:
+        for statement in SCHEMA:
+            conn.execute(text(statement))
+    engine.dispose()
+
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    procs = [ctx.Process(target=run_worker, args=(path, profile, seconds, write_ratio, i, queue))
+             for i in range(workers)]
+    for proc in procs:
+        proc.start()
+    results = [queue.get() for _ in procs]
+    for proc in procs:
+        proc.join()
+    ops = sum(r[0] for r in results)
+    locked = sum(r[1] for r in results)
+    return ops / seconds, locked
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--write-ratio', type=float, default=0.2)
+    args = parser.parse_args()
+
+    print(f"{args.workers} workers, {args.seconds:g}s, {args.write_ratio:.0%} writes")
+    print(f"{'profile':<10}{'ops/s':>10}{'locked':>10}")
+    for profile in ('default', 'tuned'):
+        rate, locked = run_case(profile, args.workers, args.seconds, args.write_ratio)
+        print(f"{profile:<10}{rate:>10.0f}{locked:>10}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""Worker boot time: importing app.py and building the app with create_app().
+
+Each run is a fresh interpreter, as a gunicorn worker without preload_app
+or a `flask` command would be.  Prints the median and best of the runs and
+whether heavy optional modules got imported; exits non-zero when the median
+boot exceeds --max-ms, for tracking regressions.
+
+    python bench/startup_bench.py [--runs 10] [--max-ms 1500]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+# modules only some requests (or only the CLI) need
+HEAVY = ('PIL', 'flask_migrate', 'alembic', 'mako')
+
+PROBE = f"""
+import json, sys, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.create_app()
+built = time.perf_counter()
+print(json.dumps({{
+    'import_ms': (imported - started) * 1000,
+    'create_ms': (built - imported) * 1000,
+    'modules': len(sys.modules),
+    'heavy': [name for name in {HEAVY!r} if name in sys.modules],
+}}))
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--max-ms', type=float, default=None, help='Fail when the median boot is slower.')
+    args = parser.parse_args()
+
+    results = []
+    for _ in range(args.runs):
+        out = subprocess.run([sys.executable, '-c', PROBE], cwd=ROOT, check=True,
+                             capture_output=True, text=True).stdout
+        results.append(json.loads(out.splitlines()[-1]))
+
+    boot = [r['import_ms'] + r['create_ms'] for r in results]
+    for label, key in (('import app', 'import_ms'), ('create_app()', 'create_ms')):
+        values = [r[key] for r in results]
+        print(f"{label:14} median {statistics.median(values):8.1f} ms   best {min(values):8.1f} ms")
+    print(f"{'boot':14} median {statistics.median(boot):8.1f} ms   best {min(boot):8.1f} ms")
+    print(f"modules loaded {results[-1]['modules']}, heavy: {', '.join(results[-1]['heavy']) or 'none'}")
+
+    if args.max_ms is not None and statistics.median(boot) > args.max_ms:
+        print(f"boot median above {args.max_ms} ms", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""Micro-benchmark for the watermark engine (utils/watermark.py).
+
+Compares the engine with the per-request implementation it replaced, for a
+few image sizes.  Each case runs in a fresh process so its peak RSS is not
+polluted by earlier cases.
+
+    python bench/watermark_bench.py [--runs 20] [--sizes 800x600,2048x1536]
+"""
+import argparse
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+TEXT = "Product Image"
+
+
+def legacy_watermark(img, watermark_text):
+    # the implementation previously copied into routes/product.py and routes/user.py
+    from PIL import Image, ImageDraw, ImageFont
+
+    img = img.convert("RGBA")
+    width, height = img.size
+    watermark = Image.new("RGBA", img.size, (0, 0, 0, 0))
+    draw = ImageDraw.Draw(watermark)
+    try:
+        font = ImageFont.truetype("arial.ttf", max(12, width // 20))
+    except Exception:
+        font = ImageFont.load_default()
+    bbox = draw.textbbox((0, 0), watermark_text, font=font)
+    x = width - (bbox[2] - bbox[0]) - 10
+    y = height - (bbox[3] - bbox[1]) - 10
+    draw.text((x, y), watermark_text, font=font, fill=(255, 255, 255, 120))
+    return Image.alpha_composite(img, watermark)
+
+
+def engine_watermark(img, watermark_text):
+    from utils.watermark import apply_watermark
+    return apply_watermark(img, watermark_text)
+
+
+IMPLEMENTATIONS = {
+    'legacy': legacy_watermark,
+    'engine': engine_watermark,
+}
+
+
+def _max_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_case(name, size, runs, queue):
+    from PIL import Image
+
+    fn = IMPLEMENTATIONS[name]
+    # warm up imports on a tiny image, a full-size run would already set
+    # the RSS high-water mark that is measured below
+    fn(Image.new("RGB", (64, 64)), TEXT)
+    source = Image.new("RGB", size, (90, 120, 200))
+    img = source.copy()
+    baseline = _max_rss_kb()
+    timings = []
+    for _ in range(runs):
+        img.paste(source)
+        start = time.perf_counter()
+        out = fn(img, TEXT)
+        if out.mode != "RGB":
+            out = out.convert("RGB")  # what gets encoded to JPEG
+        timings.append(time.perf_counter() - start)
+        del out
+    timings.sort()
+    queue.put({
+        'mean_ms': sum(timings) / len(timings) * 1000,
+        'p50_ms': timings[len(timings) // 2] * 1000,
+        'peak_extra_mb': (_max_rss_kb() - baseline) / 1024,
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--sizes', default='800x600,2048x1536,4000x3000')
+    args = parser.parse_args()
+
+    ctx = multiprocessing.get_context('spawn')
+    print(f"{'size':>10} {'impl':>7} {'mean ms':>9} {'p50 ms':>8} {'peak +MB':>9}")
+    for spec in args.sizes.split(','):
+        size = tuple(int(v) for v in spec.split('x'))
+        for name in IMPLEMENTATIONS:
+            queue = ctx.Queue()
+            proc = ctx.Process(target=run_case, args=(name, size, args.runs, queue))
+            proc.start()
+            result = queue.get()
+            proc.join()
+            print(f"{spec:>10} {name:>7} {result['mean_ms']:9.2f} "
+                  f"{result['p50_ms']:8.2f} {result['peak_extra_mb']:9.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,38 @@
+"""Flask extensions, created unbound and attached by create_app() in app.py.
+
+Models, routes and utils import `db` and `jwt` from here, so none of them
+needs the app module (or an app) to be imported.
+"""
+import click
+from flask_jwt_extended import JWTManager
+from flask_sqlalchemy import SQLAlchemy
+
+from utils.read_routing import RoutingSession
+
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+jwt = JWTManager()
+
+
+class _MigrateGroup(click.Group):
+    """`flask db`, which imports Flask-Migrate (and Alembic, Mako...) the
+    first time one of its commands is looked up instead of at startup."""
+
+    def __init__(self, app):
+        super().__init__('db', help='Perform database migrations.')
+        self.app = app
+
+    def _group(self):
+        if 'migrate' not in self.app.extensions:
+            from flask_migrate import Migrate
+
+            Migrate(self.app, db)
+        from flask_migrate.cli import db as db_cli
+        return db_cli
+
+    def make_context(self, info_name, args, parent=None, **extra):
+        # click runs the command of the returned context, the real group
+        return self._group().make_context(info_name, args, parent=parent, **extra)
+
+
+def init_migrate(app):
+    app.cli.add_command(_MigrateGroup(app))
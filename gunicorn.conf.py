@@ -0,0 +1,30 @@
+"""gunicorn settings: gunicorn -c gunicorn.conf.py
+
+Values can be overridden with GUNICORN_CMD_ARGS or the environment below.
+With preload_app (the default) the master builds the app once and the
+workers fork from it, so each worker starts in milliseconds and shares the
+imported code with its siblings; PRELOAD_APP=0 builds it in every worker.
+"""
+import multiprocessing
+import os
+
+wsgi_app = 'app:create_app()'
+bind = os.environ.get('BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+preload_app = os.environ.get('PRELOAD_APP', '1').lower() in ('1', 'true', 'yes')
+
+
+def post_fork(server, worker):
+    # a pool inherited from the master would share its sockets with every
+    # worker; start each worker with an empty pool (close=False leaves the
+    # parent's connections alone).  Threads and process pools are started
+    # lazily by each worker, see utils/background.py and utils/image_jobs.py.
+    flask_app = worker.app.callable  # only loaded in the master with preload_app
+    if flask_app is None:
+        return
+    from extensions import db
+
+    with flask_app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
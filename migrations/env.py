@@ -103,9 +103,26 @@ def run_migrations_online():
             **conf_args
         )
 
+        sqlite = connection.dialect.name == 'sqlite'
+        heads = context.get_context().get_current_heads()
+        if sqlite:
+            # batch migrations rebuild tables by copy, drop and rename, which
+            # fails (or cascades) while foreign keys are enforced
+            connection.exec_driver_sql('PRAGMA foreign_keys=OFF')
+        # end the implicit transaction so the migrations commit their own
+        connection.commit()
+
         with context.begin_transaction():
             context.run_migrations()
 
+        if sqlite:
+            if context.get_context().get_current_heads() != heads:
+                # rows the rebuilt tables carried over without enforcement
+                for table, rowid, parent, _ in connection.exec_driver_sql('PRAGMA foreign_key_check'):
+                    logger.warning('%s row %s references a missing %s', table, rowid, parent)
+            connection.exec_driver_sql('PRAGMA foreign_keys=ON')
+            connection.commit()
+
 
 if context.is_offline_mode():
     run_migrations_offline()
@@ -0,0 +1,32 @@
+"""image job token
+
+Revision ID: b7e2d4f9a013
+Revises: f3a8c61d0e95
+Create Date: 2026-10-19 19:12:37.804415
+
+The token of the image job a pending row waits for, see
+utils/image_jobs.mark_pending.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7e2d4f9a013'
+down_revision = 'f3a8c61d0e95'
+branch_labels = None
+depends_on = None
+
+TABLES = ('category', 'product', 'user')
+
+
+def upgrade():
+    for table in TABLES:
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            batch_op.add_column(sa.Column('image_job', sa.String(length=32), nullable=True))
+
+
+def downgrade():
+    for table in TABLES:
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            batch_op.drop_column('image_job')
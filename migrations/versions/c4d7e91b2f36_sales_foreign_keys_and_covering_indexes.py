@@ -0,0 +1,119 @@
+"""sales foreign keys and covering indexes
+
+Revision ID: c4d7e91b2f36
+Revises: 8b6e4f1a9c27
+Create Date: 2026-10-19 15:12:08.417302
+
+Adds the foreign keys product -> category, sale -> user/customer and
+sale_item -> sale/product, and replaces the single column indexes on
+sale_item.sale_id, sale.date_time and product.category_id with covering
+ones that start with the same column.
+
+SQLite cannot add a constraint in place, so each table is rebuilt exactly
+once (batch mode, with foreign key enforcement switched off in env.py) and
+the new indexes are built afterwards, so the copy does not maintain them.
+PostgreSQL adds the keys NOT VALID and validates them separately, and
+builds/drops the indexes CONCURRENTLY, so writers are never blocked for
+the length of a table scan.
+"""
+import logging
+
+from alembic import op
+import sqlalchemy as sa
+
+logger = logging.getLogger('alembic.env')
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4d7e91b2f36'
+down_revision = '8b6e4f1a9c27'
+branch_labels = None
+depends_on = None
+
+
+# (table, name, column, referenced table)
+FOREIGN_KEYS = (
+    ('product', 'fk_product_category_id_category', 'category_id', 'category'),
+    ('sale', 'fk_sale_user_id_user', 'user_id', 'user'),
+    ('sale', 'fk_sale_customer_id_customer', 'customer_id', 'customer'),
+    ('sale_item', 'fk_sale_item_sale_id_sale', 'sale_id', 'sale'),
+    ('sale_item', 'fk_sale_item_product_id_product', 'product_id', 'product'),
+)
+
+# (table, new covering index, its columns, single column index it replaces, that column)
+INDEXES = (
+    ('sale_item', 'ix_sale_item_sale_id_product_id_qty_total', ['sale_id', 'product_id', 'qty', 'total'],
+     'ix_sale_item_sale_id', 'sale_id'),
+    ('sale', 'ix_sale_date_time_total', ['date_time', 'total'], 'ix_sale_date_time', 'date_time'),
+    ('product', 'ix_product_category_id_name', ['category_id', 'name'], 'ix_product_category_id', 'category_id'),
+)
+
+
+def upgrade():
+    context = op.get_context()
+    dialect = context.dialect.name
+
+    # the only nullable reference: an invoice of a deleted customer keeps its data
+    op.execute("UPDATE sale SET customer_id = NULL WHERE customer_id IS NOT NULL "
+               "AND customer_id NOT IN (SELECT id FROM customer)")
+
+    if dialect == 'sqlite':
+        for table in ('product', 'sale', 'sale_item'):
+            with op.batch_alter_table(table, schema=None) as batch_op:
+                for fk_table, name, column, referent in FOREIGN_KEYS:
+                    if fk_table == table:
+                        batch_op.create_foreign_key(name, referent, [column], ['id'])
+                for ix_table, _, _, old_index, _ in INDEXES:
+                    if ix_table == table:
+                        batch_op.drop_index(old_index)
+        for table, index, columns, _, _ in INDEXES:
+            op.create_index(index, table, columns, unique=False)
+        return
+
+    if dialect == 'postgresql':
+        for table, name, column, referent in FOREIGN_KEYS:
+            op.create_foreign_key(name, table, referent, [column], ['id'], postgresql_not_valid=True)
+        with context.autocommit_block():
+            for table, name, column, referent in FOREIGN_KEYS:
+                # offline (--sql) mode cannot look at the data
+                orphans = 0 if context.as_sql else op.get_bind().execute(sa.text(
+                    f'SELECT count(*) FROM "{table}" t WHERE t.{column} IS NOT NULL '
+                    f'AND NOT EXISTS (SELECT 1 FROM "{referent}" r WHERE r.id = t.{column})')).scalar()
+                if orphans:
+                    # still enforced for new rows; validate once the old rows are fixed
+                    logger.warning("%s: %s rows without a %s, left NOT VALID", name, orphans, referent)
+                    continue
+                op.execute(f'ALTER TABLE "{table}" VALIDATE CONSTRAINT {name}')
+            for table, index, columns, old_index, _ in INDEXES:
+                op.create_index(index, table, columns, unique=False, postgresql_concurrently=True)
+                op.drop_index(old_index, table_name=table, postgresql_concurrently=True)
+        return
+
+    for table, name, column, referent in FOREIGN_KEYS:
+        op.create_foreign_key(name, table, referent, [column], ['id'])
+    for table, index, columns, old_index, _ in INDEXES:
+        op.create_index(index, table, columns, unique=False)
+        op.drop_index(old_index, table_name=table)
+
+
+def downgrade():
+    dialect = op.get_context().dialect.name
+
+    if dialect == 'sqlite':
+        for table, index, _, _, _ in INDEXES:
+            op.drop_index(index, table_name=table)
+        for table in ('sale_item', 'sale', 'product'):
+            with op.batch_alter_table(table, schema=None) as batch_op:
+                for fk_table, name, _, _ in FOREIGN_KEYS:
+                    if fk_table == table:
+                        batch_op.drop_constraint(name, type_='foreignkey')
+                for ix_table, _, _, old_index, column in INDEXES:
+                    if ix_table == table:
+                        batch_op.create_index(old_index, [column], unique=False)
+        return
+
+    for table, index, _, old_index, column in INDEXES:
+        op.create_index(old_index, table, [column], unique=False)
+        op.drop_index(index, table_name=table)
+    for table, name, _, _ in FOREIGN_KEYS:
+        op.drop_constraint(name, table, type_='foreignkey')
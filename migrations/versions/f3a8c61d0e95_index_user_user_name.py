@@ -0,0 +1,31 @@
+"""index user.user_name
+
+Revision ID: f3a8c61d0e95
+Revises: c4d7e91b2f36
+Create Date: 2026-10-19 18:03:41.552917
+
+Login looks users up by name, which read the whole user table.  The index
+is built CONCURRENTLY on PostgreSQL so logins are not blocked meanwhile.
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'f3a8c61d0e95'
+down_revision = 'c4d7e91b2f36'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    context = op.get_context()
+    if context.dialect.name == 'postgresql':
+        with context.autocommit_block():
+            op.create_index('ix_user_user_name', 'user', ['user_name'], unique=False,
+                            postgresql_concurrently=True)
+        return
+    op.create_index('ix_user_user_name', 'user', ['user_name'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_user_user_name', table_name='user')
@@ -5,3 +5,6 @@ from model.product import *
 from model.customer import *
 from model.sale import *
 from model.sale_item import *
+from model.upload_blob import *
+from model.revoked_token import *
+from model.login_failure import *
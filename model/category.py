@@ -1,7 +1,9 @@
-from app import db
+from extensions import db
 
 
 class Category(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(128), nullable=False, unique=True, index=True)
     image = db.Column(db.String(255))
+    image_status = db.Column(db.String(16))
+    image_job = db.Column(db.String(32))  # see utils/image_jobs.mark_pending
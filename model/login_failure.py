@@ -0,0 +1,9 @@
+from extensions import db
+
+
+class LoginFailure(db.Model):
+    # 'user:<user name>' or 'ip:<client address>', see utils/passwords.LoginThrottle
+    key = db.Column(db.String(160), primary_key=True)
+    count = db.Column(db.Integer, nullable=False)
+    # end of the fixed window `count` belongs to
+    window_end = db.Column(db.DateTime, nullable=False, index=True)
@@ -1,10 +1,18 @@
-from app import db
+from extensions import db
 
 
 class Product(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(255), nullable=False, index=True)
-    category_id = db.Column(db.Integer, nullable=False, index=True)
+    category_id = db.Column(db.Integer, db.ForeignKey('category.id', name='fk_product_category_id_category'),
+                            nullable=False)
     cost = db.Column(db.Numeric(10, 2), nullable=False)
     price = db.Column(db.Numeric(10, 2), nullable=False)
     image = db.Column(db.String(255))
+    image_status = db.Column(db.String(16))
+    image_job = db.Column(db.String(32))  # see utils/image_jobs.mark_pending
+
+    __table_args__ = (
+        # products of a category by name, answered from the index alone
+        db.Index('ix_product_category_id_name', 'category_id', 'name'),
+    )
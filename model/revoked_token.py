@@ -0,0 +1,9 @@
+from extensions import db
+from datetime import datetime
+
+
+class RevokedToken(db.Model):
+    jti = db.Column(db.String(64), primary_key=True)
+    # the token's own exp, the row is useless afterwards; NULL for tokens without exp
+    expires_at = db.Column(db.DateTime, index=True)
+    revoked_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
@@ -1,13 +1,20 @@
-from app import db
+from extensions import db
 from datetime import datetime
 
 
 class Sale(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    date_time = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
-    user_id = db.Column(db.Integer, nullable=False, index=True)
-    customer_id = db.Column(db.Integer, index=True)
+    date_time = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', name='fk_sale_user_id_user'),
+                        nullable=False, index=True)
+    customer_id = db.Column(db.Integer, db.ForeignKey('customer.id', name='fk_sale_customer_id_customer'),
+                            index=True)
     total = db.Column(db.Numeric(12, 2), nullable=False)
     paid = db.Column(db.Numeric(12, 2), nullable=False)
     remark = db.Column(db.String(255))
 
+    __table_args__ = (
+        # the period reports read only these two columns
+        db.Index('ix_sale_date_time_total', 'date_time', 'total'),
+    )
+
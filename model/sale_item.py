@@ -1,12 +1,20 @@
-from app import db
+from extensions import db
 from datetime import datetime
 
 
 class SaleItem(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    sale_id = db.Column(db.Integer, nullable=False, index=True)
-    product_id = db.Column(db.Integer, nullable=False, index=True)
+    sale_id = db.Column(db.Integer, db.ForeignKey('sale.id', name='fk_sale_item_sale_id_sale'),
+                        nullable=False)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id', name='fk_sale_item_product_id_product'),
+                           nullable=False, index=True)
     qty = db.Column(db.Integer, nullable=False)
     cost = db.Column(db.Numeric(10, 2), nullable=False)
     price = db.Column(db.Numeric(10, 2), nullable=False)
     total = db.Column(db.Numeric(12, 2), nullable=False)
+
+    __table_args__ = (
+        # invoice items and per-product sums without touching the table
+        db.Index('ix_sale_item_sale_id_product_id_qty_total', 'sale_id', 'product_id', 'qty', 'total'),
+    )
+
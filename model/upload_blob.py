@@ -0,0 +1,11 @@
+from extensions import db
+from datetime import datetime
+
+
+class UploadBlob(db.Model):
+    hash = db.Column(db.String(64), primary_key=True)
+    source_hash = db.Column(db.String(64), nullable=False, index=True)
+    path = db.Column(db.String(255), nullable=False)
+    size = db.Column(db.Integer, nullable=False)
+    ref_count = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
@@ -1,8 +1,10 @@
-from app import db
+from extensions import db
 
 
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_name = db.Column(db.String(128), nullable=False)
+    user_name = db.Column(db.String(128), nullable=False, index=True)
     password = db.Column(db.String(255), nullable=False)
     profile = db.Column(db.String(255))
+    image_status = db.Column(db.String(16))
+    image_job = db.Column(db.String(32))  # see utils/image_jobs.mark_pending
@@ -1,10 +1,15 @@
+def register_blueprints(app):
+    from routes.auth import auth_bp
+    from routes.category import category_bp
+    from routes.dashboard import dashboard_bp
+    from routes.error import error_bp
+    from routes.invoices import invoices_bp
+    from routes.product import product_bp
+    from routes.reports import reports_bp
+    # from routes.sales import sales_bp
+    from routes.uploads import uploads_bp
+    from routes.user import user_bp
 
-from routes.dashboard import *
-from routes.error import *
-from routes.user import *
-from routes.reports import reports_bp
-from routes.category import *
-from routes.product import *
-# from routes.sales import *
-from routes.invoices import *
-import routes.auth as auth
\ No newline at end of file
+    for blueprint in (dashboard_bp, error_bp, user_bp, reports_bp, category_bp, product_bp,
+                      invoices_bp, uploads_bp, auth_bp):
+        app.register_blueprint(blueprint)
@@ -0,0 +1,114 @@
+"""Async twins of the read-heavy Flask views, for the ASGI serving mode.
+
+Each view runs the same query as the Flask view it is named after, on an
+AsyncSession, and answers with byte-identical JSON; see utils/asgi.py.
+Writes, auth and everything else stay on the Flask views only.
+"""
+from sqlalchemy import func, select
+
+from model.category import Category
+from model.customer import Customer
+from model.product import Product
+from model.sale import Sale
+from model.sale_item import SaleItem
+from model.user import User
+from routes.category import category_rows, category_stats_query
+from routes.reports import period_rows, sales_by_period_query
+from routes.user import MAX_USER_PAGE_SIZE, USER_COLUMNS, USER_PAGE_SIZE
+from utils.asgi import AsyncRoutes, stream_json_rows
+from utils.cache import catalog_cache
+from utils.serialize import dumps, invoice_to_dict, product_to_dict, sale_to_dict, user_to_dict
+
+async_routes = AsyncRoutes()
+
+
+async def _cached_json(key, build):
+    """utils.serialize.cached_json for an async `build`."""
+    body = catalog_cache.get(key)
+    if body is None:
+        body = catalog_cache.set(key, dumps(await build()))
+    return body
+
+
+@async_routes.get('/invoice/list', read_only=True)
+async def list_invoices(session, request):
+    result = await session.stream_scalars(
+        select(Sale).order_by(Sale.date_time.desc()).execution_options(yield_per=500))
+    return stream_json_rows(result, sale_to_dict)
+
+
+@async_routes.get('/invoice/<int:invoice_id>')
+async def get_invoice_details(session, request, invoice_id):
+    sale = await session.get(Sale, invoice_id)
+    if not sale:
+        return {'error': 'Invoice not found'}, 404
+    items = (await session.scalars(select(SaleItem).filter_by(sale_id=invoice_id))).all()
+    customer = None
+    if sale.customer_id:
+        customer = await session.get(Customer, sale.customer_id)
+    return invoice_to_dict(sale, customer, items), 200
+
+
+@async_routes.get('/reports/sales/by', read_only=True)
+async def sales_by_criteria(session, request):
+    query = select(Sale)
+    user_id = request.args.get('user_id')
+    if user_id:
+        query = query.filter(Sale.user_id == user_id)
+    result = await session.stream_scalars(query.execution_options(yield_per=500))
+    return stream_json_rows(result, sale_to_dict)
+
+
+async def _sales_by_period(session, period, key):
+    result = await session.execute(sales_by_period_query(period, session.bind.dialect.name))
+    return period_rows(result.all(), key)
+
+
+@async_routes.get('/reports/sales/daily', read_only=True)
+async def daily_sales_report(session, request):
+    return await _sales_by_period(session, 'day', 'date')
+
+
+@async_routes.get('/reports/sales/weekly', read_only=True)
+async def weekly_sales_report(session, request):
+    return await _sales_by_period(session, 'week', 'week')
+
+
+@async_routes.get('/reports/sales/monthly', read_only=True)
+async def monthly_sales_report(session, request):
+    return await _sales_by_period(session, 'month', 'month')
+
+
+@async_routes.get('/user/list', read_only=True)
+async def user(session, request):
+    page = request.args.get('page', 1, type=int)
+    per_page = request.args.get('per_page', USER_PAGE_SIZE, type=int)
+    if page < 1 or per_page < 1:
+        return {"error": "page and per_page must be positive"}, 400
+    per_page = min(per_page, MAX_USER_PAGE_SIZE)
+    total = (await session.execute(select(func.count(User.id)))).scalar()
+    result = await session.execute(
+        select(*USER_COLUMNS).order_by(User.id).limit(per_page).offset((page - 1) * per_page))
+    rows = [user_to_dict(row) for row in result]
+    return rows, 200, {"X-Total-Count": str(total)}
+
+
+@async_routes.get('/product/list')
+async def list_products(session, request):
+    async def build():
+        # image_variants stats each image path only once per process
+        return [product_to_dict(p) for p in (await session.scalars(select(Product))).all()]
+
+    return await _cached_json('product:list', build)
+
+
+@async_routes.get('/category/list')
+async def list_categories(session, request):
+    with_stats = request.args.get('stats', '').lower() in ('1', 'true', 'yes')
+
+    async def build():
+        categories = (await session.scalars(select(Category).order_by(Category.id))).all()
+        stats_rows = (await session.execute(category_stats_query())).all() if with_stats else None
+        return category_rows(categories, stats_rows)
+
+    return await _cached_json('category:list:stats' if with_stats else 'category:list', build)
@@ -1,13 +1,17 @@
-from app import app, db, jsonify, jwt
-from sqlalchemy import text
-from flask import request
-from werkzeug.security import check_password_hash
+from flask import Blueprint, jsonify, request
+from extensions import db, jwt
+from sqlalchemy import select, update
 from flask_jwt_extended import (
     create_access_token, jwt_required, get_jwt_identity, get_jwt
 )
+from utils.passwords import password_hasher, login_throttle, VerifierBusy
+from utils.revocation import revocation_store
+from model.user import User
 
+auth_bp = Blueprint('auth', __name__)
 
-@app.post('/login')
+
+@auth_bp.post('/login')
 def login():
     form = request.get_json()
     if not form:
@@ -20,14 +24,37 @@ def login():
     user_name = form.get('user_name')
     password = form.get('password')
 
-    sql = text("""SELECT * FROM user WHERE user_name = :user_name""")
-    result = db.session.execute(sql, {'user_name': user_name}).fetchone()
+    # refuse brute force attempts before spending any time on hashing
+    retry_after = login_throttle.retry_after(user_name, request.remote_addr)
+    if retry_after:
+        return {"error": "Too many failed login attempts, try again later"}, 429, \
+            {"Retry-After": str(retry_after)}
+
+    # built with the ORM so "user" is quoted on backends where it is a keyword
+    sql = select(User.id, User.user_name, User.password, User.profile).where(User.user_name == user_name)
+    result = db.session.execute(sql).first()
     if not result:
+        login_throttle.failed(user_name, request.remote_addr)
         return {"error": "Invalid username or password"}, 401
 
     user = dict(result._mapping)
-    if not check_password_hash(user['password'], password):
+    try:
+        valid = password_hasher.verify(user['password'], password)
+    except VerifierBusy:
+        return {"error": "Server busy, try again shortly"}, 503, {"Retry-After": "1"}
+    if not valid:
+        login_throttle.failed(user_name, request.remote_addr)
         return {"error": "Invalid username or password"}, 401
+    login_throttle.succeeded(user_name)
+
+    # move the stored hash to the current PASSWORD_HASH_METHOD while we have the password
+    if password_hasher.needs_rehash(user['password']):
+        try:
+            db.session.execute(update(User).where(User.id == user['id'])
+                               .values(password=password_hasher.hash(password)))
+            db.session.commit()
+        except VerifierBusy:
+            pass
 
     additional_claims = {
         "user_name": user['user_name'],
@@ -43,7 +70,7 @@ def login():
            }, 200
 
 
-@app.get("/me")
+@auth_bp.get("/me")
 @jwt_required()
 def me():
     user = get_jwt_identity()
@@ -53,7 +80,7 @@ def me():
     )
 
 
-@app.post('/protected')
+@auth_bp.post('/protected')
 @jwt_required()
 def get_protected():
     return {
@@ -61,17 +88,14 @@ def get_protected():
            }, 200
 
 
-REVOKED_JTIS = set()
-
-
 @jwt.token_in_blocklist_loader
 def check_if_token_revoked(jwt_header, jwt_data):
-    return jwt_data["jti"] in REVOKED_JTIS
+    return revocation_store.is_revoked(jwt_data["jti"])
 
 
-@app.post("/logout")
+@auth_bp.post("/logout")
 @jwt_required()  # revoke current access token
 def logout():
-    jti = get_jwt()["jti"]
-    REVOKED_JTIS.add(jti)
+    token = get_jwt()
+    revocation_store.revoke(token["jti"], token.get("exp"))
     return jsonify(msg="Access token revoked")
\ No newline at end of file
@@ -1,71 +1,73 @@
-from app import app, db
-from flask import request
-from werkzeug.utils import secure_filename
-from uuid import uuid4
-import os
+from flask import Blueprint, request
+from extensions import db
+from sqlalchemy import func, select
+from sqlalchemy.exc import IntegrityError
 from model.category import Category
-
-# constants
-UPLOAD_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'static', 'uploads', 'categories'))
-MAX_IMAGE_SIZE = 2 * 1024 * 1024
-os.makedirs(UPLOAD_DIR, exist_ok=True)
-
-
-def _validate_image(file_storage):
-    if not file_storage:
-        return False, "No file uploaded"
-    mimetype = getattr(file_storage, "mimetype", "")
-    if not mimetype.startswith("image/"):
-        return False, "File is not an image"
-    data = file_storage.read()
-    size = len(data)
-    # reset file pointer for potential further use
-    try:
-        file_storage.stream.seek(0)
-    except Exception:
-        pass
-    if size > MAX_IMAGE_SIZE:
-        return False, "Image exceeds 2MB"
-    if size == 0:
-        return False, "Empty image"
-    return True, data
-
-
-def _save_image_bytes(image_bytes, filename):
-    out_path = os.path.join(UPLOAD_DIR, filename)
-    with open(out_path, 'wb') as f:
-        f.write(image_bytes)
-    return out_path
-
-
-def _remove_file_if_exists(storage_path: str):
-    try:
-        if not storage_path:
-            return
-        abs_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', storage_path))
-        if os.path.exists(abs_path):
-            os.remove(abs_path)
-    except Exception:
-        pass
+from model.product import Product
+from utils.cache import catalog_cache
+from utils.image_jobs import image_jobs, mark_pending, release_upload
+from utils.serialize import category_to_dict, cached_json, format_decimal
+from utils.uploads import accept_upload
+
+category_bp = Blueprint('category', __name__)
+
+
+def category_stats_query():
+    """Product count and price range per category, computed in one GROUP BY."""
+    return select(
+        Product.category_id,
+        func.count(Product.id),
+        func.min(Product.price),
+        func.max(Product.price)
+    ).group_by(Product.category_id)
+
+
+def category_rows(categories, stats_rows=None):
+    """category_to_dict rows, with the category_stats_query() columns added when given."""
+    rows = [category_to_dict(c) for c in categories]
+    if stats_rows is not None:
+        stats = {category_id: (count, min_price, max_price)
+                 for category_id, count, min_price, max_price in stats_rows}
+        for row in rows:
+            count, min_price, max_price = stats.get(row["id"], (0, None, None))
+            row["product_count"] = count
+            row["min_price"] = format_decimal(min_price)
+            row["max_price"] = format_decimal(max_price)
+    return rows
+
+
+def _build_category_list(with_stats=False):
+    categories = Category.query.order_by(Category.id).all()
+    stats_rows = db.session.execute(category_stats_query()).all() if with_stats else None
+    return category_rows(categories, stats_rows)
 
 
-@app.get('/category/list')
+@category_bp.get('/category/list')
 def list_categories():
-    categories = Category.query.order_by(Category.id).all()
-    rows = [{
-        "id": c.id,
-        "name": c.name,
-        "image": c.image
-    } for c in categories]
-    return rows, 200
+    # ?stats=1 adds product_count, min_price and max_price to each category
+    with_stats = request.args.get('stats', '').lower() in ('1', 'true', 'yes')
+    key = 'category:list:stats' if with_stats else 'category:list'
+    return cached_json(key, lambda: _build_category_list(with_stats))
 
 
-@app.get('/category/<int:category_id>')
+@category_bp.get('/category/<int:category_id>')
 def category_by_id(category_id: int):
     return get_category_by_id(category_id)
 
 
-@app.post('/category/create')
+@category_bp.get('/category/<int:category_id>/image-status')
+def category_image_status(category_id: int):
+    category = Category.query.get(category_id)
+    if not category:
+        return {"error": "Category not found"}, 404
+    return {
+        "id": category.id,
+        "image": category.image,
+        "image_status": category.image_status
+    }, 200
+
+
+@category_bp.post('/category/create')
 def create_category():
     # accept form-data or json
     form = request.form or {}
@@ -78,35 +80,34 @@ def create_category():
     if Category.query.filter_by(name=name).first():
         return {"error": "Category with this name already exists"}, 400
 
-    image_path = None
+    raw_path = None
     image_file = request.files.get('image')
     if image_file:
-        ok, data_or_err = _validate_image(image_file)
-        if not ok:
-            return {"error": data_or_err}, 400
-        image_bytes = data_or_err
-        orig = getattr(image_file, 'filename', '')
-        _, ext = os.path.splitext(orig)
-        if not ext:
-            ext = '.jpg'
-        filename = f"{uuid4().hex}.{secure_filename(ext.lstrip('.'))}"
-        _save_image_bytes(image_bytes, filename)
-        image_path = os.path.join('static', 'uploads', 'categories', filename).replace('\\', '/')
-
-    category = Category(name=name, image=image_path)
+        raw_path, error = accept_upload(image_file)
+        if error:
+            return error
+
+    category = Category(name=name)
+    job_token = mark_pending(category) if raw_path else None
     db.session.add(category)
-    db.session.commit()
+    try:
+        db.session.commit()
+    except Exception:
+        if raw_path:
+            image_jobs.discard(raw_path)
+        raise
+    catalog_cache.clear()
+    if raw_path:
+        # resized in the background, see /category/<id>/image-status
+        image_jobs.submit(Category, category.id, 'image', raw_path, None, job_token,
+                          on_ready=catalog_cache.clear)
     return {
         "message": "Category created",
-        "category": {
-            "id": category.id,
-            "name": category.name,
-            "image": category.image
-        }
+        "category": category_to_dict(category)
     }, 200
 
 
-@app.post('/category/update')
+@category_bp.post('/category/update')
 def update_category():
     form = request.form or {}
     json = request.get_json(silent=True) or {}
@@ -125,35 +126,32 @@ def update_category():
             return {"error": "Another category with this name already exists"}, 400
         category.name = name
 
+    raw_path = job_token = None
     image_file = request.files.get('image')
     if image_file:
-        ok, data_or_err = _validate_image(image_file)
-        if not ok:
-            return {"error": data_or_err}, 400
-        image_bytes = data_or_err
-        # remove old file
-        if category.image:
-            _remove_file_if_exists(category.image)
-        orig = getattr(image_file, 'filename', '')
-        _, ext = os.path.splitext(orig)
-        if not ext:
-            ext = '.jpg'
-        filename = f"{uuid4().hex}.{secure_filename(ext.lstrip('.'))}"
-        _save_image_bytes(image_bytes, filename)
-        category.image = os.path.join('static', 'uploads', 'categories', filename).replace('\\', '/')
-
-    db.session.commit()
+        raw_path, error = accept_upload(image_file)
+        if error:
+            return error
+        # the old image stays in place until the new one is ready
+        job_token = mark_pending(category)
+
+    try:
+        db.session.commit()
+    except Exception:
+        if raw_path:
+            image_jobs.discard(raw_path)
+        raise
+    catalog_cache.clear()
+    if raw_path:
+        image_jobs.submit(Category, category.id, 'image', raw_path, None, job_token,
+                          on_ready=catalog_cache.clear)
     return {
         "message": "Category updated",
-        "category": {
-            "id": category.id,
-            "name": category.name,
-            "image": category.image
-        }
+        "category": category_to_dict(category)
     }, 200
 
 
-@app.post('/category/delete')
+@category_bp.post('/category/delete')
 def delete_category():
     form = request.form or {}
     json = request.get_json(silent=True) or {}
@@ -165,21 +163,20 @@ def delete_category():
     if not category:
         return {"error": "Category not found"}, 404
 
-    # remove image file if present
-    if category.image:
-        _remove_file_if_exists(category.image)
-
     db.session.delete(category)
-    db.session.commit()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return {"error": "Category still has products"}, 400
+    catalog_cache.clear()
+    # drop the image once the row is gone
+    release_upload(category.image)
     return {"message": "Category deleted"}, 200
 
 
 def get_category_by_id(category_id: int):
     category = Category.query.get(category_id)
     if category:
-        return {
-            "id": category.id,
-            "name": category.name,
-            "image": category.image
-        }, 200
+        return category_to_dict(category), 200
     return {"error": "Category not found"}, 404
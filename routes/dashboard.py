@@ -1,7 +1,9 @@
-from app import app
+from flask import Blueprint
 
+dashboard_bp = Blueprint('dashboard', __name__)
 
-@app.route('/dashboard')
+
+@dashboard_bp.route('/dashboard')
 def dashboard():
     arr = [1, 2]
     print(arr[2])
@@ -1,7 +1,9 @@
-from app import app, jsonify
+from flask import Blueprint, jsonify
 
+error_bp = Blueprint('error', __name__)
 
-@app.errorhandler(404)
+
+@error_bp.app_errorhandler(404)
 def error_404(e):
     return jsonify({
         "status": 404,
@@ -9,7 +11,15 @@ def error_404(e):
     }), 404
 
 
-@app.errorhandler(500)
+@error_bp.app_errorhandler(413)
+def error_413(e):
+    return jsonify({
+        "status": 413,
+        "message": "request too large"
+    }), 413
+
+
+@error_bp.app_errorhandler(500)
 def error_500(e):
     return jsonify({
         "status": 500,
@@ -17,7 +27,7 @@ def error_500(e):
     }), 500
 
 
-# @app.errorhandler(Exception)
+# @error_bp.app_errorhandler(Exception)
 # def error_exception(e):
 #     return jsonify({
 #         "status": 500,
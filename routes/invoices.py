@@ -1,18 +1,17 @@
-from app import app, db
-from flask import request, jsonify
+from flask import Blueprint, request
+from extensions import db
 from model.sale import Sale
 from model.sale_item import SaleItem
 from model.product import Product
 from model.customer import Customer
 from datetime import datetime
 from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
 from decimal import Decimal
+from utils.serialize import format_decimal, invoice_to_dict, sale_to_dict, stream_json_list
+from utils.read_routing import read_only
 
-# Helper function to format decimal values
-def format_decimal(value):
-    if value is None:
-        return None
-    return float(value)
+invoices_bp = Blueprint('invoices', __name__)
 
 # Helper function to validate sale items
 def validate_sale_items(items):
@@ -37,21 +36,14 @@ def validate_sale_items(items):
     
     return True, None
 
-@app.get('/invoice/list')
+@invoices_bp.get('/invoice/list')
+@read_only
 def list_invoices():
     """Get all invoices with basic information"""
-    sales = Sale.query.order_by(Sale.date_time.desc()).all()
-    return jsonify([{
-        'id': sale.id,
-        'date_time': sale.date_time.isoformat(),
-        'customer_id': sale.customer_id,
-        'user_id': sale.user_id,
-        'total': format_decimal(sale.total),
-        'paid': format_decimal(sale.paid),
-        'remark': sale.remark
-    } for sale in sales]), 200
+    sales = Sale.query.order_by(Sale.date_time.desc()).yield_per(500)
+    return stream_json_list(sales, sale_to_dict)
 
-@app.get('/invoice/<int:invoice_id>')
+@invoices_bp.get('/invoice/<int:invoice_id>')
 def get_invoice_details(invoice_id):
     """Get detailed information about a specific invoice including its items"""
     sale = Sale.query.get(invoice_id)
@@ -66,28 +58,9 @@ def get_invoice_details(invoice_id):
     if sale.customer_id:
         customer = Customer.query.get(sale.customer_id)
     
-    return {
-        'invoice': {
-            'id': sale.id,
-            'date_time': sale.date_time.isoformat(),
-            'customer_id': sale.customer_id,
-            'customer_name': customer.name if customer else None,
-            'user_id': sale.user_id,
-            'total': format_decimal(sale.total),
-            'paid': format_decimal(sale.paid),
-            'remark': sale.remark
-        },
-        'items': [{
-            'id': item.id,
-            'product_id': item.product_id,
-            'qty': item.qty,
-            'cost': format_decimal(item.cost),
-            'price': format_decimal(item.price),
-            'total': format_decimal(item.total)
-        } for item in items]
-    }, 200
+    return invoice_to_dict(sale, customer, items), 200
 
-@app.post('/invoice/create')
+@invoices_bp.post('/invoice/create')
 def create_invoice():
     """Create a new invoice with its items"""
     data = request.get_json()
@@ -156,11 +129,14 @@ def create_invoice():
     except ValueError as e:
         db.session.rollback()
         return {'error': str(e)}, 400
+    except IntegrityError:
+        db.session.rollback()
+        return {'error': 'User or customer not found'}, 400
     except Exception as e:
         db.session.rollback()
         return {'error': 'An error occurred while creating the invoice'}, 500
 
-@app.post('/invoice/<int:invoice_id>/update')
+@invoices_bp.post('/invoice/<int:invoice_id>/update')
 def update_invoice(invoice_id):
     """Update invoice details and/or items"""
     data = request.get_json()
@@ -226,11 +202,14 @@ def update_invoice(invoice_id):
     except ValueError as e:
         db.session.rollback()
         return {'error': str(e)}, 400
+    except IntegrityError:
+        db.session.rollback()
+        return {'error': 'User or customer not found'}, 400
     except Exception as e:
         db.session.rollback()
         return {'error': 'An error occurred while updating the invoice'}, 500
 
-@app.delete('/invoice/<int:invoice_id>')
+@invoices_bp.delete('/invoice/<int:invoice_id>')
 def delete_invoice(invoice_id):
     """Delete an invoice and all its items"""
     sale = Sale.query.get(invoice_id)
@@ -252,7 +231,7 @@ def delete_invoice(invoice_id):
 
 
 # Invoice item specific endpoints
-@app.post('/invoice/<int:invoice_id>/items/add')
+@invoices_bp.post('/invoice/<int:invoice_id>/items/add')
 def add_invoice_item(invoice_id):
     """Add a new item to an existing invoice"""
     sale = Sale.query.get(invoice_id)
@@ -304,7 +283,7 @@ def add_invoice_item(invoice_id):
         db.session.rollback()
         return {'error': 'An error occurred while adding the item'}, 500
 
-@app.put('/invoice/<int:invoice_id>/items/<int:item_id>')
+@invoices_bp.put('/invoice/<int:invoice_id>/items/<int:item_id>')
 def update_invoice_item(invoice_id, item_id):
     """Update a specific item in an invoice"""
     item = SaleItem.query.get(item_id)
@@ -343,7 +322,7 @@ def update_invoice_item(invoice_id, item_id):
         db.session.rollback()
         return {'error': 'An error occurred while updating the item'}, 500
 
-@app.delete('/invoice/<int:invoice_id>/items/<int:item_id>')
+@invoices_bp.delete('/invoice/<int:invoice_id>/items/<int:item_id>')
 def delete_invoice_item(invoice_id, item_id):
     """Delete a specific item from an invoice"""
     item = SaleItem.query.get(item_id)
@@ -1,102 +1,40 @@
-from app import app, db
+from flask import Blueprint, request
+from extensions import db
 from sqlalchemy import text
-from flask import request
-from werkzeug.utils import secure_filename
-from PIL import Image, ImageDraw, ImageFont
-from io import BytesIO
-from uuid import uuid4
-import os
+from sqlalchemy.exc import IntegrityError
 from model.product import Product
+from utils.cache import catalog_cache
+from utils.image_jobs import image_jobs, mark_pending, release_upload
+from utils.serialize import product_to_dict, cached_json
+from utils.uploads import accept_upload
 
-# constants
-UPLOAD_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'static', 'uploads', 'products'))
-MAX_IMAGE_SIZE = 2 * 1024 * 1024
-os.makedirs(UPLOAD_DIR, exist_ok=True)
+product_bp = Blueprint('product', __name__)
 
 
-def _validate_image(file_storage):
-    if not file_storage:
-        return False, "No file uploaded"
-    # check mimetype
-    mimetype = getattr(file_storage, "mimetype", "")
-    if not mimetype.startswith("image/"):
-        return False, "File is not an image"
-    # read bytes to check size and to use for processing
-    data = file_storage.read()
-    size = len(data)
-    # reset pointer for later use if needed (we return bytes anyway)
-    if size > MAX_IMAGE_SIZE:
-        return False, "Image exceeds 2MB"
-    if size == 0:
-        return False, "Empty image"
-    return True, data
-
-
-def _save_with_watermark(image_bytes, filename, watermark_text="Product Watermark"):
-    img = Image.open(BytesIO(image_bytes)).convert("RGBA")
-    width, height = img.size
-
-    # create watermark layer
-    watermark = Image.new("RGBA", img.size, (0, 0, 0, 0))
-    draw = ImageDraw.Draw(watermark)
-    try:
-        # attempt to load a TTF font; fallback to default
-        font_size = max(12, width // 20)
-        font = ImageFont.truetype("arial.ttf", font_size)
-    except Exception:
-        font = ImageFont.load_default()
-
-    text = watermark_text
-    # textsize may not exist on some Pillow versions — try several fallbacks
-    try:
-        textwidth, textheight = draw.textsize(text, font=font)
-    except AttributeError:
-        try:
-            textwidth, textheight = font.getsize(text)
-        except Exception:
-            # final fallback: use textbbox (Pillow >= 8.0) to compute size
-            try:
-                bbox = draw.textbbox((0, 0), text, font=font)
-                textwidth = bbox[2] - bbox[0]
-                textheight = bbox[3] - bbox[1]
-            except Exception:
-                # give a conservative default if all methods fail
-                textwidth, textheight = (100, 20)
-    margin = 10
-    x = width - textwidth - margin
-    y = height - textheight - margin
-
-    # semi-transparent white text
-    draw.text((x, y), text, font=font, fill=(255, 255, 255, 120))
-
-    combined = Image.alpha_composite(img, watermark)
-
-    # save as JPEG (convert to RGB)
-    out_path = os.path.join(UPLOAD_DIR, filename)
-    combined.convert("RGB").save(out_path, format="JPEG", quality=85)
-    return out_path
-
-
-@app.get('/product/list')
+@product_bp.get('/product/list')
 def list_products():
-    products = Product.query.all()
-    return [{
-        "id": product.id,
-        "name": product.name,
-        "category_id": product.category_id,
-        "cost": float(product.cost),
-        "price": float(product.price),
-        "image": product.image
-    } for product in products], 200
+    return cached_json('product:list', lambda: [product_to_dict(p) for p in Product.query.all()])
 
 
-@app.get('/product/list-by-id/<int:product_id>')
+@product_bp.get('/product/list-by-id/<int:product_id>')
 def product_by_id(product_id):
     result = get_product_by_id(product_id)
     return result
 
 
-@app.post('/product/create')
+@product_bp.get('/product/<int:product_id>/image-status')
+def product_image_status(product_id):
+    product = Product.query.get(product_id)
+    if not product:
+        return {"error": "Product not found"}, 404
+    return {
+        "id": product.id,
+        "image": product.image,
+        "image_status": product.image_status
+    }, 200
+
+
+@product_bp.post('/product/create')
 def create_product():
     # expect form-data: fields in request.form and file in request.files['image']
     form = request.form
@@ -126,42 +64,45 @@ def create_product():
     except ValueError:
         return {"error": "Invalid numeric values provided"}, 400
 
-    image_path = None
+    raw_path = None
     image_file = files.get('image')
     if image_file:
-        ok, data_or_err = _validate_image(image_file)
-        if not ok:
-            return {"error": data_or_err}, 400
-        image_bytes = data_or_err
-        # generate filename and save with watermark
-        filename = f"{uuid4().hex}.jpg"
-        _save_with_watermark(image_bytes, filename, watermark_text="Product Image")
-        image_path = os.path.join('static', 'uploads', 'products', filename).replace("\\", "/")
+        raw_path, error = accept_upload(image_file)
+        if error:
+            return error
 
     product = Product(
         name=name,
         category_id=category_id,
         cost=cost,
-        price=price,
-        image=image_path
+        price=price
     )
+    job_token = mark_pending(product) if raw_path else None
     db.session.add(product)
-    db.session.commit()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        if raw_path:
+            image_jobs.discard(raw_path)
+        return {"error": "Category not found"}, 400
+    except Exception:
+        if raw_path:
+            image_jobs.discard(raw_path)
+        raise
+    catalog_cache.clear()
+    if raw_path:
+        # watermarked in the background, see /product/<id>/image-status
+        image_jobs.submit(Product, product.id, 'image', raw_path, "Product Image", job_token,
+                          on_ready=catalog_cache.clear)
 
     return {
         "message": "Product created",
-        "product": {
-            "id": product.id,
-            "name": product.name,
-            "category_id": product.category_id,
-            "cost": float(product.cost),
-            "price": float(product.price),
-            "image": product.image
-        }
+        "product": product_to_dict(product)
     }, 200
 
 
-@app.post('/product/update')
+@product_bp.post('/product/update')
 def update_product():
     form = request.form
     files = request.files
@@ -198,41 +139,37 @@ def update_product():
         except ValueError:
             return {"error": "Invalid price value"}, 400
 
+    raw_path = job_token = None
     image_file = files.get('image')
     if image_file:
-        ok, data_or_err = _validate_image(image_file)
-        if not ok:
-            return {"error": data_or_err}, 400
-        image_bytes = data_or_err
+        raw_path, error = accept_upload(image_file)
+        if error:
+            return error
+        # the old image stays in place until the new one is ready
+        job_token = mark_pending(product)
 
-        # Remove old image if present
-        if product.image:
-            try:
-                old = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', product.image))
-                if os.path.exists(old):
-                    os.remove(old)
-            except Exception:
-                pass
-
-        filename = f"{uuid4().hex}.jpg"
-        _save_with_watermark(image_bytes, filename, watermark_text="Product Image")
-        product.image = os.path.join('static', 'uploads', 'products', filename).replace("\\", "/")
-
-    db.session.commit()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        if raw_path:
+            image_jobs.discard(raw_path)
+        return {"error": "Category not found"}, 400
+    except Exception:
+        if raw_path:
+            image_jobs.discard(raw_path)
+        raise
+    catalog_cache.clear()
+    if raw_path:
+        image_jobs.submit(Product, product.id, 'image', raw_path, "Product Image", job_token,
+                          on_ready=catalog_cache.clear)
     return {
         "message": "Product updated",
-        "product": {
-            "id": product.id,
-            "name": product.name,
-            "category_id": product.category_id,
-            "cost": float(product.cost),
-            "price": float(product.price),
-            "image": product.image
-        }
+        "product": product_to_dict(product)
     }, 200
 
 
-@app.post('/product/delete')
+@product_bp.post('/product/delete')
 def delete_product():
     form = request.form
     if not form.get('product_id'):
@@ -243,17 +180,15 @@ def delete_product():
     if not product:
         return {"error": "Product not found"}, 404
 
-    # Delete image file if exists
-    if product.image:
-        try:
-            old = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', product.image))
-            if os.path.exists(old):
-                os.remove(old)
-        except Exception:
-            pass
-
     db.session.delete(product)
-    db.session.commit()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return {"error": "Product is used by invoices"}, 400
+    catalog_cache.clear()
+    # Drop the image once the row is gone
+    release_upload(product.image)
     return {
         "message": "Product deleted",
     }, 200
@@ -262,14 +197,7 @@ def delete_product():
 def get_product_by_id(product_id: int) -> dict:
     product = Product.query.get(product_id)
     if product:
-        return {
-            "id": product.id,
-            "name": product.name,
-            "category_id": product.category_id,
-            "cost": float(product.cost),
-            "price": float(product.price),
-            "image": product.image
-        }
+        return product_to_dict(product)
     return {
         "error": "Product not found"
     }
@@ -1,10 +1,15 @@
 
 from flask import Blueprint, jsonify, request
 from model.sale import Sale
-from app import db
-from sqlalchemy import func
+from extensions import db
+from sqlalchemy import func, select
+from utils.db_profiles import date_bucket
+from utils.read_routing import use_read_engine
+from utils.serialize import format_decimal, sale_to_dict, stream_json_list
 
 reports_bp = Blueprint('reports', __name__)
+# reports tolerate READ_MAX_STALENESS, see utils/read_routing.py
+reports_bp.before_request(use_read_engine)
 
 @reports_bp.route('/reports/sales/by', methods=['GET'])
 def sales_by_criteria():
@@ -20,71 +25,41 @@ def sales_by_criteria():
 	#     query = query.join(SaleItem).filter(SaleItem.product_id == product_id)
 	# if category_id:
 	#     query = query.join(SaleItem).join(Product).filter(Product.category_id == category_id)
-	results = query.all()
-	data = [
-		{
-			'id': sale.id,
-			'date_time': sale.date_time.isoformat(),
-			'user_id': sale.user_id,
-			'customer_id': sale.customer_id,
-			'total': float(sale.total),
-			'paid': float(sale.paid),
-			'remark': sale.remark
-		}
-		for sale in results
-	]
-	return jsonify(data)
-# Weekly Sales Report
-@reports_bp.route('/reports/sales/weekly', methods=['GET'])
-def weekly_sales_report():
-	results = db.session.query(
-		func.strftime('%Y-%W', Sale.date_time).label('week'),
+	return stream_json_list(query.yield_per(500), sale_to_dict)
+def sales_by_period_query(period, dialect):
+	bucket = date_bucket(Sale.date_time, period, dialect).label('period')
+	return select(
+		bucket,
 		func.sum(Sale.total).label('total_sales'),
 		func.count(Sale.id).label('num_sales')
-	).group_by(func.strftime('%Y-%W', Sale.date_time)).order_by(func.strftime('%Y-%W', Sale.date_time).desc()).all()
-	data = [
+	).group_by(bucket).order_by(bucket.desc())
+
+def period_rows(results, key):
+	return [
 		{
-			'week': row.week,
-			'total_sales': float(row.total_sales),
+			key: row.period,
+			'total_sales': format_decimal(row.total_sales),
 			'num_sales': row.num_sales
 		}
 		for row in results
 	]
-	return jsonify(data)
+
+def _sales_by_period(period, key):
+	results = db.session.execute(sales_by_period_query(period, db.engine.dialect.name)).all()
+	return period_rows(results, key)
+
+# Weekly Sales Report
+@reports_bp.route('/reports/sales/weekly', methods=['GET'])
+def weekly_sales_report():
+	return jsonify(_sales_by_period('week', 'week'))
 
 # Monthly Sales Report
 @reports_bp.route('/reports/sales/monthly', methods=['GET'])
 def monthly_sales_report():
-	results = db.session.query(
-		func.strftime('%Y-%m', Sale.date_time).label('month'),
-		func.sum(Sale.total).label('total_sales'),
-		func.count(Sale.id).label('num_sales')
-	).group_by(func.strftime('%Y-%m', Sale.date_time)).order_by(func.strftime('%Y-%m', Sale.date_time).desc()).all()
-	data = [
-		{
-			'month': row.month,
-			'total_sales': float(row.total_sales),
-			'num_sales': row.num_sales
-		}
-		for row in results
-	]
-	return jsonify(data)
+	return jsonify(_sales_by_period('month', 'month'))
 
 
 # Daily Sales Report
 @reports_bp.route('/reports/sales/daily', methods=['GET'])
 def daily_sales_report():
-	results = db.session.query(
-		func.date(Sale.date_time).label('date'),
-		func.sum(Sale.total).label('total_sales'),
-		func.count(Sale.id).label('num_sales')
-	).group_by(func.date(Sale.date_time)).order_by(func.date(Sale.date_time).desc()).all()
-	data = [
-		{
-			'date': str(row.date),
-			'total_sales': float(row.total_sales),
-			'num_sales': row.num_sales
-		}
-		for row in results
-	]
-	return jsonify(data)
+	return jsonify(_sales_by_period('day', 'date'))
@@ -0,0 +1,41 @@
+from flask import Blueprint, abort, current_app, make_response, send_from_directory
+import mimetypes
+import os
+import re
+from utils.blob_store import BASE_DIR, BLOB_DIR
+
+uploads_bp = Blueprint('uploads', __name__)
+
+BLOB_ROOT = os.path.join(BASE_DIR, BLOB_DIR)
+# <2 hex>/<sha256>[_<size>].<ext>, anything else under the prefix is a 404
+BLOB_NAME = re.compile(r'[0-9a-f]{2}/(?P<name>[0-9a-f]{64}(?:_\d+)?)\.(?:jpg|webp)')
+ONE_YEAR = 365 * 24 * 60 * 60
+
+
+@uploads_bp.get('/static/uploads/blobs/<path:filename>')
+def upload_blob_file(filename):
+    """Serve a content-addressed upload.
+
+    The file name is the hash of the content, so it can never change: it is
+    sent with a one year `immutable` Cache-Control and a strong ETag, and
+    supports conditional and range requests.  With USE_X_SENDFILE or
+    UPLOADS_ACCEL_REDIRECT_PREFIX set, the bytes are left to the front proxy.
+    """
+    match = BLOB_NAME.fullmatch(filename)
+    if not match:
+        abort(404)
+    accel_prefix = current_app.config.get('UPLOADS_ACCEL_REDIRECT_PREFIX')
+    if accel_prefix:
+        # nginx: internal location aliased to static/uploads/blobs
+        response = make_response('')
+        response.headers['X-Accel-Redirect'] = accel_prefix.rstrip('/') + '/' + filename
+        response.mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        response.set_etag(match['name'])
+    else:
+        # send_file emits X-Sendfile itself when USE_X_SENDFILE is on
+        response = send_from_directory(BLOB_ROOT, filename, etag=match['name'],
+                                       max_age=ONE_YEAR, conditional=True)
+    response.cache_control.public = True
+    response.cache_control.max_age = ONE_YEAR
+    response.cache_control.immutable = True
+    return response
@@ -1,100 +1,86 @@
-from app import app, db
-from sqlalchemy import text
-from flask import request
-from flask_jwt_extended import jwt_required, get_jwt_identity
-from werkzeug.security import generate_password_hash, check_password_hash
-from functools import wraps
-from werkzeug.utils import secure_filename
-from PIL import Image, ImageDraw, ImageFont
-from io import BytesIO
-from uuid import uuid4
-import os
+from flask import Blueprint, current_app, request
+from extensions import db
+from sqlalchemy import func, select
+from sqlalchemy.exc import IntegrityError
+from flask_jwt_extended import verify_jwt_in_request, get_jwt_identity
+from functools import partial, wraps
+import hashlib
+import hmac
+import secrets
 from model.user import User
+from utils.passwords import password_hasher, login_throttle, VerifierBusy
+from utils.image_jobs import image_jobs, mark_pending, release_upload
+from utils.serialize import user_to_dict
+from utils.uploads import accept_upload
+from utils.cache import TTLCache, user_cache
+from utils.read_routing import read_only
 
-# constants
-UPLOAD_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'static', 'uploads', 'users'))
-MAX_IMAGE_SIZE = 2 * 1024 * 1024
-os.makedirs(UPLOAD_DIR, exist_ok=True)
-
-
-def _validate_image(file_storage):
-    if not file_storage:
-        return False, "No file uploaded"
-    # check mimetype
-    mimetype = getattr(file_storage, "mimetype", "")
-    if not mimetype.startswith("image/"):
-        return False, "File is not an image"
-    # read bytes to check size and to use for processing
-    data = file_storage.read()
-    size = len(data)
-    # reset pointer for later use if needed (we return bytes anyway)
-    if size > MAX_IMAGE_SIZE:
-        return False, "Image exceeds 2MB"
-    if size == 0:
-        return False, "Empty image"
-    return True, data
-
-
-def _save_with_watermark(image_bytes, filename, watermark_text="Test Watermark"):
-    img = Image.open(BytesIO(image_bytes)).convert("RGBA")
-    width, height = img.size
-
-    # create watermark layer
-    watermark = Image.new("RGBA", img.size, (0, 0, 0, 0))
-    draw = ImageDraw.Draw(watermark)
-    try:
-        # attempt to load a TTF font; fallback to default
-        font_size = max(12, width // 20)
-        font = ImageFont.truetype("arial.ttf", font_size)
-    except Exception:
-        font = ImageFont.load_default()
-
-    text = watermark_text
-    # textsize may not exist on some Pillow versions — try several fallbacks
-    try:
-        textwidth, textheight = draw.textsize(text, font=font)
-    except AttributeError:
-        try:
-            textwidth, textheight = font.getsize(text)
-        except Exception:
-            # final fallback: use textbbox (Pillow >= 8.0) to compute size
-            try:
-                bbox = draw.textbbox((0, 0), text, font=font)
-                textwidth = bbox[2] - bbox[0]
-                textheight = bbox[3] - bbox[1]
-            except Exception:
-                # give a conservative default if all methods fail
-                textwidth, textheight = (100, 20)
-    margin = 10
-    x = width - textwidth - margin
-    y = height - textheight - margin
-
-    # semi-transparent white text
-    draw.text((x, y), text, font=font, fill=(255, 255, 255, 120))
+user_bp = Blueprint('user', __name__)
 
-    combined = Image.alpha_composite(img, watermark)
 
-    # save as JPEG (convert to RGB)
-    out_path = os.path.join(UPLOAD_DIR, filename)
-    combined.convert("RGB").save(out_path, format="JPEG", quality=85)
-    return out_path
+USER_PAGE_SIZE = 50
+MAX_USER_PAGE_SIZE = 200
+USER_COLUMNS = (User.id, User.user_name, User.profile, User.image_status)
 
 
-@app.get('/user/list')
+@user_bp.get('/user/list')
+@read_only
 def user():
-    sql = text("""SELECT * FROM  user""")
-    result = db.session.execute(sql).fetchall()
-    rows = [dict(row._mapping) for row in result]
-    return rows, 200
-
-
-@app.get('/user/list-by-id/<int:user_id>')
+    page = request.args.get('page', 1, type=int)
+    per_page = request.args.get('per_page', USER_PAGE_SIZE, type=int)
+    if page < 1 or per_page < 1:
+        return {"error": "page and per_page must be positive"}, 400
+    per_page = min(per_page, MAX_USER_PAGE_SIZE)
+    total = db.session.execute(select(func.count(User.id))).scalar()
+    result = db.session.execute(
+        select(*USER_COLUMNS).order_by(User.id).limit(per_page).offset((page - 1) * per_page))
+    rows = [user_to_dict(row) for row in result]
+    return rows, 200, {"X-Total-Count": str(total)}
+
+
+@user_bp.get('/user/by-ids')
+def users_by_ids():
+    # e.g. /user/by-ids?ids=3,7,12 to resolve every cashier on a page of invoices
+    try:
+        ids = list(dict.fromkeys(int(i) for i in request.args.get('ids', '').split(',') if i.strip()))
+    except ValueError:
+        return {"error": "ids must be a comma separated list of integers"}, 400
+    if len(ids) > MAX_USER_PAGE_SIZE:
+        return {"error": f"At most {MAX_USER_PAGE_SIZE} ids per request"}, 400
+    found = {}
+    missing = []
+    for user_id in ids:
+        cached = user_cache.get(user_id)
+        if cached is None:
+            missing.append(user_id)
+        else:
+            found[user_id] = cached
+    if missing:
+        for row in db.session.execute(select(*USER_COLUMNS).where(User.id.in_(missing))):
+            found[row.id] = user_cache.set(row.id, user_to_dict(row))
+    # unknown ids are left out
+    return [found[user_id] for user_id in ids if user_id in found], 200
+
+
+@user_bp.get('/user/list-by-id/<int:user_id>')
 def user_by_id(user_id):
     result = get_user_by_id(user_id)
     return result
 
 
-@app.post('/user/create')
+@user_bp.get('/user/<int:user_id>/image-status')
+def user_image_status(user_id):
+    user = User.query.get(user_id)
+    if not user:
+        return {"error": "User not found"}, 404
+    return {
+        "id": user.id,
+        "profile": user.profile,
+        "image_status": user.image_status
+    }, 200
+
+
+@user_bp.post('/user/create')
 def create_user():
     # expect form-data: fields in request.form and file in request.files['profile']
     form = request.form
@@ -108,59 +94,109 @@ def create_user():
     if not password:
         return {"error": "Password is required"}, 400
 
-    profile_path = None
+    try:
+        hashed = password_hasher.hash(password)
+    except VerifierBusy:
+        return {"error": "Server busy, try again shortly"}, 503
+
+    raw_path = None
     profile_file = files.get('profile')
     if profile_file:
-        ok, data_or_err = _validate_image(profile_file)
-        if not ok:
-            return {"error": data_or_err}, 400
-        image_bytes = data_or_err
-        # generate filename and save with watermark
-        filename = f"{uuid4().hex}.jpg"
-        _save_with_watermark(image_bytes, filename)
-        profile_path = os.path.join('static', 'uploads', 'users', filename).replace("\\", "/")
-
-    hashed = generate_password_hash(password)
-    user = User(user_name=user_name, password=hashed, profile=profile_path)
+        raw_path, error = accept_upload(profile_file)
+        if error:
+            return error
+
+    user = User(user_name=user_name, password=hashed)
+    job_token = mark_pending(user) if raw_path else None
     db.session.add(user)
-    db.session.commit()
+    try:
+        db.session.commit()
+    except Exception:
+        if raw_path:
+            image_jobs.discard(raw_path)
+        raise
+    if raw_path:
+        # watermarked in the background, see /user/<id>/image-status
+        image_jobs.submit(User, user.id, 'profile', raw_path, "Test Watermark", job_token)
     return {
                "message": "User created",
-               "user": {
-                   "id": user.id,
-                   "user_name": user.user_name,
-                   "profile": user.profile
-               }
+               "user": user_to_dict(user)
            }, 200
 
 
+# verified Basic credentials: keyed digest of "name:password:stored hash" -> user id
+_basic_auth_cache = TTLCache(ttl=60, maxsize=1024)
+_basic_auth_key = secrets.token_bytes(32)
+
+
+def _authenticate_basic(auth):
+    """Return the id of the user named in HTTP Basic `auth`, or None.
+
+    Legacy clients send the password on every call; a verified pair is
+    remembered for a minute so repeat calls skip the slow hash.  The stored
+    hash is part of the cache key, so a password changed through any worker
+    stops matching at once. Raises VerifierBusy when the password pool is
+    saturated.
+    """
+    if not auth.username or not auth.password:
+        return None
+    user = db.session.execute(
+        select(User.id, User.password).where(User.user_name == auth.username)).first()
+    if not user:
+        return None
+    key = hmac.new(_basic_auth_key, f"{auth.username}:{auth.password}:{user.password}".encode('utf-8'),
+                   hashlib.sha256).digest()
+    user_id = _basic_auth_cache.get(key)
+    if user_id is not None:
+        return user_id
+    if not password_hasher.verify(user.password, auth.password):
+        return None
+    login_throttle.succeeded(auth.username)
+    return _basic_auth_cache.set(key, user.id)
+
+
 def require_auth_owner(f):
-    """Decorator to require JWT authentication and ownership check."""
+    """Require a JWT, or HTTP Basic for legacy clients when LEGACY_BASIC_AUTH
+    is set, and that the authenticated user matches the `user_id` provided in
+    the form, JSON or URL. Returns 401 if not authenticated, 403 if trying to
+    act on another user's id.
+    """
     @wraps(f)
-    @jwt_required()
     def wrapper(*args, **kwargs):
-        # Get user id from JWT token
-        authed_id = get_jwt_identity()
+        auth = request.authorization
+        if auth is not None and auth.type == 'basic' and current_app.config['LEGACY_BASIC_AUTH']:
+            # the same brute force limits as /login
+            retry_after = login_throttle.retry_after(auth.username or '', request.remote_addr)
+            if retry_after:
+                return {"error": "Too many failed login attempts, try again later"}, 429, \
+                    {"Retry-After": str(retry_after)}
+            try:
+                authed_id = _authenticate_basic(auth)
+            except VerifierBusy:
+                return {"error": "Server busy, try again shortly"}, 503
+            if authed_id is None:
+                login_throttle.failed(auth.username or '', request.remote_addr)
+                return {"error": "Authentication required"}, 401
+        else:
+            verify_jwt_in_request()
+            authed_id = get_jwt_identity()
 
         # try to find user_id from form, json, or URL kwargs
         user_id = None
         try:
             if request.form and request.form.get('user_id'):
                 user_id = request.form.get('user_id')
-            elif request.json and request.json.get('user_id'):
+            elif request.is_json and request.json.get('user_id'):
                 user_id = request.json.get('user_id')
         except Exception:
+            # ignore if reading json fails
             pass
         if 'user_id' in kwargs and kwargs.get('user_id') is not None:
             user_id = kwargs.get('user_id')
 
         # enforce ownership
-        if user_id is not None:
-            try:
-                if str(user_id) != str(authed_id):
-                    return {"error": "Forbidden: cannot modify other user"}, 403
-            except Exception:
-                return {"error": "Invalid user id"}, 400
+        if user_id is not None and str(user_id) != str(authed_id):
+            return {"error": "Forbidden: cannot modify other user"}, 403
 
         # attach authenticated user id to request context for handlers if needed
         request.auth_user_id = authed_id
@@ -168,7 +204,8 @@ def require_auth_owner(f):
 
     return wrapper
 
-@app.post('/user/update')
+
+@user_bp.post('/user/update')
 @require_auth_owner
 def update_user():
     # expect form-data
@@ -190,38 +227,37 @@ def update_user():
     if user_name:
         user.user_name = user_name
     if password:
-        user.password = generate_password_hash(password)
+        try:
+            user.password = password_hasher.hash(password)
+        except VerifierBusy:
+            return {"error": "Server busy, try again shortly"}, 503
 
+    raw_path = job_token = None
     profile_file = files.get('profile')
     if profile_file:
-        ok, data_or_err = _validate_image(profile_file)
-        if not ok:
-            return {"error": data_or_err}, 400
-        image_bytes = data_or_err
-        # remove old file if present
-        if user.profile:
-            try:
-                old = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', user.profile))
-                if os.path.exists(old):
-                    os.remove(old)
-            except Exception:
-                pass
-        filename = f"{uuid4().hex}.jpg"
-        _save_with_watermark(image_bytes, filename)
-        user.profile = os.path.join('static', 'uploads', 'users', filename).replace("\\", "/")
-
-    db.session.commit()
+        raw_path, error = accept_upload(profile_file)
+        if error:
+            return error
+        # the old profile image stays in place until the new one is ready
+        job_token = mark_pending(user)
+
+    try:
+        db.session.commit()
+    except Exception:
+        if raw_path:
+            image_jobs.discard(raw_path)
+        raise
+    user_cache.pop(user.id)
+    if raw_path:
+        image_jobs.submit(User, user.id, 'profile', raw_path, "Test Watermark", job_token,
+                          on_ready=partial(user_cache.pop, user.id))
     return {
                "message": "User updated",
-               "user": {
-                   "id": user.id,
-                   "user_name": user.user_name,
-                   "profile": user.profile
-               }
+               "user": user_to_dict(user)
            }, 200
 
 
-@app.post('/user/delete')
+@user_bp.post('/user/delete')
 @require_auth_owner
 def delete_user():
     form = request.form
@@ -231,91 +267,27 @@ def delete_user():
     user = User.query.get(user_id)
     if not user:
         return {"error": "User not found"}, 404
-    # delete image file if exists
-    if user.profile:
-        try:
-            old = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', user.profile))
-            if os.path.exists(old):
-                os.remove(old)
-        except Exception:
-            pass
     db.session.delete(user)
-    db.session.commit()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return {"error": "User has invoices"}, 400
+    user_cache.pop(user.id)
+    # drop the image once the row is gone
+    release_upload(user.profile)
     return {
                "message": "User deleted",
            }, 200
 
 
 def get_user_by_id(user_id: int) -> dict:
-    # use ORM to fetch
-    user = User.query.get(user_id)
-    if user:
-        return {
-            "id": user.id,
-            "user_name": user.user_name,
-            "profile": user.profile
-        }
+    cached = user_cache.get(user_id)
+    if cached is not None:
+        return cached
+    row = db.session.execute(select(*USER_COLUMNS).where(User.id == user_id)).first()
+    if row:
+        return user_cache.set(user_id, user_to_dict(row))
     return {
         "error": "User not found"
     }
-
-
-def _authenticate_request():
-    """Authenticate using HTTP Basic Auth (Authorization header).
-    Returns the authenticated User instance or None.
-    """
-    auth = request.authorization
-    if not auth or not getattr(auth, "username", None) or not getattr(auth, "password", None):
-        return None
-    user = User.query.filter_by(user_name=auth.username).first()
-    if not user:
-        return None
-    try:
-        if check_password_hash(user.password, auth.password):
-            return user
-    except Exception:
-        # if password hashing format mismatch or other error, treat as unauthenticated
-        return None
-    return None
-
-
-def require_auth_owner(f):
-    """Decorator to require that the request is authenticated and the authenticated
-    user matches the `user_id` provided in the form (or JSON). Returns 401 if not
-    authenticated, 403 if trying to act on another user's id.
-    """
-    @wraps(f)
-    def wrapper(*args, **kwargs):
-        authed = _authenticate_request()
-        if not authed:
-            return {"error": "Authentication required"}, 401
-
-        # try to find user_id from form, json, or URL kwargs
-        user_id = None
-        try:
-            if request.form and request.form.get('user_id'):
-                user_id = request.form.get('user_id')
-            elif request.json and request.json.get('user_id'):
-                user_id = request.json.get('user_id')
-        except Exception:
-            # ignore if reading json fails
-            pass
-
-        # if route provided user_id as URL parameter, use that
-        if 'user_id' in kwargs and kwargs.get('user_id') is not None:
-            user_id = kwargs.get('user_id')
-
-        # if we have a user_id to check, enforce ownership
-        if user_id is not None:
-            try:
-                if int(user_id) != int(authed.id):
-                    return {"error": "Forbidden: cannot modify other user"}, 403
-            except Exception:
-                # invalid id format
-                return {"error": "Invalid user id"}, 400
-
-        # attach authenticated user to request context for handlers if needed
-        request.auth_user = authed
-        return f(*args, **kwargs)
-
-    return wrapper
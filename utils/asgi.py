@@ -0,0 +1,349 @@
+"""ASGI serving mode: read-heavy endpoints on the event loop, the rest of the
+app in a bounded thread pool.
+
+    uvicorn --factory app:create_asgi_app --host 0.0.0.0 --port 8000 --workers 2
+
+A gunicorn sync worker is busy for the whole life of a request, including
+the time it waits on the database or streams a long listing, so serving
+more connections at once means more workers, each with its own copy of the
+app.  Here a single process serves many connections:
+
+* the GET endpoints of routes/async_reads.py (invoice list and detail, the
+  sales reports, the user, product and category lists) run on the event
+  loop with an AsyncSession.  They answer with the same JSON as their Flask
+  views, and the read_only ones use the read replica or snapshot in the
+  same way (utils/read_routing.py).  The async engine uses DATABASE_URL
+  with the backend's async driver (sqlite+aiosqlite, postgresql+psycopg,
+  mysql+aiomysql), or ASYNC_DATABASE_URL when set.
+* every other request goes to the unchanged Flask app, with its hooks,
+  metrics, profiler and error handlers, on ASGI_THREADS threads.  The
+  request body is read first, at most MAX_CONTENT_LENGTH + 1 bytes, and the
+  response is iterated in the pool, so streamed responses stay streamed.
+  Up to ASGI_QUEUE_SIZE more requests wait for a thread.  Beyond that the
+  answer is 503 straight from the loop, as with the password and image
+  pools.
+
+Image processing and password hashing keep their own pools.  Everything
+else that blocks (file I/O, the sync ORM) runs in these threads and never
+on the loop.
+"""
+import asyncio
+import contextvars
+import io
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
+
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.pool import NullPool
+from werkzeug.datastructures import Headers, MultiDict
+from werkzeug.exceptions import HTTPException
+from werkzeug.routing import Map, Rule
+
+from utils.db_profiles import engine_options
+from utils.read_routing import SNAPSHOT_PRAGMAS, read_router, wants_fresh_read
+from utils.serialize import dumps
+from utils.sqlite_profile import DEFAULT_PRAGMAS, apply_pragmas
+
+logger = logging.getLogger(__name__)
+
+# backend -> async driver for the same database
+ASYNC_DRIVERS = {
+    'sqlite': 'aiosqlite',
+    'postgresql': 'psycopg',
+    'mysql': 'aiomysql',
+    'mariadb': 'aiomysql',
+}
+
+BUSY = {"error": "Server busy, try again shortly"}
+SERVER_ERROR = {"status": 500, "message": "internal server error"}
+
+_DONE = object()
+
+
+def async_url(url):
+    """`url` with its backend's async driver."""
+    url = make_url(url)
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise RuntimeError(f"no async driver known for {backend}, set ASYNC_DATABASE_URL")
+    return url.set(drivername=f"{backend}+{ASYNC_DRIVERS[backend]}")
+
+
+class AsyncRequest:
+    """The parts of a request the async views read."""
+
+    def __init__(self, scope):
+        self.method = scope['method']
+        self.path = scope['path']
+        self.args = MultiDict(parse_qsl(scope['query_string'].decode('latin-1'), keep_blank_values=True))
+        self.headers = Headers([(name.decode('latin-1'), value.decode('latin-1'))
+                                for name, value in scope['headers']])
+
+
+class AsyncRoutes:
+    """GET endpoints served on the event loop, matched with werkzeug's router
+    like Flask's.
+
+    A view is called as ``await view(session, request, **url_args)`` and
+    returns what a Flask view may: a payload, pre-encoded bytes or an async
+    iterator of bytes (see stream_json_rows), optionally followed by the
+    status and extra headers.
+    """
+
+    def __init__(self):
+        self.url_map = Map()
+        self.views = {}
+
+    def get(self, rule, read_only=False):
+        def decorator(view):
+            self.url_map.add(Rule(rule, endpoint=view.__name__, methods=['GET']))
+            self.views[view.__name__] = (view, read_only)
+            return view
+
+        return decorator
+
+
+async def stream_json_rows(result, mapper, chunk_size=500):
+    """Async twin of utils.serialize.stream_json_list over a streamed result."""
+    yield b'['
+    first = True
+    async for rows in result.partitions(chunk_size):
+        yield (b'' if first else b',') + b','.join(dumps(mapper(row)) for row in rows)
+        first = False
+    yield b']'
+
+
+class AsyncApp:
+    """ASGI application around a Flask app; see the module docstring."""
+
+    def __init__(self, app, routes):
+        self.app = app
+        self.routes = routes
+        self.threads = app.config.setdefault('ASGI_THREADS', 8)
+        self.queue_size = app.config.setdefault('ASGI_QUEUE_SIZE', 64)
+        self.database_url = app.config.setdefault('ASYNC_DATABASE_URL', os.environ.get('ASYNC_DATABASE_URL'))
+        self.max_body = app.config.get('MAX_CONTENT_LENGTH')
+        self._adapter = routes.url_map.bind('localhost')
+        self._executor = None
+        self._engines = {}
+        self._waiting = 0
+        self._pid = None
+        app.extensions['asgi'] = self
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http':
+            self._ensure_started()
+            await self._http(scope, receive, send)
+        elif scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        else:
+            raise RuntimeError(f"unsupported ASGI scope {scope['type']}")
+
+    # process state, created in the worker process that serves
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._executor = ThreadPoolExecutor(self.threads, thread_name_prefix='asgi-wsgi')
+        self._engines = {}
+        periodic = self.app.extensions.get('periodic_tasks')
+        if periodic is not None:
+            periodic.ensure_started()
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self._ensure_started()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                for engine in self._engines.values():
+                    await engine.dispose()
+                self._engines = {}
+                if self._executor is not None:
+                    self._executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def _engine(self, read_only, request):
+        use_read = (read_only and read_router.enabled and not wants_fresh_read(request)
+                    and read_router.fresh_enough())
+        key = 'read' if use_read else 'primary'
+        if key not in self._engines:
+            self._engines[key] = self._create_engine(use_read)
+        return self._engines[key]
+
+    def _create_engine(self, read):
+        config = self.app.config
+        if read and not read_router.url:
+            # a new connection per checkout, so a refreshed snapshot file is picked up
+            engine = create_async_engine(
+                f"sqlite+aiosqlite:///file:{read_router.snapshot_path}?mode=ro&uri=true", poolclass=NullPool)
+            pragmas = SNAPSHOT_PRAGMAS
+        else:
+            if read:
+                url, options = read_router.url, engine_options(read_router.url)
+            elif self.database_url:
+                url, options = self.database_url, engine_options(self.database_url)
+            else:
+                # the sync engine's URL, with relative SQLite paths already
+                # resolved against the instance folder
+                with self.app.app_context():
+                    url = self.app.extensions['sqlalchemy'].engine.url
+                options = config['SQLALCHEMY_ENGINE_OPTIONS']
+            engine = create_async_engine(async_url(url), **options)
+            pragmas = dict(DEFAULT_PRAGMAS, **config.get('SQLITE_PRAGMAS', {}))
+        if engine.dialect.name == 'sqlite':
+            @event.listens_for(engine.sync_engine, 'connect')
+            def _on_connect(dbapi_connection, connection_record):
+                apply_pragmas(dbapi_connection, pragmas)
+        return engine
+
+    # requests
+
+    async def _http(self, scope, receive, send):
+        if scope['method'] == 'GET':
+            try:
+                rule, url_args = self._adapter.match(scope['path'], 'GET', return_rule=True)
+            except HTTPException:
+                # not found, a redirect... all answered by Flask
+                rule = None
+            if rule is not None:
+                await self._async_view(rule, url_args, scope, send)
+                return
+        await self._wsgi(scope, receive, send)
+
+    async def _async_view(self, rule, url_args, scope, send):
+        started = time.perf_counter()
+        view, read_only = self.routes.views[rule.endpoint]
+        request = AsyncRequest(scope)
+        async with AsyncSession(self._engine(read_only, request), expire_on_commit=False) as session:
+            try:
+                result = await view(session, request, **url_args)
+            except Exception:
+                logger.exception("async view %s failed", rule.endpoint)
+                result = (SERVER_ERROR, 500)
+            if not isinstance(result, tuple):
+                result = (result,)
+            body, status, headers = result + (200, {})[len(result) - 1:]
+            headers = [(b'content-type', b'application/json')] + [
+                (name.lower().encode('latin-1'), str(value).encode('latin-1')) for name, value in headers.items()]
+            if hasattr(body, '__aiter__'):
+                await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+                async for chunk in body:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                await send({'type': 'http.response.body', 'body': b''})
+            else:
+                await self._send(send, status, body, headers)
+        metrics = self.app.extensions.get('metrics')
+        if metrics is not None:
+            metrics.observe('http_request_duration_seconds', ('GET', rule.rule, str(status)),
+                            time.perf_counter() - started)
+
+    async def _send(self, send, status, body, headers=None):
+        if not isinstance(body, (bytes, bytearray)):
+            body = dumps(body)
+        headers = headers or [(b'content-type', b'application/json')]
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': headers + [(b'content-length', str(len(body)).encode())]})
+        await send({'type': 'http.response.body', 'body': bytes(body)})
+
+    async def _read_body(self, receive):
+        """The request body, None when the client went away first."""
+        chunks = []
+        size = 0
+        more = True
+        while more:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return None
+            chunk = message.get('body', b'')
+            chunks.append(chunk)
+            size += len(chunk)
+            more = message.get('more_body', False)
+            if self.max_body is not None and size > self.max_body:
+                # enough for Flask to answer 413
+                break
+        return b''.join(chunks)
+
+    def _environ(self, scope, body):
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('', 0)
+        root_path = scope.get('root_path', '')
+        path = scope['path']
+        if root_path and path.startswith(root_path):
+            path = path[len(root_path):]
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': root_path.encode('utf-8').decode('latin-1'),
+            'PATH_INFO': path.encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope['query_string'].decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+            'REMOTE_ADDR': client[0],
+            'REMOTE_PORT': str(client[1]),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+        }
+        for name, value in scope['headers']:
+            name = name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            key = name if name in ('CONTENT_TYPE', 'CONTENT_LENGTH') else 'HTTP_' + name
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+        return environ
+
+    async def _wsgi(self, scope, receive, send):
+        if self._waiting >= self.threads + self.queue_size:
+            await self._send(send, 503, BUSY, [(b'content-type', b'application/json'), (b'retry-after', b'1')])
+            return
+        self._waiting += 1
+        try:
+            body = await self._read_body(receive)
+            if body is None:
+                return
+            environ = self._environ(scope, body)
+            loop = asyncio.get_running_loop()
+            # every step of one request runs in the same context, whichever
+            # thread it lands on, so Flask's context variables carry over
+            # from the call to the iteration of a streamed body
+            context = contextvars.copy_context()
+
+            def run(fn, *args):
+                return loop.run_in_executor(self._executor, context.run, fn, *args)
+
+            response = []
+
+            def start_response(status, headers, exc_info=None):
+                response[:] = [int(status.split(' ', 1)[0]), headers]
+
+            iterable = await run(self.app, environ, start_response)
+            try:
+                iterator = iter(iterable)
+                chunk = await run(next, iterator, _DONE)
+                status, headers = response
+                await send({'type': 'http.response.start', 'status': status,
+                            'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                        for name, value in headers]})
+                while chunk is not _DONE:
+                    if chunk:
+                        await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                    chunk = await run(next, iterator, _DONE)
+                await send({'type': 'http.response.body', 'body': b''})
+            finally:
+                if hasattr(iterable, 'close'):
+                    await run(iterable.close)
+        finally:
+            self._waiting -= 1
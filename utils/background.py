@@ -0,0 +1,65 @@
+"""Periodic maintenance tasks run in daemon threads inside each worker.
+
+Threads do not survive a fork, so nothing is started at import time: the
+tasks are started by the first request a process serves, which also works
+for gunicorn with ``preload_app``.  The ASGI server (utils/asgi.py) calls
+`ensure_started` itself, since its async routes never reach Flask.
+"""
+import logging
+import os
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class PeriodicTasks:
+
+    def __init__(self, app=None):
+        self.app = None
+        self._tasks = []
+        self._pid = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Call before the init_app of any extension that adds tasks; each
+        create_app() registers its tasks again, into a fresh list."""
+        self.app = app
+        self._tasks = []
+        self._pid = None
+        app.before_request(self.ensure_started)
+        app.extensions['periodic_tasks'] = self
+
+    def add(self, name, interval, fn):
+        """Run `fn()` inside an app context every `interval` seconds; 0 disables it."""
+        if interval and interval > 0:
+            self._tasks.append((name, interval, fn))
+
+    def ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            for name, interval, fn in self._tasks:
+                thread = threading.Thread(target=self._run, args=(self.app, name, interval, fn),
+                                          name=f"periodic-{name}", daemon=True)
+                thread.start()
+
+    def _run(self, app, name, interval, fn):
+        # spread workers out so they do not all run the task at the same moment
+        time.sleep(random.uniform(0, interval))
+        while True:
+            try:
+                with app.app_context():
+                    fn()
+            except Exception:
+                logger.exception("periodic task %s failed", name)
+            time.sleep(interval)
+
+
+periodic = PeriodicTasks()
@@ -0,0 +1,153 @@
+"""Content-addressed storage for processed uploads.
+
+Processed images live once under ``static/uploads/blobs``, named by the
+sha256 of the stored JPEG, and are shared by every row that points at them.
+``upload_blob.ref_count`` counts those rows and the files go away with the
+last reference.
+
+Every change to a blob row is made before the matching file move or delete,
+inside the same transaction, so the database write lock (SQLite) or row lock
+(server databases) serializes concurrent uploads and deletes of the same
+content.
+"""
+import hashlib
+import os
+
+from sqlalchemy import delete, update
+
+from extensions import db
+from model.upload_blob import UploadBlob
+from utils.images import PROCESSING_VERSION, variant_paths
+
+BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+BLOB_DIR = 'static/uploads/blobs'
+
+
+def blob_path(digest):
+    return f"{BLOB_DIR}/{digest[:2]}/{digest}.jpg"
+
+
+def is_blob_path(path):
+    return bool(path) and path.startswith(BLOB_DIR + '/')
+
+
+def file_digest(abs_path):
+    h = hashlib.sha256()
+    with open(abs_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def source_key(raw_path, params=None):
+    """Hash of a raw upload plus everything that changes how it is processed."""
+    h = hashlib.sha256(f"{PROCESSING_VERSION}:{params or ''}:".encode('utf-8'))
+    with open(raw_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _abs(path):
+    return os.path.join(BASE_DIR, path)
+
+
+def _files_present(path):
+    return all(os.path.exists(_abs(p)) for p in [path] + variant_paths(path))
+
+
+def _remove_files(path):
+    for p in [path] + variant_paths(path):
+        try:
+            os.remove(_abs(p))
+        except OSError:
+            pass
+
+
+def _increment(digest):
+    result = db.session.execute(
+        update(UploadBlob)
+        .where(UploadBlob.hash == digest)
+        .values(ref_count=UploadBlob.ref_count + 1)
+    )
+    return result.rowcount == 1
+
+
+def acquire_source(key):
+    """Reference the blob already built from the same source, if there is one.
+
+    Returns the blob path, or None when the upload still has to be
+    processed.  The caller commits.
+    """
+    blob = UploadBlob.query.filter_by(source_hash=key).first()
+    if blob is None or not _increment(blob.hash):
+        return None
+    if not _files_present(blob.path):
+        # files lost underneath us, take the reference back and rebuild them
+        db.session.execute(
+            update(UploadBlob)
+            .where(UploadBlob.hash == blob.hash)
+            .values(ref_count=UploadBlob.ref_count - 1)
+        )
+        return None
+    return blob.path
+
+
+def add_staged(staged_path, digest, key):
+    """Reference the processed image at `staged_path` and return its blob path.
+
+    The staged file and its variants are moved into the store, or dropped
+    when the store already holds the same content.  The caller commits.
+    """
+    path = blob_path(digest)
+    if _increment(digest) and _files_present(path):
+        discard_staged(staged_path)
+        return path
+    if db.session.get(UploadBlob, digest) is None:
+        db.session.add(UploadBlob(
+            hash=digest,
+            source_hash=key,
+            path=path,
+            size=os.path.getsize(staged_path),
+            ref_count=1
+        ))
+        db.session.flush()
+    os.makedirs(os.path.dirname(_abs(path)), exist_ok=True)
+    # variants first, the main file marks the blob as complete
+    for staged, final in reversed(list(zip([staged_path] + variant_paths(staged_path),
+                                           [path] + variant_paths(path)))):
+        os.replace(staged, _abs(final))
+    return path
+
+
+def discard_staged(staged_path):
+    for p in [staged_path] + variant_paths(staged_path):
+        try:
+            os.remove(p)
+        except OSError:
+            pass
+
+
+def release(path):
+    """Drop one reference to a stored upload, deleting the files with the last one.
+
+    Uploads stored before the blob store existed are deleted directly.
+    Commits the current session.
+    """
+    if not path:
+        return
+    if not is_blob_path(path):
+        _remove_files(path)
+        return
+    digest = os.path.splitext(os.path.basename(path))[0]
+    db.session.execute(
+        update(UploadBlob)
+        .where(UploadBlob.hash == digest)
+        .values(ref_count=UploadBlob.ref_count - 1)
+    )
+    gone = db.session.execute(
+        delete(UploadBlob).where(UploadBlob.hash == digest, UploadBlob.ref_count <= 0)
+    ).rowcount
+    if gone:
+        _remove_files(path)
+    db.session.commit()
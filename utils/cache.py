@@ -0,0 +1,58 @@
+import threading
+import time
+
+
+class TTLCache:
+    """Small thread-safe in-process cache with a time-to-live per entry.
+
+    Each gunicorn worker keeps its own copy, so the ttl also bounds how long
+    another worker can serve a value after it was invalidated here.
+    """
+
+    def __init__(self, ttl=60, maxsize=1024):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._data[key]
+                return default
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            if len(self._data) >= self.maxsize and key not in self._data:
+                # drop the entry closest to expiry to make room
+                oldest = min(self._data, key=lambda k: self._data[k][0])
+                del self._data[oldest]
+            self._data[key] = (time.monotonic() + self.ttl, value)
+        return value
+
+    def get_or_set(self, key, factory):
+        value = self.get(key)
+        if value is None:
+            value = self.set(key, factory())
+        return value
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+# category and product payloads, cleared on every category or product write
+catalog_cache = TTLCache(ttl=60)
+
+# user_to_dict payloads by id, dropped on user update and delete
+user_cache = TTLCache(ttl=120, maxsize=4096)
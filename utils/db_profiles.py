@@ -0,0 +1,91 @@
+"""Database URL and connection pool settings per backend.
+
+The database is chosen with DATABASE_URL (falling back to the URI in
+app.py), and the pool is sized for the backend it points at.  SQLite keeps
+SQLAlchemy's defaults, because connections are file handles there.  MySQL
+and PostgreSQL get a bounded QueuePool:
+
+    DATABASE_URL=postgresql+psycopg://pos:secret@db/pos
+    DB_POOL_SIZE=5 DB_MAX_OVERFLOW=10 DB_POOL_RECYCLE=1800
+    DB_POOL_TIMEOUT=30 DB_POOL_PRE_PING=1
+
+Large listings (/invoice/list, /reports/sales/by) read with .yield_per(),
+which also asks for a server-side cursor (stream_results) on these backends.
+That way rows arrive in batches while the response streams, instead of the
+whole result set being buffered by the driver first.
+
+Every gunicorn worker has its own pool, so the server must accept
+workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW) connections.  See gunicorn.conf.py
+for disposing of pools inherited through fork.
+"""
+import os
+
+from sqlalchemy import func
+from sqlalchemy.engine import make_url
+
+SERVER_PROFILE = {
+    'pool_size': 5,
+    'max_overflow': 10,
+    # below MySQL's and most proxies' idle timeouts
+    'pool_recycle': 1800,
+    'pool_timeout': 30,
+    # one cheap round trip on checkout instead of a failed request after a
+    # database restart or failover
+    'pool_pre_ping': True,
+}
+
+PROFILES = {
+    'sqlite': {},
+    'postgresql': SERVER_PROFILE,
+    'mysql': SERVER_PROFILE,
+    'mariadb': SERVER_PROFILE,
+}
+
+ENV_OPTIONS = {
+    'DB_POOL_SIZE': ('pool_size', int),
+    'DB_MAX_OVERFLOW': ('max_overflow', int),
+    'DB_POOL_RECYCLE': ('pool_recycle', int),
+    'DB_POOL_TIMEOUT': ('pool_timeout', int),
+    'DB_POOL_PRE_PING': ('pool_pre_ping', lambda value: value.lower() in ('1', 'true', 'yes')),
+}
+
+
+def database_url(default):
+    url = os.environ.get('DATABASE_URL', default)
+    # Heroku style URLs, SQLAlchemy only knows the postgresql:// name
+    if url.startswith('postgres://'):
+        url = 'postgresql://' + url[len('postgres://'):]
+    return url
+
+
+def engine_options(url, overrides=None):
+    """Engine options for `url`: its backend profile, then DB_* from the
+    environment, then `overrides` (SQLALCHEMY_ENGINE_OPTIONS)."""
+    options = dict(PROFILES.get(make_url(url).get_backend_name(), {}))
+    if options:
+        for env_name, (option, convert) in ENV_OPTIONS.items():
+            if os.environ.get(env_name):
+                options[option] = convert(os.environ[env_name])
+    options.update(overrides or {})
+    return options
+
+
+def init_app(app):
+    """Resolve SQLALCHEMY_DATABASE_URI and SQLALCHEMY_ENGINE_OPTIONS; call
+    before SQLAlchemy(app)."""
+    url = database_url(app.config.get('SQLALCHEMY_DATABASE_URI', 'sqlite:///app.db'))
+    app.config['SQLALCHEMY_DATABASE_URI'] = url
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(
+        url, app.config.get('SQLALCHEMY_ENGINE_OPTIONS'))
+
+
+def date_bucket(column, period, dialect):
+    """`column` truncated to 'day', 'week' or 'month' as text in `dialect`'s SQL.
+
+    Weeks are '%Y-%W' (Monday based) on SQLite and ISO weeks elsewhere.
+    """
+    if dialect == 'postgresql':
+        return func.to_char(column, {'day': 'YYYY-MM-DD', 'week': 'IYYY-IW', 'month': 'YYYY-MM'}[period])
+    if dialect in ('mysql', 'mariadb'):
+        return func.date_format(column, {'day': '%Y-%m-%d', 'week': '%x-%v', 'month': '%Y-%m'}[period])
+    return func.strftime({'day': '%Y-%m-%d', 'week': '%Y-%W', 'month': '%Y-%m'}[period], column)
@@ -0,0 +1,235 @@
+"""Bounded background processing for uploaded images.
+
+Routes store the raw upload under the instance folder, commit the record
+with ``image_status = 'pending'`` and hand the file to a small process pool.
+When the job finishes the processed file is added to the blob store
+(utils/blob_store.py) and the record is switched to it with ``'ready'``
+(or ``'failed'``).  At most ``IMAGE_WORKERS + IMAGE_QUEUE_SIZE``
+jobs are accepted per worker process; beyond that routes answer 503.
+
+`mark_pending` also stores a job token in the row's ``image_job`` column.
+A finished job whose token is no longer the row's was superseded by a later
+upload and is dropped, so the newest upload wins whatever order the jobs end
+in.  Jobs die with their gunicorn worker (timeout, max_requests, deploy), so
+rows still pending after IMAGE_JOB_TIMEOUT seconds are marked failed by a
+periodic task; the raw file is then left to the sweeper.
+"""
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from uuid import uuid4
+
+from flask import has_app_context
+from sqlalchemy import update
+
+from utils.background import periodic
+from utils.images import process_upload
+from utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+STATUS_PENDING = 'pending'
+STATUS_READY = 'ready'
+STATUS_FAILED = 'failed'
+
+
+def new_job_token(now_ns=None):
+    """A token that sorts by submit time: zero padded nanoseconds, then a random part."""
+    now_ns = time.time_ns() if now_ns is None else now_ns
+    return f"{now_ns:020d}-{uuid4().hex[:8]}"
+
+
+def mark_pending(record):
+    """Flag `record` as waiting for a new image; returns the token to submit() with."""
+    record.image_status = STATUS_PENDING
+    record.image_job = new_job_token()
+    return record.image_job
+
+
+class ImageJobQueue:
+
+    def __init__(self, app=None):
+        self.app = None
+        self.workers = 2
+        self.queue_size = 16
+        self.raw_dir = None
+        self.job_timeout = 15 * 60
+        self.models = ()
+        self._executor = None
+        self._slots = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.workers = app.config.setdefault('IMAGE_WORKERS', 2)
+        self.queue_size = app.config.setdefault('IMAGE_QUEUE_SIZE', 16)
+        self.raw_dir = app.config.setdefault(
+            'IMAGE_RAW_DIR', os.path.join(app.instance_path, 'uploads_pending'))
+        self.job_timeout = app.config.setdefault('IMAGE_JOB_TIMEOUT', 15 * 60)
+        # created by the first upload (utils/uploads.py), not at startup
+        self._slots = threading.BoundedSemaphore(max(1, self.workers) + self.queue_size)
+        periodic.add('image-job-recovery', max(60, self.job_timeout // 3), self.fail_stale_jobs)
+        app.extensions['image_jobs'] = self
+
+    def fail_stale_jobs(self):
+        """Mark rows pending for longer than IMAGE_JOB_TIMEOUT as failed.
+
+        Their job was lost with the worker that ran it; the client can upload again.
+        """
+        from model import Category, Product, User
+
+        db = self.app.extensions['sqlalchemy']
+        cutoff = new_job_token(time.time_ns() - self.job_timeout * 10 ** 9)
+        for model in (Category, Product, User):
+            result = db.session.execute(
+                update(model)
+                .where(model.image_status == STATUS_PENDING, model.image_job < cutoff)
+                .values(image_status=STATUS_FAILED, image_job=None))
+            if result.rowcount:
+                logger.warning("%s %s image jobs lost, marked failed", result.rowcount, model.__name__)
+        db.session.commit()
+
+    def _get_executor(self):
+        # created lazily so each gunicorn worker gets its own pool after fork
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('spawn'))
+            return self._executor
+
+    def _reset_executor(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+    def reserve(self) -> bool:
+        """Claim a queue slot; False means the queue is full."""
+        return self._slots.acquire(blocking=False)
+
+    def release(self):
+        self._slots.release()
+
+    def discard(self, raw_path):
+        """Give back a reserved slot whose job will never be submitted."""
+        try:
+            os.remove(raw_path)
+        except OSError:
+            pass
+        self.release()
+
+    def submit(self, model, record_id, column, raw_path, watermark_text, token, on_ready=None):
+        """Process `raw_path` for `model.column` of row `record_id`.
+
+        Must be preceded by a successful `reserve()`, and `token` is what
+        `mark_pending` returned for the committed row.  An upload whose source
+        is already in the blob store is attached right away without being
+        processed again.  `on_ready` is called inside an app context after
+        the record has been updated.
+        """
+        from utils import blob_store
+
+        started = time.perf_counter()
+        key = blob_store.source_key(raw_path, watermark_text)
+        path = blob_store.acquire_source(key)
+        if path is not None:
+            os.remove(raw_path)
+            try:
+                self._finish(model, record_id, column, token, lambda: path, None, None, on_ready)
+            finally:
+                self.release()
+                metrics.observe('image_job_duration_seconds', ('deduplicated',), time.perf_counter() - started)
+            return
+
+        staged_path = os.path.join(self.raw_dir, f"{uuid4().hex}.jpg")
+
+        def done(digest=None, error=None):
+            try:
+                self._finish(model, record_id, column, token,
+                             lambda: blob_store.add_staged(staged_path, digest, key),
+                             lambda: blob_store.discard_staged(staged_path),
+                             error, on_ready)
+            finally:
+                self.release()
+                metrics.observe('image_job_duration_seconds', ('failed' if error else 'ready',),
+                                time.perf_counter() - started)
+
+        if self.workers <= 0:
+            # inline mode for development and CLI use
+            try:
+                digest = process_upload(raw_path, staged_path, watermark_text)
+            except Exception as e:
+                done(error=e)
+            else:
+                done(digest)
+            return
+
+        try:
+            future = self._get_executor().submit(process_upload, raw_path, staged_path, watermark_text)
+        except (BrokenProcessPool, RuntimeError) as e:
+            self._reset_executor()
+            done(error=e)
+            return
+
+        def callback(fut):
+            error = fut.exception()
+            if isinstance(error, BrokenProcessPool):
+                self._reset_executor()
+            done(None if error else fut.result(), error)
+
+        future.add_done_callback(callback)
+
+    def _finish(self, *args):
+        if has_app_context():
+            # inline mode, reuse the request's session
+            self._apply(*args)
+        else:
+            with self.app.app_context():
+                self._apply(*args)
+
+    def _apply(self, model, record_id, column, token, acquire, discard, error, on_ready):
+        from utils import blob_store
+
+        db = self.app.extensions['sqlalchemy']
+        # the row lock (FOR UPDATE where supported) keeps a newer upload from
+        # changing the token between the check and the commit
+        record = db.session.get(model, record_id, with_for_update=True)
+        if record is None or record.image_job != token or error:
+            if discard:
+                discard()
+            if record is None or record.image_job != token:
+                # row deleted, or a newer upload replaced this one meanwhile
+                db.session.rollback()
+                return
+            logger.error("image processing failed for %s %s: %s",
+                         model.__name__, record_id, error)
+            record.image_status = STATUS_FAILED
+            record.image_job = None
+            db.session.commit()
+            return
+        old_path = getattr(record, column)
+        setattr(record, column, acquire())
+        record.image_status = STATUS_READY
+        record.image_job = None
+        db.session.commit()
+        # also when the path is unchanged: acquire() took a reference of its own
+        blob_store.release(old_path)
+        if on_ready:
+            on_ready()
+
+
+def release_upload(storage_path):
+    """Drop a row's reference to its image, call after the row change is committed."""
+    from utils import blob_store
+
+    blob_store.release(storage_path)
+
+
+image_jobs = ImageJobQueue()
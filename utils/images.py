@@ -0,0 +1,123 @@
+"""Image processing run by the upload workers.
+
+Nothing in here may import the Flask app: these functions execute in the
+image worker processes (see utils/image_jobs.py).
+"""
+import hashlib
+import os
+
+# bump whenever the output for a given upload changes, it is part of the
+# dedup key in utils/blob_store.py
+PROCESSING_VERSION = 2
+# images above this many pixels are refused before decoding
+MAX_IMAGE_PIXELS = 40_000_000
+# longest side of the stored full-size image
+MAX_DIMENSION = 2048
+# longest side of each downscaled variant, every size is written as JPEG and WebP
+VARIANT_SIZES = (96, 256, 512)
+VARIANT_FORMATS = (('jpeg', '.jpg'), ('webp', '.webp'))
+
+
+def pil_image():
+    # Pillow is imported on first use, so the web process (which only needs
+    # the names and sizes above) does not load it at startup
+    from PIL import Image
+
+    # makes Pillow itself refuse to decode anything bigger, in case a file
+    # gets here without going through utils/uploads.py
+    Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+    return Image
+
+
+def variant_path(path, size, ext):
+    """`static/uploads/x/abc.jpg` -> `static/uploads/x/abc_256.webp`"""
+    stem, _ = os.path.splitext(path)
+    return f"{stem}_{size}{ext}"
+
+
+def variant_paths(path, sizes=VARIANT_SIZES):
+    paths = [os.path.splitext(path)[0] + '.webp']
+    for size in sizes:
+        for _, ext in VARIANT_FORMATS:
+            paths.append(variant_path(path, size, ext))
+    return paths
+
+
+def open_image(src_path, max_dimension=MAX_DIMENSION):
+    """Open and decode an image, never at more than `max_dimension` per side.
+
+    For JPEG the decoder is asked to scale down by 1/2, 1/4 or 1/8 while
+    decoding (`draft`), which is much cheaper than decoding at full size and
+    resizing afterwards.
+    """
+    Image = pil_image()
+    img = Image.open(src_path)
+    if img.size[0] * img.size[1] > MAX_IMAGE_PIXELS:
+        raise Image.DecompressionBombError(f"{img.size} exceeds {MAX_IMAGE_PIXELS} pixels")
+    if img.format == 'JPEG' and max(img.size) > max_dimension:
+        img.draft('RGB', (max_dimension, max_dimension))
+    if max(img.size) > max_dimension:
+        img.thumbnail((max_dimension, max_dimension), reducing_gap=3.0)
+    else:
+        img.load()
+    return img
+
+
+def flatten(img, background=(255, 255, 255)):
+    """Convert to RGB, putting any transparency on a solid background."""
+    if img.mode == 'RGB':
+        return img
+    if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
+        img = img.convert('RGBA')
+        base = pil_image().new('RGB', img.size, background)
+        base.paste(img, mask=img.getchannel('A'))
+        return base
+    return img.convert('RGB')
+
+
+def _save(img, out_path, fmt):
+    # write to a temp name so readers never see a half-written file
+    tmp_path = out_path + '.tmp'
+    if fmt == 'jpeg':
+        img.save(tmp_path, format='JPEG', quality=85, optimize=True)
+    else:
+        img.save(tmp_path, format='WEBP', quality=80, method=4)
+    os.replace(tmp_path, out_path)
+
+
+def save_variants(img, out_path, sizes=VARIANT_SIZES):
+    """Write the WebP copy of `img` and every downscaled variant next to `out_path`.
+
+    Variants are produced largest first, each from the previous one, so
+    every step only has to reduce an already small image.
+    """
+    _save(img, os.path.splitext(out_path)[0] + '.webp', 'webp')
+    current = img.copy()
+    for size in sorted(sizes, reverse=True):
+        current.thumbnail((size, size), reducing_gap=2.0)
+        for fmt, ext in VARIANT_FORMATS:
+            _save(current, variant_path(out_path, size, ext), fmt)
+
+
+def process_upload(raw_path, out_path, watermark_text=None):
+    """Worker entry point: build the stored image and its variants, then drop the raw upload.
+
+    Returns the sha256 of the stored image, which names it in the blob store.
+    """
+    try:
+        img = open_image(raw_path)
+        if watermark_text:
+            from utils.watermark import apply_watermark
+
+            img = apply_watermark(img, watermark_text)
+        img = flatten(img)
+        save_variants(img, out_path)
+        # the main file goes last, once it exists every variant exists too
+        _save(img, out_path, 'jpeg')
+        with open(out_path, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    finally:
+        try:
+            os.remove(raw_path)
+        except OSError:
+            pass
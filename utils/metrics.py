@@ -0,0 +1,310 @@
+"""Prometheus metrics aggregated over all gunicorn workers.
+
+Each worker counts in memory, one locked dict update per request,
+and writes a snapshot to METRICS_DIR/<pid>.json every METRICS_FLUSH_INTERVAL
+seconds.  GET /metrics flushes the serving worker, then adds up every
+snapshot and answers in the Prometheus text format:
+
+    http_requests_total{method, route, status}
+    http_request_duration_seconds{method, route, status}   histogram
+    http_requests_in_flight
+    db_pool_size, db_pool_checked_out, db_pool_overflow
+    image_job_duration_seconds{result}                      histogram
+
+Metrics are off unless METRICS is set.  /metrics then answers requests
+with ``Authorization: Bearer <METRICS_TOKEN>``, or without a token only
+loopback clients; behind a local reverse proxy set TRUSTED_PROXIES, or every
+client looks like one.
+
+Counters and histograms of workers that have exited are folded into
+_retired.json so totals keep growing across worker restarts.  A worker has
+exited when its pid is gone, or is now another process: each snapshot holds
+its worker's start time from /proc.  Gauges only count live workers.
+"""
+import atexit
+import bisect
+import fcntl
+import hmac
+import json
+import os
+import threading
+import time
+
+from functools import wraps
+
+from flask import Response, request
+from werkzeug.wsgi import ClosingIterator
+
+from utils.background import periodic
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+IMAGE_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# name -> (type, help, label names, buckets)
+METRICS = {
+    'http_requests_total': (
+        'counter', 'Requests handled.', ('method', 'route', 'status'), None),
+    'http_request_duration_seconds': (
+        'histogram', 'Time from routing to the response being returned.',
+        ('method', 'route', 'status'), LATENCY_BUCKETS),
+    'http_requests_in_flight': (
+        'gauge', 'Requests being handled right now.', (), None),
+    'db_pool_size': (
+        'gauge', 'Connections the pools keep open.', (), None),
+    'db_pool_checked_out': (
+        'gauge', 'Pooled connections in use.', (), None),
+    'db_pool_overflow': (
+        'gauge', 'Connections opened beyond the pool size.', (), None),
+    'image_job_duration_seconds': (
+        'histogram', 'Time from submitting an upload to its record being updated.',
+        ('result',), IMAGE_BUCKETS),
+}
+
+RETIRED = '_retired.json'
+
+
+class Metrics:
+
+    def __init__(self, app=None):
+        self.app = None
+        self.directory = None
+        self.flush_interval = 10
+        self._values = {}
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        if not app.config.setdefault('METRICS', False):
+            return
+        self.directory = app.config.setdefault('METRICS_DIR', os.path.join(app.instance_path, 'metrics'))
+        self.flush_interval = app.config.setdefault('METRICS_FLUSH_INTERVAL', 10)
+        app.wsgi_app = self._wrap(app.wsgi_app)
+        app.after_request(self._finish)
+        app.add_url_rule('/metrics', 'metrics', self.view)
+        periodic.add('metrics-flush', self.flush_interval, self.flush)
+        atexit.register(self.flush)
+        app.extensions['metrics'] = self
+
+    # recording
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        """Add `value` to histogram `name`: [per-bucket counts..., +Inf, sum]."""
+        buckets = METRICS[name][3]
+        key = (name, labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [0] * (len(buckets) + 2)
+            entry[bisect.bisect_left(buckets, value)] += 1
+            entry[-1] += value
+
+    def _wrap(self, wsgi_app):
+        # plain WSGI, so the per-request cost stays free of Flask's context proxies
+        @wraps(wsgi_app)
+        def middleware(environ, start_response):
+            environ['metrics.started'] = time.perf_counter()
+            with self._lock:
+                self._in_flight += 1
+            try:
+                body = wsgi_app(environ, start_response)
+            except BaseException:
+                self._request_done()
+                raise
+            # a streamed body is still being produced after the call returns,
+            # the server closes it once the last chunk is sent
+            return ClosingIterator(body, self._request_done)
+
+        return middleware
+
+    def _request_done(self):
+        with self._lock:
+            self._in_flight -= 1
+
+    def _finish(self, response):
+        req = request._get_current_object()
+        started = req.environ.get('metrics.started')
+        if started is None:
+            return response
+        duration = time.perf_counter() - started
+        rule = req.url_rule
+        key = ('http_request_duration_seconds',
+               (req.method, rule.rule if rule is not None else 'unmatched', str(response.status_code)))
+        bucket = bisect.bisect_left(LATENCY_BUCKETS, duration)
+        # one lock round trip per request; http_requests_total is derived from the count
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [0] * (len(LATENCY_BUCKETS) + 2)
+            entry[bucket] += 1
+            entry[-1] += duration
+        return response
+
+    # snapshots
+
+    def _gauges(self):
+        gauges = {'http_requests_in_flight': self._in_flight}
+        db = self.app.extensions.get('sqlalchemy')
+        if db is not None:
+            with self.app.app_context():
+                pools = [engine.pool for engine in db.engines.values()]
+            for name, method in (('db_pool_size', 'size'), ('db_pool_checked_out', 'checkedout'),
+                                 ('db_pool_overflow', 'overflow')):
+                # NullPool and friends have no size to report
+                gauges[name] = sum(max(0, getattr(pool, method)()) for pool in pools
+                                   if hasattr(pool, method))
+        return gauges
+
+    def snapshot(self):
+        with self._lock:
+            values = [[name, list(labels), list(value) if isinstance(value, list) else value]
+                      for (name, labels), value in self._values.items()]
+        return {'time': time.time(), 'started': _process_start(os.getpid()),
+                'values': values, 'gauges': self._gauges()}
+
+    def flush(self):
+        if not self.directory:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"{os.getpid()}.json")
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmp_path, path)
+
+    def _is_live(self, pid, snapshot):
+        if pid == os.getpid():
+            return True
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        # a busy worker may not have flushed for a while, only a reused pid
+        # (started at another time) means the snapshot's worker has exited
+        started = snapshot.get('started')
+        return started is None or started == _process_start(pid)
+
+    def collect(self):
+        """Sum of every worker's snapshot: ({(name, labels): value}, {gauge: value})."""
+        self.flush()
+        totals = {}
+        gauges = {}
+        with open(os.path.join(self.directory, '.lock'), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            retired_path = os.path.join(self.directory, RETIRED)
+            retired = _read(retired_path) or {'time': 0, 'values': [], 'gauges': {}}
+            retiring = []
+            for filename in os.listdir(self.directory):
+                pid = filename[:-len('.json')]
+                if not filename.endswith('.json') or not pid.isdigit():
+                    continue
+                snapshot = _read(os.path.join(self.directory, filename))
+                if snapshot is None:
+                    continue
+                if self._is_live(int(pid), snapshot):
+                    _merge(totals, snapshot['values'])
+                    for name, value in snapshot['gauges'].items():
+                        gauges[name] = gauges.get(name, 0) + value
+                else:
+                    retiring.append((filename, snapshot))
+            if retiring:
+                merged = _merge({}, retired['values'])
+                for _, snapshot in retiring:
+                    _merge(merged, snapshot['values'])
+                retired['values'] = [[name, list(labels), value] for (name, labels), value in merged.items()]
+                with open(retired_path + '.tmp', 'w') as f:
+                    json.dump(retired, f)
+                os.replace(retired_path + '.tmp', retired_path)
+                for filename, _ in retiring:
+                    os.remove(os.path.join(self.directory, filename))
+            _merge(totals, retired['values'])
+        return totals, gauges
+
+    def render(self):
+        totals, gauges = self.collect()
+        # the request counter is the latency histogram's count
+        for (metric, labels), value in list(totals.items()):
+            if metric == 'http_request_duration_seconds':
+                totals[('http_requests_total', labels)] = sum(value[:-1])
+        lines = []
+        for name, (kind, help_text, label_names, buckets) in METRICS.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == 'gauge':
+                lines.append(f"{name} {gauges.get(name, 0)}")
+                continue
+            for (metric, labels), value in sorted(totals.items()):
+                if metric != name:
+                    continue
+                pairs = [f'{label}="{_escape(v)}"' for label, v in zip(label_names, labels)]
+                if kind == 'counter':
+                    lines.append(f"{name}{_labels(pairs)} {value}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets + (float('inf'),), value[:-1]):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    le_pair = 'le="%s"' % le
+                    lines.append(f"{name}_bucket{_labels(pairs + [le_pair])} {cumulative}")
+                lines.append(f"{name}_sum{_labels(pairs)} {value[-1]}")
+                lines.append(f"{name}_count{_labels(pairs)} {cumulative}")
+        return '\n'.join(lines) + '\n'
+
+    def view(self):
+        token = self.app.config.get('METRICS_TOKEN')
+        if token:
+            if not hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {token}"):
+                return {"error": "Authentication required"}, 401
+        elif request.remote_addr not in ('127.0.0.1', '::1'):
+            return {"error": "Set METRICS_TOKEN to scrape metrics from other hosts"}, 403
+        return Response(self.render(), mimetype='text/plain; version=0.0.4')
+
+
+def _process_start(pid):
+    """Start time of `pid` in clock ticks after boot, None where /proc is missing."""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # the command name may contain spaces, the fields after it do not
+            return int(f.read().rsplit(')', 1)[1].split()[19])
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _merge(totals, values):
+    """Add snapshot `values` into `totals`, histograms element-wise."""
+    for name, labels, value in values:
+        key = (name, tuple(labels))
+        if isinstance(value, list):
+            current = totals.get(key)
+            totals[key] = value if current is None else [a + b for a, b in zip(current, value)]
+        else:
+            totals[key] = totals.get(key, 0) + value
+    return totals
+
+
+def _labels(pairs):
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+metrics = Metrics()
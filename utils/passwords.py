@@ -0,0 +1,211 @@
+"""Password hashing off the request workers' CPU budget.
+
+Verifying a password costs tens of milliseconds of pure CPU.  At shift start
+hundreds of logins arrive at once, so every hash runs on a small dedicated
+thread pool (hashlib releases the GIL while it works) and needs one of
+PASSWORD_QUEUE_SIZE slots shared by all workers: a slot is an flock()ed
+file under instance/password-slots, released by the kernel should the worker
+die.  When every slot is taken the login is refused with 503 right away
+instead of piling up.
+
+Repeated failures per user name and per client IP are refused before any
+hashing happens.  The counters live in the ``login_failure`` table, so the
+limits hold across workers; behind reverse proxies the client IP is only
+right with TRUSTED_PROXIES set, see app.py.
+"""
+import fcntl
+import hashlib
+import os
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from datetime import datetime, timedelta
+
+from sqlalchemy import case, delete, select
+from sqlalchemy.exc import IntegrityError
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from utils.background import periodic
+
+
+class VerifierBusy(Exception):
+    """The password pool is saturated, the caller should answer 503."""
+
+
+class PasswordHasher:
+
+    def __init__(self, app=None):
+        self.method = 'scrypt'
+        self.workers = 2
+        self.queue_size = 32
+        self.timeout = 5
+        self.slot_dir = None
+        self._executor = None
+        self._pid = None
+        self._method_prefix = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.method = app.config.setdefault('PASSWORD_HASH_METHOD', 'scrypt')
+        self.workers = app.config.setdefault('PASSWORD_WORKERS', 2)
+        self.queue_size = app.config.setdefault('PASSWORD_QUEUE_SIZE', 32)
+        self.timeout = app.config.setdefault('PASSWORD_TIMEOUT', 5)
+        self.slot_dir = os.path.join(app.instance_path, 'password-slots')
+        os.makedirs(self.slot_dir, exist_ok=True)
+        app.extensions['password_hasher'] = self
+
+    def _get_executor(self):
+        # one pool per process, a pool inherited through fork has no threads
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=self.workers,
+                                                    thread_name_prefix='password')
+                self._pid = os.getpid()
+            return self._executor
+
+    def _acquire_slot(self):
+        """An open file holding one of the shared slots, None when all are taken."""
+        first = random.randrange(self.queue_size)
+        for n in range(self.queue_size):
+            slot = open(os.path.join(self.slot_dir, str((first + n) % self.queue_size)), 'a')
+            try:
+                fcntl.flock(slot, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return slot
+            except BlockingIOError:
+                slot.close()
+        return None
+
+    def _run(self, fn, *args):
+        slot = self._acquire_slot()
+        if slot is None:
+            raise VerifierBusy()
+        try:
+            future = self._get_executor().submit(fn, *args)
+        except BaseException:
+            slot.close()
+            raise
+        # a hash that outlives the timeout keeps its slot until it is done
+        future.add_done_callback(lambda _: slot.close())
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            raise VerifierBusy()
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, pwhash, password):
+        """True when `password` matches; raises VerifierBusy when saturated."""
+        try:
+            return self._run(check_password_hash, pwhash, password)
+        except VerifierBusy:
+            raise
+        except Exception:
+            # unknown hash format and the like
+            return False
+
+    def needs_rehash(self, pwhash):
+        """True when `pwhash` was made with other parameters than PASSWORD_HASH_METHOD."""
+        if self._method_prefix is None:
+            # e.g. 'scrypt' -> 'scrypt:32768:8:1', resolved once from a throwaway hash
+            self._method_prefix = generate_password_hash('', self.method).split('$', 1)[0]
+        return pwhash.split('$', 1)[0] != self._method_prefix
+
+
+def _throttle_key(kind, value):
+    key = f"{kind}:{value}"
+    # user names come straight from the login form
+    return key if len(key) <= 160 else f"{kind}#" + hashlib.sha256(value.encode('utf-8')).hexdigest()
+
+
+class LoginThrottle:
+    """Fixed-window failure counters per user name and per client address."""
+
+    def __init__(self, app=None):
+        self.app = None
+        self.window = 15 * 60
+        self.max_per_user = 5
+        self.max_per_ip = 20
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.window = app.config.setdefault('LOGIN_FAILURE_WINDOW', 15 * 60)
+        self.max_per_user = app.config.setdefault('LOGIN_MAX_FAILURES_PER_USER', 5)
+        self.max_per_ip = app.config.setdefault('LOGIN_MAX_FAILURES_PER_IP', 20)
+        periodic.add('login-failure-purge', self.window, self.purge)
+        app.extensions['login_throttle'] = self
+
+    @property
+    def _engine(self):
+        # the primary, outside the request's session and its transaction
+        return self.app.extensions['sqlalchemy'].engine
+
+    def _keys(self, user_name, remote_addr):
+        return ((_throttle_key('user', user_name), self.max_per_user),
+                (_throttle_key('ip', remote_addr or ''), self.max_per_ip))
+
+    def retry_after(self, user_name, remote_addr):
+        """Seconds until another attempt is allowed, 0 when it is allowed now."""
+        from model import LoginFailure
+
+        limits = dict(self._keys(user_name, remote_addr))
+        now = datetime.utcnow()
+        with self._engine.connect() as conn:
+            rows = conn.execute(
+                select(LoginFailure.key, LoginFailure.count, LoginFailure.window_end)
+                .where(LoginFailure.key.in_(limits), LoginFailure.window_end > now)
+            ).all()
+        wait = 0
+        for key, count, window_end in rows:
+            if count >= limits[key]:
+                wait = max(wait, int((window_end - now).total_seconds()) + 1)
+        return wait
+
+    def failed(self, user_name, remote_addr):
+        from model import LoginFailure
+
+        table = LoginFailure.__table__
+        now = datetime.utcnow()
+        window_end = now + timedelta(seconds=self.window)
+        expired = table.c.window_end <= now
+        for key, _ in self._keys(user_name, remote_addr):
+            for attempt in (1, 2):
+                try:
+                    with self._engine.begin() as conn:
+                        # one statement, so concurrent failures in other workers all count;
+                        # count is set first, MySQL evaluates SET left to right
+                        counted = conn.execute(
+                            table.update().where(table.c.key == key).ordered_values(
+                                (table.c.count, case((expired, 1), else_=table.c.count + 1)),
+                                (table.c.window_end, case((expired, window_end), else_=table.c.window_end)),
+                            )).rowcount
+                        if not counted:
+                            conn.execute(table.insert().values(key=key, count=1, window_end=window_end))
+                    break
+                except IntegrityError:
+                    # another worker inserted the first failure meanwhile, count on top of it
+                    if attempt == 2:
+                        raise
+
+    def succeeded(self, user_name):
+        from model import LoginFailure
+
+        with self._engine.begin() as conn:
+            conn.execute(delete(LoginFailure).where(LoginFailure.key == _throttle_key('user', user_name)))
+
+    def purge(self):
+        """Delete the counters of windows that are over."""
+        from model import LoginFailure
+
+        with self._engine.begin() as conn:
+            conn.execute(delete(LoginFailure).where(LoginFailure.window_end <= datetime.utcnow()))
+
+
+password_hasher = PasswordHasher()
+login_throttle = LoginThrottle()
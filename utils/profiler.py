@@ -0,0 +1,292 @@
+"""Profile single requests on demand.
+
+Off unless PROFILER_SECRET is set; then a WSGI wrapper profiles a request
+(cProfile call tree, wall and CPU time, every SQL statement with its
+duration) when either
+
+* it carries a signed header, valid for one path until it expires:
+
+      X-Profile: <expires>:<hex HMAC-SHA256(secret, "<expires>:<path>")>
+
+  which ``flask profiler sign /invoice/list`` prints, or
+* sampling has been switched on with POST /admin/profiler
+  {"sample_rate": 0.01, "minutes": 10}.  The setting lives in
+  PROFILER_DIR/_sampling.json so every worker picks it up within
+  SAMPLING_RELOAD seconds, and it switches itself off when the time is up.
+
+Profiles go to PROFILER_DIR as <id>.prof (pstats, for snakeviz and
+friends) and <id>.json (timings, SQL, the top of the call tree), keeping the
+newest PROFILER_MAX_PROFILES.  GET /admin/profiles lists them,
+/admin/profiles/<id> shows one and /admin/profiles/<id>/pstats downloads the
+dump.  The admin routes want ``Authorization: Bearer <PROFILER_SECRET>``.
+
+A request that is not profiled costs a header lookup and a clock read.
+The body of a streamed response is produced after the wrapper returns, so
+only the work done before streaming starts is in its profile.
+"""
+import cProfile
+import hashlib
+import hmac
+import io
+import itertools
+import json
+import logging
+import os
+import pstats
+import random
+import re
+import time
+from functools import wraps
+
+import click
+from flask import request, send_file
+
+from utils.sql_stats import recording
+
+logger = logging.getLogger(__name__)
+
+SAMPLING = '_sampling.json'
+SAMPLING_RELOAD = 5  # seconds
+MAX_SQL_STATEMENTS = 500
+TOP_FUNCTIONS = 40
+_PROFILE_ID = re.compile(r'^\d+-\d+-\d+$')
+
+
+def sign(secret, path, expires):
+    digest = hmac.new(secret.encode(), f"{expires}:{path}".encode(), hashlib.sha256).hexdigest()
+    return f"{expires}:{digest}"
+
+
+class RequestProfiler:
+
+    def __init__(self, app=None):
+        self.app = None
+        self.secret = None
+        self.directory = None
+        self.max_profiles = 50
+        self._sample_rate = 0.0
+        self._next_reload = 0.0
+        self._sequence = itertools.count()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.secret = app.config.setdefault('PROFILER_SECRET', os.environ.get('PROFILER_SECRET'))
+        self.directory = app.config.setdefault('PROFILER_DIR', os.path.join(app.instance_path, 'profiles'))
+        self.max_profiles = app.config.setdefault('PROFILER_MAX_PROFILES', 50)
+        app.cli.add_command(profiler_cli)
+        if not self.secret:
+            # nothing is installed, so requests pay nothing
+            return
+        app.wsgi_app = self._wrap(app.wsgi_app)
+        app.add_url_rule('/admin/profiler', 'profiler_sampling', self.sampling_view, methods=['GET', 'POST'])
+        app.add_url_rule('/admin/profiles', 'profile_list', self.list_view)
+        app.add_url_rule('/admin/profiles/<profile_id>', 'profile_detail', self.detail_view)
+        app.add_url_rule('/admin/profiles/<profile_id>/pstats', 'profile_pstats', self.pstats_view)
+        app.extensions['request_profiler'] = self
+
+    # triggering
+
+    def _wrap(self, wsgi_app):
+        @wraps(wsgi_app)
+        def middleware(environ, start_response):
+            header = environ.get('HTTP_X_PROFILE')
+            if header is not None:
+                if self._valid(header, environ.get('PATH_INFO', '')):
+                    return self._profile(wsgi_app, environ, start_response, 'header')
+            else:
+                now = time.monotonic()
+                if now >= self._next_reload:
+                    self._reload_sampling(now)
+                if self._sample_rate and random.random() < self._sample_rate:
+                    return self._profile(wsgi_app, environ, start_response, 'sample')
+            return wsgi_app(environ, start_response)
+
+        return middleware
+
+    def _valid(self, header, path):
+        expires, _, _ = header.partition(':')
+        if not expires.isdigit() or int(expires) < time.time():
+            return False
+        return hmac.compare_digest(header, sign(self.secret, path, int(expires)))
+
+    def _reload_sampling(self, now):
+        self._next_reload = now + SAMPLING_RELOAD
+        setting = _read(os.path.join(self.directory, SAMPLING))
+        if setting is None or setting['until'] < time.time():
+            self._sample_rate = 0.0
+        else:
+            self._sample_rate = setting['sample_rate']
+
+    def set_sampling(self, sample_rate, minutes):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, SAMPLING)
+        setting = {'sample_rate': sample_rate, 'until': time.time() + minutes * 60}
+        with open(path + '.tmp', 'w') as f:
+            json.dump(setting, f)
+        os.replace(path + '.tmp', path)
+        self._reload_sampling(time.monotonic())
+        return setting
+
+    # profiling
+
+    def _profile(self, wsgi_app, environ, start_response, trigger):
+        statuses = []
+
+        def capture_status(status, headers, exc_info=None):
+            statuses.append(status)
+            return start_response(status, headers, exc_info)
+
+        profiler = cProfile.Profile()
+        started = time.time()
+        wall_started = time.perf_counter()
+        cpu_started = time.thread_time()
+        with recording(keep_log=True) as recorder:
+            profiler.enable()
+            try:
+                return wsgi_app(environ, capture_status)
+            finally:
+                profiler.disable()
+                timings = {
+                    'wall_ms': round((time.perf_counter() - wall_started) * 1000, 3),
+                    'cpu_ms': round((time.thread_time() - cpu_started) * 1000, 3),
+                }
+                try:
+                    self._save(profiler, recorder, environ, statuses, trigger, started, timings)
+                except OSError:
+                    logger.exception("could not store the profile of %s", environ.get('PATH_INFO'))
+
+    def _save(self, profiler, recorder, environ, statuses, trigger, started, timings):
+        os.makedirs(self.directory, exist_ok=True)
+        profile_id = f"{int(started * 1000)}-{os.getpid()}-{next(self._sequence)}"
+        base = os.path.join(self.directory, profile_id)
+        profiler.dump_stats(base + '.prof')
+
+        top = io.StringIO()
+        pstats.Stats(profiler, stream=top).sort_stats('cumulative').print_stats(TOP_FUNCTIONS)
+        statements = [{'ms': round(duration * 1000, 3), 'statement': statement}
+                      for duration, statement in recorder.log[:MAX_SQL_STATEMENTS]]
+        meta = {
+            'id': profile_id,
+            'time': started,
+            'trigger': trigger,
+            'method': environ.get('REQUEST_METHOD'),
+            'path': environ.get('PATH_INFO'),
+            'query_string': environ.get('QUERY_STRING', ''),
+            'status': int(statuses[-1].split()[0]) if statuses else None,
+            **timings,
+            'sql': {
+                'queries': recorder.count,
+                'ms': round(recorder.duration * 1000, 3),
+                'statements': statements,
+            },
+            'top': top.getvalue(),
+        }
+        with open(base + '.json.tmp', 'w') as f:
+            json.dump(meta, f)
+        os.replace(base + '.json.tmp', base + '.json')
+        self._trim()
+
+    def _profile_ids(self):
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        ids = [name[:-len('.json')] for name in names
+               if name.endswith('.json') and _PROFILE_ID.match(name[:-len('.json')])]
+        return sorted(ids, key=lambda profile_id: tuple(map(int, profile_id.split('-'))))
+
+    def _trim(self):
+        ids = self._profile_ids()
+        for profile_id in ids[:max(0, len(ids) - self.max_profiles)]:
+            for suffix in ('.json', '.prof'):
+                try:
+                    os.remove(os.path.join(self.directory, profile_id + suffix))
+                except FileNotFoundError:
+                    # trimmed by another worker at the same time
+                    pass
+
+    # admin views
+
+    def _authorized(self):
+        return hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {self.secret}")
+
+    def _meta(self, profile_id):
+        if not _PROFILE_ID.match(profile_id):
+            return None
+        return _read(os.path.join(self.directory, profile_id + '.json'))
+
+    def sampling_view(self):
+        if not self._authorized():
+            return {"error": "Authentication required"}, 401
+        if request.method == 'POST':
+            data = request.get_json(silent=True) or {}
+            try:
+                sample_rate = float(data.get('sample_rate', 0))
+                minutes = float(data.get('minutes', 10))
+            except (TypeError, ValueError):
+                return {"error": "sample_rate and minutes must be numbers"}, 400
+            if not 0 <= sample_rate <= 1 or minutes <= 0:
+                return {"error": "sample_rate must be between 0 and 1, minutes positive"}, 400
+            return self.set_sampling(sample_rate, minutes)
+        setting = _read(os.path.join(self.directory, SAMPLING)) or {'sample_rate': 0.0, 'until': None}
+        if setting['until'] is not None and setting['until'] < time.time():
+            setting['sample_rate'] = 0.0
+        return setting
+
+    def list_view(self):
+        if not self._authorized():
+            return {"error": "Authentication required"}, 401
+        profiles = []
+        for profile_id in reversed(self._profile_ids()):
+            meta = _read(os.path.join(self.directory, profile_id + '.json'))
+            if meta is None:
+                continue
+            profiles.append({key: meta[key] for key in (
+                'id', 'time', 'trigger', 'method', 'path', 'status', 'wall_ms', 'cpu_ms')})
+            profiles[-1]['queries'] = meta['sql']['queries']
+        return {'profiles': profiles}
+
+    def detail_view(self, profile_id):
+        if not self._authorized():
+            return {"error": "Authentication required"}, 401
+        return self._meta(profile_id) or ({"error": "Profile not found"}, 404)
+
+    def pstats_view(self, profile_id):
+        if not self._authorized():
+            return {"error": "Authentication required"}, 401
+        if self._meta(profile_id) is None:
+            return {"error": "Profile not found"}, 404
+        return send_file(os.path.join(self.directory, profile_id + '.prof'),
+                         mimetype='application/octet-stream', as_attachment=True,
+                         download_name=f"{profile_id}.prof")
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+@click.group('profiler')
+def profiler_cli():
+    """On-demand request profiling."""
+
+
+@profiler_cli.command('sign')
+@click.argument('path')
+@click.option('--ttl', default=300, type=int, help='Seconds the header stays valid.')
+def sign_command(path, ttl):
+    """Print an X-Profile header that profiles requests to PATH."""
+    from flask import current_app
+
+    secret = current_app.config.get('PROFILER_SECRET')
+    if not secret:
+        raise click.ClickException('PROFILER_SECRET is not set')
+    click.echo(f"X-Profile: {sign(secret, path, int(time.time()) + ttl)}")
+
+
+request_profiler = RequestProfiler()
@@ -0,0 +1,259 @@
+"""Query plan checks for the hot endpoints: ``flask plans check``.
+
+Each entry of HOT_QUERIES requests one endpoint through the test client,
+so the SQL is exactly what the route runs.  It captures the SELECTs, asks
+the database for their plans and compares them with what is declared:
+
+* `indexes` must all appear in the plans,
+* a table read in full (SQLite ``SCAN t`` without an index, PostgreSQL
+  ``Seq Scan``) fails unless it is listed in `full_scans`,
+* a temporary b-tree or sort fails unless its purpose ('GROUP BY' or
+  'ORDER BY') is listed in `temp`,
+* the request may run at most `max_queries` statements of any kind
+  (utils/sql_stats.query_budget), so an N+1 loop fails as well.
+
+Wrapping sale.date_time in a function in /invoice/list, for instance, makes
+its plan a full scan with a temp b-tree for ORDER BY, and the check fails:
+
+    flask plans check           # against the configured database
+    flask plans check --fresh   # a throwaway SQLite database with generated data
+
+On PostgreSQL the plans are taken with enable_seqscan and enable_sort off.
+The planner then picks an index whenever one can answer the query at all,
+so a small test database does not hide a missing index behind a cheap
+sequential scan.
+"""
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+from collections import namedtuple
+from datetime import date
+
+import click
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from utils.sql_stats import query_budget
+
+PlanExpectation = namedtuple('PlanExpectation', 'name method path body indexes full_scans temp max_queries')
+PlanExpectation.__new__.__defaults__ = (None, (), (), (), None)
+
+HOT_QUERIES = (
+    PlanExpectation('invoice list', 'GET', '/invoice/list',
+                    indexes=('ix_sale_date_time_total',), max_queries=1),
+    # sale, its items and its customer
+    PlanExpectation('invoice detail', 'GET', '/invoice/{sale_id}',
+                    indexes=('ix_sale_item_sale_id_product_id_qty_total',), max_queries=3),
+    PlanExpectation('daily report', 'GET', '/reports/sales/daily',
+                    indexes=('ix_sale_date_time_total',), temp=('GROUP BY', 'ORDER BY'), max_queries=1),
+    PlanExpectation('weekly report', 'GET', '/reports/sales/weekly',
+                    indexes=('ix_sale_date_time_total',), temp=('GROUP BY', 'ORDER BY'), max_queries=1),
+    PlanExpectation('monthly report', 'GET', '/reports/sales/monthly',
+                    indexes=('ix_sale_date_time_total',), temp=('GROUP BY', 'ORDER BY'), max_queries=1),
+    PlanExpectation('sales by user', 'GET', '/reports/sales/by?user_id={user_id}',
+                    indexes=('ix_sale_user_id',), max_queries=1),
+    PlanExpectation('product list', 'GET', '/product/list',
+                    full_scans=('product',), max_queries=1),
+    PlanExpectation('category stats', 'GET', '/category/list?stats=1',
+                    indexes=('ix_product_category_id_name',), full_scans=('category',), max_queries=2),
+    # throttle lookup, user lookup and the two failure counters, each an
+    # UPDATE plus the INSERT of a first failure
+    PlanExpectation('login lookup', 'POST', '/login', body={'user_name': 'cashier{user_id}', 'password': '-'},
+                    indexes=('ix_user_user_name',), max_queries=6),
+)
+
+# SQLite: "SCAN sale", "SCAN sale USING COVERING INDEX ix", "SEARCH sale USING INDEX ix (a=?)"
+_SQLITE_ACCESS = re.compile(r'^(SCAN|SEARCH) (\S+)(?: AS \S+)?(?: USING (?:COVERING )?INDEX (\S+))?')
+_SQLITE_TEMP = re.compile(r'USE TEMP B-TREE FOR (?:(?:RIGHT PART OF |LAST \d+ TERMS OF )?)(GROUP BY|ORDER BY|DISTINCT)')
+
+
+class Plan:
+    """What a plan does, reduced to the facts the expectations talk about."""
+
+    def __init__(self, statement, lines):
+        self.statement = statement
+        self.lines = lines
+        self.indexes = set()
+        self.full_scans = set()
+        self.temp = set()
+
+    def __str__(self):
+        return '\n'.join(self.lines)
+
+
+def sqlite_plan(conn, statement, parameters):
+    rows = conn.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters).all()
+    plan = Plan(statement, [row[-1] for row in rows])
+    for detail in plan.lines:
+        access = _SQLITE_ACCESS.match(detail)
+        if access:
+            kind, table, index = access.groups()
+            if index:
+                plan.indexes.add(index)
+            elif kind == 'SCAN':
+                plan.full_scans.add(table)
+            continue
+        temp = _SQLITE_TEMP.search(detail)
+        if temp:
+            plan.temp.add('GROUP BY' if temp.group(1) == 'DISTINCT' else temp.group(1))
+    return plan
+
+
+def postgresql_plan(conn, statement, parameters):
+    conn.exec_driver_sql('SET LOCAL enable_seqscan = off')
+    conn.exec_driver_sql('SET LOCAL enable_sort = off')
+    result = conn.exec_driver_sql('EXPLAIN (FORMAT JSON) ' + statement, parameters).scalar()
+    root = (json.loads(result) if isinstance(result, str) else result)[0]['Plan']
+    plan = Plan(statement, [])
+
+    def walk(node, depth, parent):
+        node_type = node['Node Type']
+        relation = node.get('Relation Name')
+        plan.lines.append('  ' * depth + node_type + (f" on {relation}" if relation else '')
+                          + (f" using {node['Index Name']}" if node.get('Index Name') else ''))
+        if node.get('Index Name'):
+            plan.indexes.add(node['Index Name'])
+        if node_type == 'Seq Scan':
+            plan.full_scans.add(relation)
+        if node_type == 'Sort':
+            plan.temp.add('GROUP BY' if parent in ('Aggregate', 'Group', 'Unique') else 'ORDER BY')
+        if node_type == 'Aggregate' and node.get('Strategy') == 'Hashed':
+            plan.temp.add('GROUP BY')
+        for child in node.get('Plans', ()):
+            walk(child, depth + 1, node_type)
+
+    walk(root, 0, None)
+    return plan
+
+
+EXPLAINERS = {'sqlite': sqlite_plan, 'postgresql': postgresql_plan}
+
+
+def capture(client, method, path, body=None):
+    """(statement, parameters) of every SELECT the request runs, streamed bodies included."""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip()[:6].upper() == 'SELECT':
+            statements.append((statement, parameters))
+
+    event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        response = client.open(path, method=method, json=body)
+        response.get_data()
+        response.close()
+    finally:
+        event.remove(Engine, 'before_cursor_execute', before_cursor_execute)
+    return statements
+
+
+def check(expectation, plans):
+    """The ways `plans` break `expectation`, as messages."""
+    failures = []
+    used = set().union(*(plan.indexes for plan in plans)) if plans else set()
+    for index in expectation.indexes:
+        if index not in used:
+            failures.append(f"does not use {index}")
+    for plan in plans:
+        for table in sorted(plan.full_scans - set(expectation.full_scans)):
+            failures.append(f"reads all of {table}")
+        for purpose in sorted(plan.temp - set(expectation.temp)):
+            failures.append(f"needs a temp b-tree or sort for {purpose}")
+    if not plans:
+        failures.append("ran no SELECT")
+    return failures
+
+
+def run_checks(app, expectations=HOT_QUERIES, verbose=False, echo=click.echo):
+    """Check every expectation; returns the number that failed."""
+    from model import Sale
+
+    db = app.extensions['sqlalchemy']
+    with app.app_context():
+        dialect = db.engine.dialect.name
+        explain = EXPLAINERS.get(dialect)
+        if explain is None:
+            raise click.ClickException(f"no plan reader for {dialect}")
+        sale = db.session.query(Sale.id, Sale.user_id).order_by(Sale.id.desc()).first()
+        db.session.remove()
+    if sale is None:
+        # the detail routes would only 404 and never reach their real queries
+        raise click.ClickException("the database has no sales; generate some or use --fresh")
+    values = {'sale_id': sale.id, 'user_id': sale.user_id}
+
+    client = app.test_client()
+    failed = 0
+    for expectation in expectations:
+        body = ({key: value.format(**values) for key, value in expectation.body.items()}
+                if expectation.body else None)
+        over_budget = None
+        try:
+            with query_budget(expectation.max_queries if expectation.max_queries is not None else sys.maxsize):
+                statements = capture(client, expectation.method, expectation.path.format(**values), body)
+        except AssertionError as e:
+            over_budget = str(e).splitlines()[0]
+        with app.app_context():
+            with db.engine.connect() as conn:
+                plans = [explain(conn, statement, parameters) for statement, parameters in statements]
+                conn.rollback()
+        failures = check(expectation, plans)
+        if over_budget:
+            failures.append(over_budget)
+        failed += bool(failures)
+        echo(f"{'FAIL' if failures else 'ok':4}  {expectation.name} ({expectation.method} {expectation.path})")
+        for failure in failures:
+            echo(f"      {failure}")
+        if failures or verbose:
+            for plan in plans:
+                echo('      ' + ' '.join(plan.statement.split())[:160])
+                for line in plan.lines:
+                    echo('        ' + line)
+    return failed
+
+
+@click.group('plans')
+def plans_cli():
+    """Query plan checks."""
+
+
+@plans_cli.command('check')
+@click.option('--fresh', is_flag=True,
+              help='Check a throwaway SQLite database filled by the dataset generator.')
+@click.option('--sales', default=20000, show_default=True, help='Sales generated with --fresh.')
+@click.option('--verbose', '-v', is_flag=True, help='Print every plan, not only failing ones.')
+def check_command(fresh, sales, verbose):
+    """Compare the plans of the hot queries with HOT_QUERIES."""
+    from flask import current_app
+
+    if not fresh:
+        app = current_app._get_current_object()
+        sys.exit(1 if run_checks(app, verbose=verbose) else 0)
+
+    from app import create_app
+    from utils.dataset import generate
+
+    tmp_dir = tempfile.mkdtemp(prefix='plans-')
+    # this process only exists for the check, so the app below simply
+    # takes the throwaway database from the environment
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(tmp_dir, 'plans.db')}"
+    try:
+        app = create_app({'METRICS': False, 'READ_SNAPSHOT_INTERVAL': 0,
+                          'IMAGE_RAW_DIR': os.path.join(tmp_dir, 'uploads_pending')})
+        db = app.extensions['sqlalchemy']
+        with app.app_context():
+            db.create_all()
+            generate(db.engine, seed=1, branches=2, users=20, categories=20, products=2000, customers=2000,
+                     sales=sales, days=365, end=date.today(), batch=sales, password_hash='-',
+                     echo=lambda message: None)
+            db.engine.dispose()
+        failed = run_checks(app, verbose=verbose)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    sys.exit(1 if failed else 0)
+
+
+def init_app(app):
+    app.cli.add_command(plans_cli)
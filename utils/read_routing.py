@@ -0,0 +1,246 @@
+"""Send read-only routes to a separate read engine.
+
+Reports and big listings are marked with `@read_only` (or by registering
+`use_read_engine` as a blueprint's before_request). During those requests
+`RoutingSession` sends every query to the read engine. Flushes and explicit
+binds still go to the primary.  The read engine is either:
+
+* READ_DATABASE_URL: a streaming replica of the primary, or
+* for a SQLite primary with READ_SNAPSHOT_INTERVAL set (it is off by
+  default, every refresh copies the whole database), a snapshot copy under
+  instance/ that one worker at a time refreshes that often with the SQLite
+  backup API.  The copy goes BACKUP_STEP_PAGES at a time, so writers and
+  WAL checkpoints get the file between steps, and a refresh that takes
+  longer than the interval is abandoned.  A long report then reads the copy
+  and holds no locks on the file checkout writes go to.
+
+A read engine whose data is older than READ_MAX_STALENESS seconds is not
+used, and the request falls back to the primary.  So is a replica whose lag
+is unknown: not measured yet, the last probe failed, the replica does not
+replay, or its backend has no probe in LAG_PROBES (PostgreSQL, MySQL and
+MariaDB have one).  Clients that must see their own last write send
+``X-Read-Your-Writes: 1`` or ``?fresh=1``.
+"""
+import fcntl
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import suppress
+from functools import partial, wraps
+
+from flask import g, has_request_context, request
+from flask_sqlalchemy.session import Session
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import NullPool
+from sqlalchemy.sql import Delete, Insert, Update
+
+from utils.background import periodic
+from utils.db_profiles import engine_options
+from utils.sqlite_profile import apply_pragmas
+
+logger = logging.getLogger(__name__)
+
+# the snapshot is only ever read; no journal to set up, a large page cache
+SNAPSHOT_PRAGMAS = {
+    'query_only': 'ON',
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -64000,
+    'temp_store': 'MEMORY',
+}
+# pages copied per backup step, 4 MB with the default page size
+BACKUP_STEP_PAGES = 1024
+BACKUP_STEP_PAUSE = 0.01
+
+
+class ReadRouter:
+
+    def __init__(self, app=None):
+        self.app = None
+        self.url = None
+        self.snapshot_path = None
+        self.primary_path = None
+        self.snapshot_interval = 0
+        self.max_staleness = 30
+        self._engine = None
+        self._pid = None
+        self._replica_lag = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Call after SQLAlchemy(app, session_options={'class_': RoutingSession})."""
+        self.app = app
+        self.url = app.config.setdefault('READ_DATABASE_URL', os.environ.get('READ_DATABASE_URL'))
+        self.snapshot_interval = app.config.setdefault('READ_SNAPSHOT_INTERVAL', 0)
+        self.max_staleness = app.config.setdefault('READ_MAX_STALENESS', 30)
+        with app.app_context():
+            primary = app.extensions['sqlalchemy'].engine
+        if self.url:
+            probe = LAG_PROBES.get(make_url(self.url).get_backend_name())
+            if probe is not None:
+                periodic.add('read-replica-lag', 5, partial(self._measure_replica_lag, probe))
+        elif primary.dialect.name == 'sqlite' and primary.url.database not in (None, '', ':memory:') \
+                and self.snapshot_interval:
+            self.primary_path = primary.url.database
+            base, _ = os.path.splitext(self.primary_path)
+            self.snapshot_path = base + '.read.db'
+            periodic.add('read-snapshot', self.snapshot_interval, self.refresh_snapshot)
+        app.extensions['read_router'] = self
+
+    @property
+    def enabled(self):
+        return bool(self.url or self.snapshot_path)
+
+    def _get_engine(self):
+        # created per process, like the other pools, so forked workers never share one
+        with self._lock:
+            if self._engine is None or self._pid != os.getpid():
+                if self.url:
+                    self._engine = create_engine(self.url, **engine_options(self.url))
+                else:
+                    # a new connection per checkout, so readers pick up a
+                    # refreshed snapshot file instead of the replaced one
+                    self._engine = create_engine(
+                        f"sqlite:///file:{self.snapshot_path}?mode=ro&uri=true", poolclass=NullPool)
+
+                    @event.listens_for(self._engine, 'connect')
+                    def _on_connect(dbapi_connection, connection_record):
+                        apply_pragmas(dbapi_connection, SNAPSHOT_PRAGMAS)
+                self._pid = os.getpid()
+            return self._engine
+
+    def staleness(self):
+        """Seconds the read engine is behind the primary, None if unknown or unusable."""
+        if self.snapshot_path:
+            try:
+                return max(0.0, time.time() - os.stat(self.snapshot_path).st_mtime)
+            except OSError:
+                return None
+        if self._replica_lag is None:
+            return None
+        lag, measured_at = self._replica_lag
+        # a reading that stops being renewed grows old with the data
+        return lag + max(0.0, time.monotonic() - measured_at)
+
+    def fresh_enough(self):
+        """Whether the read engine is within READ_MAX_STALENESS right now."""
+        lag = self.staleness()
+        return lag is not None and lag <= self.max_staleness
+
+    def engine_for_request(self):
+        """The read engine when the current request may use it, else None."""
+        if not self.enabled or not has_request_context() or not g.get('read_only'):
+            return None
+        if 'read_engine' not in g:
+            engine = None
+            if not wants_fresh_read() and self.fresh_enough():
+                engine = self._get_engine()
+            # decided once, so one request never mixes the two sources
+            g.read_engine = engine
+        return g.read_engine
+
+    def refresh_snapshot(self):
+        """Copy the primary into the snapshot file; one worker at a time."""
+        age = self.staleness()
+        if age is not None and age < self.snapshot_interval / 2:
+            # another worker has just refreshed it
+            return
+        with open(self.snapshot_path + '.lock', 'w') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+            tmp_path = f"{self.snapshot_path}.{os.getpid()}.tmp"
+            started = time.perf_counter()
+
+            def progress(status, remaining, total):
+                # writes to the primary restart the copy; past the interval
+                # the old snapshot goes stale and reads use the primary
+                if time.perf_counter() - started > self.snapshot_interval:
+                    raise TimeoutError(f"read snapshot not done after {self.snapshot_interval}s")
+
+            source = sqlite3.connect(self.primary_path)
+            target = sqlite3.connect(tmp_path)
+            try:
+                try:
+                    source.backup(target, pages=BACKUP_STEP_PAGES, progress=progress, sleep=BACKUP_STEP_PAUSE)
+                    # a WAL header would make readers look for a -wal file of their own
+                    target.execute("PRAGMA journal_mode=DELETE")
+                finally:
+                    target.close()
+                    source.close()
+                os.replace(tmp_path, self.snapshot_path)
+            except BaseException as e:
+                # timed out, a full disk, a locked primary...: no partial copy stays behind
+                with suppress(FileNotFoundError):
+                    os.remove(tmp_path)
+                if not isinstance(e, TimeoutError):
+                    raise
+                logger.warning("%s", e)
+                return
+        logger.debug("read snapshot refreshed in %.3fs", time.perf_counter() - started)
+
+    def _measure_replica_lag(self, probe):
+        self._replica_lag = None
+        with self._get_engine().connect() as conn:
+            lag = probe(conn)
+        if lag is not None:
+            self._replica_lag = (float(lag), time.monotonic())
+
+
+def _postgresql_lag(conn):
+    # NULL on a server that is not replaying; the timestamp also grows
+    # while the primary is idle, which errs on the side of the primary
+    return conn.execute(text(
+        "SELECT EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())")).scalar()
+
+
+def _mysql_lag(conn):
+    # no row on a server that is no replica, NULL while replication is stopped;
+    # MariaDB and MySQL before 8.0.22 still name the column after the master
+    row = conn.exec_driver_sql("SHOW REPLICA STATUS").mappings().first()
+    if row is None:
+        return None
+    return row.get('Seconds_Behind_Source', row.get('Seconds_Behind_Master'))
+
+
+# backend name -> fn(connection) giving the replica lag in seconds, None when unknown
+LAG_PROBES = {'postgresql': _postgresql_lag, 'mysql': _mysql_lag, 'mariadb': _mysql_lag}
+
+
+def wants_fresh_read(req=None):
+    """`req` defaults to the current Flask request; anything with headers and args works."""
+    req = request if req is None else req
+    return req.headers.get('X-Read-Your-Writes') == '1' or req.args.get('fresh') == '1'
+
+
+def use_read_engine():
+    """Mark the current request as read-only; usable as a before_request hook."""
+    g.read_only = True
+
+
+def read_only(f):
+    """Route decorator: run the view's queries on the read engine."""
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        use_read_engine()
+        return f(*args, **kwargs)
+
+    return wrapper
+
+
+class RoutingSession(Session):
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and not isinstance(clause, (Insert, Update, Delete)):
+            engine = read_router.engine_for_request()
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+read_router = ReadRouter()
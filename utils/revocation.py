@@ -0,0 +1,145 @@
+"""Revoked JWT ids shared by every worker.
+
+Revocations live in the ``revoked_token`` table until the token's own expiry.
+`is_revoked` runs on every protected request, so each worker keeps a Bloom
+filter of the revoked ids: a miss (the common case) answers without touching
+the database, a hit is confirmed with a primary key lookup whose result is
+cached briefly.  The filter picks up revocations made by other workers with
+one indexed query at most every ``JWT_REVOCATION_SYNC_SECONDS``, which is
+also the longest a token logged out elsewhere can still be accepted here:
+a sync drops the cached result of every id it brings in, so a false
+positive cached as "not revoked" cannot hide a later revocation.
+"""
+import hashlib
+import math
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, select
+from sqlalchemy.exc import IntegrityError
+
+from utils.background import periodic
+from utils.cache import TTLCache
+
+
+class BloomFilter:
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.capacity = max(1, capacity)
+        self.size = max(8, int(-self.capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / self.capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+
+class RevocationStore:
+
+    def __init__(self, app=None):
+        self.app = None
+        self.sync_seconds = 2
+        self.rebuild_seconds = 60 * 60
+        self.capacity = 100_000
+        self._bloom = None
+        self._synced_at = 0
+        self._rebuilt_at = 0
+        self._watermark = None
+        self._confirmed = TTLCache(ttl=30, maxsize=4096)
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.sync_seconds = app.config.setdefault('JWT_REVOCATION_SYNC_SECONDS', 2)
+        self.rebuild_seconds = app.config.setdefault('JWT_REVOCATION_REBUILD_SECONDS', 60 * 60)
+        self.capacity = app.config.setdefault('JWT_REVOCATION_CAPACITY', 100_000)
+        periodic.add('revoked-token-purge',
+                     app.config.setdefault('JWT_REVOCATION_PURGE_SECONDS', 15 * 60), self.purge)
+        app.extensions['revocation_store'] = self
+
+    @property
+    def _db(self):
+        return self.app.extensions['sqlalchemy']
+
+    def _sync(self):
+        from model import RevokedToken
+
+        now = time.monotonic()
+        if self._bloom is not None and now - self._synced_at < self.sync_seconds:
+            return
+        with self._lock:
+            if self._bloom is not None and now - self._synced_at < self.sync_seconds:
+                return
+            query = select(RevokedToken.jti, RevokedToken.revoked_at)
+            rebuild = self._bloom is None or now - self._rebuilt_at >= self.rebuild_seconds
+            if not rebuild and self._watermark is not None:
+                # overlap a little to cover clock differences between writers
+                query = query.where(RevokedToken.revoked_at > self._watermark - timedelta(seconds=5))
+            rows = self._db.session.execute(query).all()
+            if rebuild:
+                # a fresh filter drops purged ids and resizes with the table
+                bloom = BloomFilter(max(self.capacity, 2 * len(rows)))
+                self._rebuilt_at = now
+                self._watermark = None
+            else:
+                bloom = self._bloom
+            for jti, revoked_at in rows:
+                bloom.add(jti)
+                self._confirmed.pop(jti)
+                if self._watermark is None or revoked_at > self._watermark:
+                    self._watermark = revoked_at
+            if bloom.count > bloom.capacity:
+                self._rebuilt_at = 0
+            self._bloom = bloom
+            self._synced_at = now
+
+    def is_revoked(self, jti):
+        from model import RevokedToken
+
+        self._sync()
+        if jti not in self._bloom:
+            return False
+        revoked = self._confirmed.get(jti)
+        if revoked is None:
+            revoked = self._confirmed.set(
+                jti, self._db.session.get(RevokedToken, jti) is not None)
+        return revoked
+
+    def revoke(self, jti, exp=None):
+        from model import RevokedToken
+
+        expires_at = datetime.utcfromtimestamp(exp) if exp else None
+        self._db.session.add(RevokedToken(jti=jti, expires_at=expires_at))
+        try:
+            self._db.session.commit()
+        except IntegrityError:
+            # already revoked
+            self._db.session.rollback()
+        self._sync()
+        self._bloom.add(jti)
+        self._confirmed.set(jti, True)
+
+    def purge(self):
+        """Delete revocations of tokens that have expired anyway."""
+        from model import RevokedToken
+
+        self._db.session.execute(delete(RevokedToken).where(RevokedToken.expires_at < datetime.utcnow()))
+        self._db.session.commit()
+
+
+revocation_store = RevocationStore()
@@ -0,0 +1,209 @@
+import json
+import os
+from datetime import date, datetime
+from decimal import Decimal
+from functools import lru_cache
+
+from flask import Response, stream_with_context
+from flask.json.provider import DefaultJSONProvider
+
+from utils.cache import catalog_cache
+from utils.images import VARIANT_SIZES, variant_path
+
+try:
+    import orjson
+except ImportError:  # optional, stdlib json is used when it is missing
+    orjson = None
+
+JSON_MIMETYPE = 'application/json'
+
+
+def _default(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+if orjson is not None:
+    _ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS
+
+    def dumps(obj) -> bytes:
+        return orjson.dumps(obj, default=_default, option=_ORJSON_OPTIONS)
+
+    def loads(data):
+        return orjson.loads(data)
+else:
+    _encoder = json.JSONEncoder(default=_default, separators=(',', ':'), ensure_ascii=False)
+
+    def dumps(obj) -> bytes:
+        return _encoder.encode(obj).encode('utf-8')
+
+    def loads(data):
+        return json.loads(data)
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson when it is installed."""
+
+    sort_keys = False
+
+    def dumps(self, obj, **kwargs):
+        if kwargs:
+            return super().dumps(obj, **kwargs)
+        return dumps(obj).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(dumps(obj), mimetype=self.mimetype)
+
+
+BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+
+@lru_cache(maxsize=8192)
+def image_variants(image_path):
+    """Downscaled JPEG/WebP URLs for an uploaded image, smallest first.
+
+    Images uploaded before variants existed have none, which is checked once
+    per path; a stored path never gains variants later because every upload
+    gets a new file name.
+    """
+    if not image_path:
+        return []
+    if not os.path.exists(os.path.join(BASE_DIR, variant_path(image_path, VARIANT_SIZES[0], '.webp'))):
+        return []
+    return [{
+        "size": size,
+        "jpeg": variant_path(image_path, size, '.jpg'),
+        "webp": variant_path(image_path, size, '.webp')
+    } for size in sorted(VARIANT_SIZES)]
+
+
+# row -> dict mappers, one per model
+
+def format_decimal(value):
+    if value is None:
+        return None
+    return float(value)
+
+
+def category_to_dict(category) -> dict:
+    return {
+        "id": category.id,
+        "name": category.name,
+        "image": category.image,
+        "image_status": category.image_status,
+        "image_variants": image_variants(category.image)
+    }
+
+
+def product_to_dict(product) -> dict:
+    return {
+        "id": product.id,
+        "name": product.name,
+        "category_id": product.category_id,
+        "cost": format_decimal(product.cost),
+        "price": format_decimal(product.price),
+        "image": product.image,
+        "image_status": product.image_status,
+        "image_variants": image_variants(product.image)
+    }
+
+
+def user_to_dict(user) -> dict:
+    return {
+        "id": user.id,
+        "user_name": user.user_name,
+        "profile": user.profile,
+        "image_status": user.image_status,
+        "profile_variants": image_variants(user.profile)
+    }
+
+
+def sale_to_dict(sale) -> dict:
+    return {
+        'id': sale.id,
+        'date_time': sale.date_time.isoformat(),
+        'customer_id': sale.customer_id,
+        'user_id': sale.user_id,
+        'total': format_decimal(sale.total),
+        'paid': format_decimal(sale.paid),
+        'remark': sale.remark
+    }
+
+
+def sale_item_to_dict(item) -> dict:
+    return {
+        'id': item.id,
+        'product_id': item.product_id,
+        'qty': item.qty,
+        'cost': format_decimal(item.cost),
+        'price': format_decimal(item.price),
+        'total': format_decimal(item.total)
+    }
+
+
+def invoice_to_dict(sale, customer, items) -> dict:
+    """An invoice with its customer's name and its items, for /invoice/<id>."""
+    return {
+        'invoice': {
+            'id': sale.id,
+            'date_time': sale.date_time.isoformat(),
+            'customer_id': sale.customer_id,
+            'customer_name': customer.name if customer else None,
+            'user_id': sale.user_id,
+            'total': format_decimal(sale.total),
+            'paid': format_decimal(sale.paid),
+            'remark': sale.remark
+        },
+        'items': [sale_item_to_dict(item) for item in items]
+    }
+
+
+# responses
+
+def json_response(body, status=200):
+    """Wrap a payload (or bytes that are already encoded) in a JSON response."""
+    if not isinstance(body, (bytes, bytearray)):
+        body = dumps(body)
+    return Response(body, status=status, mimetype=JSON_MIMETYPE)
+
+
+def cached_json(key, factory, cache=catalog_cache):
+    """Serve a payload from `cache` as pre-encoded bytes, building it on a miss."""
+    body = cache.get(key)
+    if body is None:
+        body = cache.set(key, dumps(factory()))
+    return json_response(body)
+
+
+def _encode_list(rows, mapper, chunk_size):
+    yield b'['
+    chunk = []
+    first = True
+    for row in rows:
+        chunk.append(dumps(mapper(row) if mapper else row))
+        if len(chunk) >= chunk_size:
+            yield (b'' if first else b',') + b','.join(chunk)
+            first = False
+            chunk = []
+    if chunk:
+        yield (b'' if first else b',') + b','.join(chunk)
+    yield b']'
+
+
+def stream_json_list(rows, mapper=None, chunk_size=500, status=200):
+    """Encode `rows` into a JSON array chunk by chunk instead of all at once.
+
+    `rows` may be a lazy query result; it is consumed inside the request
+    context while the response is being sent.
+    """
+    body = stream_with_context(_encode_list(rows, mapper, chunk_size))
+    return Response(body, status=status, mimetype=JSON_MIMETYPE)
@@ -0,0 +1,159 @@
+"""Per-request SQL statistics.
+
+With SQL_STATS set, every statement run while a request is being handled is
+counted and timed through SQLAlchemy's cursor events (on all engines, so the
+read engine is included).  The response gets a Server-Timing header with the
+query count, the total database time and the total time in the view, e.g.
+
+    Server-Timing: db;dur=4.1;desc="7 queries", app;dur=9.8
+
+Streamed responses (stream_json_list) run their queries after the headers
+are sent, so only the queries made before streaming appear in theirs.
+A statement that runs more than SQL_REPEAT_THRESHOLD times in one request is
+logged as a likely N+1 query, together with the slowest statement.
+The header tells any client how the database is doing, so SQL_STATS is meant
+for development and staging, not for a public deployment.
+
+`query_budget` applies the same counting to a block of code, for asserting
+how many queries an endpoint may run; ``flask plans check`` holds every hot
+endpoint to one (utils/query_plans.py).
+"""
+import logging
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+_recorder = ContextVar('sql_recorder', default=None)
+# the cursor listeners, installed on first use; they only cost a lookup
+# of _recorder while nothing records
+_installed = False
+
+
+class QueryRecorder:
+
+    def __init__(self, parent=None, keep_log=False):
+        self.parent = parent
+        # (duration, statement) of every query, when asked for
+        self.log = [] if keep_log else None
+        self.count = 0
+        self.duration = 0.0
+        self.slowest = (0.0, None)
+        self.statements = Counter()
+
+    def record(self, statement, duration):
+        recorder = self
+        while recorder is not None:
+            recorder.count += 1
+            recorder.duration += duration
+            recorder.statements[statement] += 1
+            if duration > recorder.slowest[0]:
+                recorder.slowest = (duration, statement)
+            if recorder.log is not None:
+                recorder.log.append((duration, statement))
+            recorder = recorder.parent
+
+    def repeated(self, threshold):
+        """(statement, times) for statements run more than `threshold` times."""
+        return [(statement, times) for statement, times in self.statements.most_common()
+                if times > threshold]
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _recorder.get() is not None:
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    recorder = _recorder.get()
+    if recorder is not None and conn.info.get('query_start'):
+        recorder.record(statement, time.perf_counter() - conn.info['query_start'].pop())
+
+
+def _install():
+    global _installed
+    if not _installed:
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        _installed = True
+
+
+@contextmanager
+def recording(keep_log=False):
+    """Record the statements run inside the block; yields the QueryRecorder."""
+    _install()
+    recorder = QueryRecorder(parent=_recorder.get(), keep_log=keep_log)
+    token = _recorder.set(recorder)
+    try:
+        yield recorder
+    finally:
+        _recorder.reset(token)
+
+
+@contextmanager
+def query_budget(max_queries):
+    """Fail with AssertionError when the block runs more than `max_queries`
+    statements, e.g.
+
+        with query_budget(3):
+            client.post('/invoice/create', json=payload)
+    """
+    with recording() as recorder:
+        yield recorder
+    if recorder.count > max_queries:
+        top = '\n'.join(f"  {times}x {statement}" for statement, times in recorder.statements.most_common(5))
+        raise AssertionError(f"{recorder.count} queries, budget is {max_queries}:\n{top}")
+
+
+class SQLStats:
+
+    def __init__(self, app=None):
+        self.repeat_threshold = 5
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if not app.config.setdefault('SQL_STATS', False):
+            return
+        self.repeat_threshold = app.config.setdefault('SQL_REPEAT_THRESHOLD', 5)
+        _install()
+        app.before_request(self._start)
+        app.after_request(self._finish)
+        app.teardown_request(self._teardown)
+        app.extensions['sql_stats'] = self
+
+    def _start(self):
+        recorder = QueryRecorder(parent=_recorder.get())
+        g.sql_stats = (recorder, _recorder.set(recorder), time.perf_counter())
+
+    def _finish(self, response):
+        stats = g.get('sql_stats')
+        if stats is None:
+            return response
+        recorder, _, started = stats
+        response.headers.add('Server-Timing', (
+            f'db;dur={recorder.duration * 1000:.1f};desc="{recorder.count} queries", '
+            f'app;dur={(time.perf_counter() - started) * 1000:.1f}'))
+        for statement, times in recorder.repeated(self.repeat_threshold):
+            logger.warning("%s %s ran this statement %d times (likely N+1; %d queries, "
+                           "%.1fms in total, slowest %.1fms):\n%s", request.method, request.path, times,
+                           recorder.count, recorder.duration * 1000, recorder.slowest[0] * 1000, statement)
+        return response
+
+    def _teardown(self, exc):
+        stats = g.pop('sql_stats', None)
+        if stats is not None:
+            try:
+                _recorder.reset(stats[1])
+            except ValueError:
+                # torn down in another context than it started in
+                _recorder.set(stats[0].parent)
+
+
+sql_stats = SQLStats()
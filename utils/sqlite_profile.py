@@ -0,0 +1,86 @@
+"""SQLite settings for running under several gunicorn workers.
+
+Out of the box SQLite uses a rollback journal, fsyncs on every commit and
+fails at once with "database is locked" when another process holds the write
+lock.  `init_app` applies a pragma profile to every new connection instead:
+WAL lets readers run alongside the single writer, synchronous=NORMAL only
+fsyncs at checkpoints (still safe against application crashes), and
+busy_timeout makes writers wait for the lock instead of failing.
+`PRAGMA optimize` and WAL checkpoints run as periodic background tasks.
+"""
+import logging
+import sqlite3
+
+from flask import current_app
+from sqlalchemy import event, text
+
+from utils.background import periodic
+
+logger = logging.getLogger(__name__)
+
+# pragma -> value, applied in this order; SQLITE_PRAGMAS overrides single
+# entries and a value of None leaves that pragma at SQLite's default
+DEFAULT_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,  # ms
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -64000,  # negative means KiB, i.e. 64 MB per connection
+    'temp_store': 'MEMORY',
+    'foreign_keys': 'ON',
+}
+
+
+def apply_pragmas(dbapi_connection, pragmas):
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in pragmas.items():
+            if value is not None:
+                cursor.execute(f"PRAGMA {name}={value}")
+    finally:
+        cursor.close()
+
+
+def install(engine, pragmas):
+    """Apply `pragmas` on every new sqlite3 connection made by `engine`."""
+    @event.listens_for(engine, 'connect')
+    def _on_connect(dbapi_connection, connection_record):
+        if isinstance(dbapi_connection, sqlite3.Connection):
+            apply_pragmas(dbapi_connection, pragmas)
+
+    return _on_connect
+
+
+def _optimize():
+    db = current_app.extensions['sqlalchemy']
+    with db.engine.connect() as conn:
+        conn.execute(text("PRAGMA optimize"))
+
+
+def _checkpoint():
+    db = current_app.extensions['sqlalchemy']
+    with db.engine.connect() as conn:
+        # TRUNCATE also shrinks the -wal file; busy=1 means active readers held it back
+        busy, log_pages, checkpointed = conn.execute(text("PRAGMA wal_checkpoint(TRUNCATE)")).one()
+    if busy:
+        logger.debug("wal checkpoint incomplete: %s of %s pages", checkpointed, log_pages)
+
+
+def init_app(app):
+    """Install the profile on the app's SQLite engines; call after SQLAlchemy(app)."""
+    pragmas = dict(DEFAULT_PRAGMAS)
+    pragmas.update(app.config.setdefault('SQLITE_PRAGMAS', {}))
+    app.config.setdefault('SQLITE_OPTIMIZE_INTERVAL', 60 * 60)
+    app.config.setdefault('SQLITE_CHECKPOINT_INTERVAL', 5 * 60)
+    with app.app_context():
+        engines = [engine for engine in app.extensions['sqlalchemy'].engines.values()
+                   if engine.dialect.name == 'sqlite']
+    if not engines:
+        return
+    # Flask-SQLAlchemy creates the engines up front but connects lazily,
+    # so no connection has been opened without the profile yet
+    for engine in engines:
+        install(engine, pragmas)
+    periodic.add('sqlite-optimize', app.config['SQLITE_OPTIMIZE_INTERVAL'], _optimize)
+    if str(pragmas.get('journal_mode')).upper() == 'WAL':
+        periodic.add('sqlite-checkpoint', app.config['SQLITE_CHECKPOINT_INTERVAL'], _checkpoint)
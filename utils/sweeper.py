@@ -0,0 +1,291 @@
+"""Reconcile the upload directories with the database.
+
+Removes image files that no row references any more (left behind by failed
+updates, lost deletes or crashed image jobs), fixes blob reference counts
+that drifted, and reports what was reclaimed.  Only files older than the
+grace period are touched, so uploads that are still being processed or
+committed are never affected.
+"""
+import fcntl
+import logging
+import os
+import re
+import time
+
+import click
+from sqlalchemy import delete, func, select
+
+from utils.background import periodic
+from utils.images import variant_paths
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+LEGACY_DIRS = ('static/uploads/products', 'static/uploads/categories', 'static/uploads/users')
+BATCH_SIZE = 500
+# abc_256.webp / abc.webp -> abc.jpg
+VARIANT_SUFFIX = re.compile(r'_\d+$')
+
+
+def _old_files(rel_dir, cutoff):
+    """(relative path, size) of every file under `rel_dir` last modified before `cutoff`."""
+    root = os.path.join(BASE_DIR, rel_dir)
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            abs_path = os.path.join(dirpath, filename)
+            try:
+                st = os.stat(abs_path)
+            except OSError:
+                continue
+            if st.st_mtime < cutoff:
+                rel = os.path.relpath(abs_path, BASE_DIR).replace(os.sep, '/')
+                yield rel, st.st_size
+
+
+def _batches(items, size=BATCH_SIZE):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _owner_path(path):
+    """The stored image path a file belongs to, variants map to their main file."""
+    stem, ext = os.path.splitext(path)
+    base = VARIANT_SUFFIX.sub('', stem)
+    if base != stem or ext == '.webp':
+        return base + '.jpg'
+    return path
+
+
+def _referenced_paths(db, paths):
+    from model import Category, Product, User
+
+    found = set()
+    for batch in _batches(list(paths)):
+        for column in (Product.image, Category.image, User.profile):
+            found.update(db.session.execute(select(column).where(column.in_(batch))).scalars())
+    return found
+
+
+def _reference_counts(db):
+    """{stored path: rows referencing it}, one streamed GROUP BY per image column."""
+    from model import Category, Product, User
+
+    counts = {}
+    for column in (Product.image, Category.image, User.profile):
+        result = db.session.execute(
+            select(column, func.count()).where(column.isnot(None)).group_by(column)
+            .execution_options(yield_per=BATCH_SIZE))
+        for path, count in result:
+            counts[path] = counts.get(path, 0) + count
+    return counts
+
+
+def _drifted_blobs(db, counts):
+    """(hash, path, counted references, created_at) of the blobs whose ref_count differs from `counts`."""
+    from model import UploadBlob
+
+    drifted = []
+    last = ''
+    while True:
+        rows = db.session.execute(
+            select(UploadBlob.hash, UploadBlob.path, UploadBlob.ref_count, UploadBlob.created_at)
+            .where(UploadBlob.hash > last).order_by(UploadBlob.hash).limit(BATCH_SIZE)
+        ).all()
+        if not rows:
+            return drifted
+        for blob_hash, path, ref_count, created_at in rows:
+            if counts.get(path, 0) != ref_count:
+                drifted.append((blob_hash, path, counts.get(path, 0), created_at))
+        last = rows[-1][0]
+
+
+def _recount_blobs(db, cutoff_dt, dry_run):
+    """Fix blob reference counts that drifted from the image columns.
+
+    The references are aggregated once and compared with the blobs batch by
+    batch.  Only the blobs that differ are then recounted exactly, in one
+    UPDATE, so an upload that committed its blob reference and its row
+    change in the meantime is counted correctly.  Blobs left with no
+    reference are deleted along with their files.
+    """
+    from model import Category, Product, UploadBlob, User
+
+    drifted = _drifted_blobs(db, _reference_counts(db))
+    db.session.rollback()
+    if dry_run:
+        return 0, [_blob_files(path, remove=False)
+                   for _, path, count, created_at in drifted if count == 0 and created_at < cutoff_dt]
+
+    refs = sum(
+        select(func.count()).where(column == UploadBlob.path).scalar_subquery()
+        for column in (Product.image, Category.image, User.profile)
+    )
+    fixed = 0
+    for batch in _batches([blob_hash for blob_hash, _, _, _ in drifted]):
+        fixed += db.session.execute(
+            UploadBlob.__table__.update()
+            .where(UploadBlob.hash.in_(batch), UploadBlob.ref_count != refs)
+            .values(ref_count=refs)
+        ).rowcount
+    stale = db.session.execute(
+        select(UploadBlob.path)
+        .where(UploadBlob.ref_count <= 0, UploadBlob.created_at < cutoff_dt)
+    ).scalars().all()
+    db.session.execute(
+        delete(UploadBlob)
+        .where(UploadBlob.ref_count <= 0, UploadBlob.created_at < cutoff_dt)
+    )
+    # files go while the blob rows are still locked, see utils/blob_store.py
+    removed = [_blob_files(path, remove=True) for path in stale]
+    db.session.commit()
+    return fixed, removed
+
+
+def _blob_files(path, remove):
+    """(file count, bytes) of a blob and its variants, removing them if asked."""
+    count = size = 0
+    for p in [path] + variant_paths(path):
+        abs_path = os.path.join(BASE_DIR, p)
+        try:
+            file_size = os.path.getsize(abs_path)
+            if remove:
+                os.remove(abs_path)
+        except OSError:
+            continue
+        count += 1
+        size += file_size
+    return count, size
+
+
+def _remove(path, dry_run):
+    if dry_run:
+        return True
+    try:
+        os.remove(os.path.join(BASE_DIR, path))
+        return True
+    except OSError:
+        return False
+
+
+def sweep_uploads(grace_seconds=3600, dry_run=False):
+    """Remove orphaned upload files older than `grace_seconds`; returns a report dict."""
+    from datetime import datetime, timedelta
+    from flask import current_app
+    from model import UploadBlob
+    from utils.blob_store import BLOB_DIR
+
+    db = current_app.extensions['sqlalchemy']
+    started = time.perf_counter()
+    cutoff = time.time() - grace_seconds
+    report = {'scanned': 0, 'removed': 0, 'reclaimed_bytes': 0, 'blob_refs_fixed': 0}
+
+    def removed(path, size):
+        if _remove(path, dry_run):
+            report['removed'] += 1
+            report['reclaimed_bytes'] += size
+
+    # blobs whose reference count dropped to zero without being released
+    fixed, stale = _recount_blobs(db, datetime.utcnow() - timedelta(seconds=grace_seconds), dry_run)
+    report['blob_refs_fixed'] = fixed
+    for count, size in stale:
+        report['removed'] += count
+        report['reclaimed_bytes'] += size
+
+    # blob files without a blob row
+    files = list(_old_files(BLOB_DIR, cutoff))
+    report['scanned'] += len(files)
+    for batch in _batches(files):
+        digests = {p: os.path.basename(VARIANT_SUFFIX.sub('', os.path.splitext(p)[0])) for p, _ in batch}
+        known = set(db.session.execute(
+            select(UploadBlob.hash).where(UploadBlob.hash.in_(set(digests.values())))
+        ).scalars())
+        for path, size in batch:
+            if digests[path] not in known:
+                removed(path, size)
+
+    # files from before the blob store
+    for rel_dir in LEGACY_DIRS:
+        files = list(_old_files(rel_dir, cutoff))
+        report['scanned'] += len(files)
+        for batch in _batches(files):
+            owners = {p: _owner_path(p) for p, _ in batch}
+            referenced = _referenced_paths(db, set(owners.values()) | set(owners))
+            for path, size in batch:
+                if path not in referenced and owners[path] not in referenced:
+                    removed(path, size)
+
+    # raw uploads and staged output of image jobs that never finished
+    raw_dir = current_app.config.get('IMAGE_RAW_DIR')
+    if raw_dir and os.path.isdir(raw_dir):
+        for filename in os.listdir(raw_dir):
+            abs_path = os.path.join(raw_dir, filename)
+            try:
+                st = os.stat(abs_path)
+                if st.st_mtime >= cutoff:
+                    continue
+                report['scanned'] += 1
+                if not dry_run:
+                    os.remove(abs_path)
+                report['removed'] += 1
+                report['reclaimed_bytes'] += st.st_size
+            except OSError:
+                continue
+
+    report['seconds'] = round(time.perf_counter() - started, 3)
+    return report
+
+
+def _periodic_sweep():
+    """sweep_uploads() in one worker at a time, at most once per half interval."""
+    from flask import current_app
+
+    interval = current_app.config['UPLOAD_SWEEP_INTERVAL']
+    os.makedirs(current_app.instance_path, exist_ok=True)
+    with open(os.path.join(current_app.instance_path, 'upload-sweep.lock'), 'a+') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            # another worker is sweeping
+            return
+        # the file holds the time of the last sweep of any worker
+        lock_file.seek(0)
+        try:
+            last = float(lock_file.read() or 0)
+        except ValueError:
+            last = 0
+        if time.time() - last < interval / 2:
+            return
+        report = sweep_uploads(current_app.config['UPLOAD_SWEEP_GRACE'])
+        lock_file.seek(0)
+        lock_file.truncate()
+        lock_file.write(str(time.time()))
+    logger.info("upload sweep: %s", report)
+
+
+@click.group('uploads')
+def uploads_cli():
+    """Upload storage maintenance."""
+
+
+@uploads_cli.command('sweep')
+@click.option('--grace', default=None, type=int, help='Only touch files older than this many seconds.')
+@click.option('--dry-run', is_flag=True, help='Report what would be removed without removing it.')
+def sweep_command(grace, dry_run):
+    """Remove upload files no row references any more."""
+    from flask import current_app
+
+    if grace is None:
+        grace = current_app.config['UPLOAD_SWEEP_GRACE']
+    report = sweep_uploads(grace, dry_run=dry_run)
+    click.echo(f"scanned {report['scanned']} files, removed {report['removed']} "
+               f"({report['reclaimed_bytes'] / 1024 / 1024:.1f} MB), "
+               f"fixed {report['blob_refs_fixed']} blob ref counts in {report['seconds']}s"
+               + (" (dry run)" if dry_run else ""))
+
+
+def init_app(app):
+    app.config.setdefault('UPLOAD_SWEEP_INTERVAL', 6 * 60 * 60)
+    app.config.setdefault('UPLOAD_SWEEP_GRACE', 60 * 60)
+    app.cli.add_command(uploads_cli)
+    periodic.add('upload-sweep', app.config['UPLOAD_SWEEP_INTERVAL'], _periodic_sweep)
@@ -0,0 +1,110 @@
+"""Upload intake shared by the product, category and user routes.
+
+Nothing here ever holds a whole upload in memory: the part is copied to the
+pending directory in small chunks while its size is counted, the format is
+sniffed from the first bytes instead of trusting the client's mimetype, and
+the dimensions come from the image header so oversized (decompression
+bomb) images are refused before any pixel buffer is allocated.
+"""
+import os
+import warnings
+from uuid import uuid4
+
+from utils.image_jobs import image_jobs
+from utils.images import MAX_IMAGE_PIXELS, pil_image
+
+MAX_IMAGE_SIZE = 2 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+TOO_LARGE = "Image dimensions are too large"
+
+# leading bytes -> Pillow format name
+SIGNATURES = (
+    (b'\xff\xd8\xff', 'JPEG'),
+    (b'\x89PNG\r\n\x1a\n', 'PNG'),
+    (b'GIF87a', 'GIF'),
+    (b'GIF89a', 'GIF'),
+)
+
+
+def sniff_format(head: bytes):
+    for signature, fmt in SIGNATURES:
+        if head.startswith(signature):
+            return fmt
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'WEBP'
+    return None
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def receive_image(file_storage, dest_dir, max_size=MAX_IMAGE_SIZE):
+    """Copy an uploaded image to `dest_dir` and validate it on the way.
+
+    Returns ``(True, path)`` or ``(False, error message)``.
+    """
+    if not file_storage:
+        return False, "No file uploaded"
+    os.makedirs(dest_dir, exist_ok=True)
+    path = os.path.join(dest_dir, uuid4().hex)
+    size = 0
+    head = b''
+    with open(path, 'wb') as out:
+        while True:
+            chunk = file_storage.stream.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            if len(head) < 16:
+                head += chunk[:16]
+            size += len(chunk)
+            if size > max_size:
+                out.close()
+                _remove(path)
+                return False, "Image exceeds 2MB"
+            out.write(chunk)
+    if size == 0:
+        _remove(path)
+        return False, "Empty image"
+
+    fmt = sniff_format(head)
+    if fmt is None:
+        _remove(path)
+        return False, "File is not an image"
+    Image = pil_image()
+    try:
+        # only parses the header, pixels are not decoded here; oversized
+        # images are refused just below, Pillow's warning adds nothing
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', Image.DecompressionBombWarning)
+            with Image.open(path, formats=[fmt]) as img:
+                width, height = img.size
+    except Image.DecompressionBombError:
+        # Pillow refuses images far above MAX_IMAGE_PIXELS already at open()
+        _remove(path)
+        return False, TOO_LARGE
+    except Exception:
+        _remove(path)
+        return False, "File is not a valid image"
+    if width * height > MAX_IMAGE_PIXELS:
+        _remove(path)
+        return False, TOO_LARGE
+    return True, path
+
+
+def accept_upload(file_storage):
+    """Validate an upload and claim an image processing slot for it.
+
+    Returns ``(raw_path, None)``, or ``(None, (body, status))`` to return
+    from the view.
+    """
+    ok, path_or_err = receive_image(file_storage, image_jobs.raw_dir)
+    if not ok:
+        return None, ({"error": path_or_err}, 400)
+    if not image_jobs.reserve():
+        _remove(path_or_err)
+        return None, ({"error": "Image processing is busy, try again shortly"}, 503)
+    return path_or_err, None
@@ -0,0 +1,71 @@
+"""Watermark rendering shared by every upload that carries one.
+
+The text is rendered once per (text, font size bucket) into a small RGBA
+tile and kept in a per-process cache, fonts are loaded once per size, and
+only the corner of the image the text covers is composited, so the cost no
+longer grows with the full image area.
+"""
+from functools import lru_cache
+
+from PIL import Image, ImageDraw, ImageFont
+
+FONT_CANDIDATES = ("arial.ttf", "DejaVuSans.ttf", "LiberationSans-Regular.ttf")
+# font sizes are rounded down to a multiple of this so similar widths share a tile
+SIZE_BUCKET = 4
+MIN_FONT_SIZE = 12
+MARGIN = 10
+FILL = (255, 255, 255, 120)
+
+
+def font_size_for(width):
+    size = max(MIN_FONT_SIZE, width // 20)
+    return max(MIN_FONT_SIZE, size - size % SIZE_BUCKET)
+
+
+@lru_cache(maxsize=32)
+def get_font(size):
+    for name in FONT_CANDIDATES:
+        try:
+            return ImageFont.truetype(name, size)
+        except OSError:
+            continue
+    try:
+        return ImageFont.load_default(size)
+    except TypeError:
+        # Pillow < 10.1 only has the fixed-size bitmap font
+        return ImageFont.load_default()
+
+
+@lru_cache(maxsize=64)
+def text_tile(text, size):
+    """The rendered text as an RGBA tile, with the width and height of its ink."""
+    font = get_font(size)
+    left, top, right, bottom = font.getbbox(text)
+    tile = Image.new("RGBA", (max(1, right), max(1, bottom)), (0, 0, 0, 0))
+    ImageDraw.Draw(tile).text((0, 0), text, font=font, fill=FILL)
+    return tile, right - left, bottom - top
+
+
+def apply_watermark(img, text):
+    """Draw `text` semi-transparently in the bottom-right corner of `img`.
+
+    L, LA, RGB and RGBA images keep their mode, anything else is converted
+    to RGB (RGBA when it has transparency).  `img` may be modified in place.
+    """
+    if img.mode not in ("L", "LA", "RGB", "RGBA"):
+        has_alpha = img.mode in ("PA", "La") or "transparency" in img.info
+        img = img.convert("RGBA" if has_alpha else "RGB")
+    width, height = img.size
+    tile, text_width, text_height = text_tile(text, font_size_for(width))
+
+    # same placement as drawing the text at (x, y) on a full-size layer
+    x = width - text_width - MARGIN
+    y = height - text_height - MARGIN
+    box = (max(x, 0), max(y, 0), min(x + tile.width, width), min(y + tile.height, height))
+    if box[0] >= box[2] or box[1] >= box[3]:
+        return img
+    tile = tile.crop((box[0] - x, box[1] - y, box[2] - x, box[3] - y))
+
+    region = Image.alpha_composite(img.crop(box).convert("RGBA"), tile)
+    img.paste(region.convert(img.mode), box[:2])
+    return img